@@ -1,209 +1,3495 @@
+import argparse
+import atexit
+import hashlib
+import html
 import json
+import multiprocessing
 import os
 import re
-import shutil
+import socket
+import queue
+import random
+import sys
 import threading
+import uuid
 import sqlite3
-from urllib.parse import urlparse, parse_qs
-from datetime import datetime
-import tkinter as tk
-from tkinter import filedialog, messagebox
-from tkinter import ttk
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse, urlunparse, parse_qs, parse_qsl, urlencode
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
+try:
+    import tkinter as tk
+    from tkinter import filedialog, messagebox
+    from tkinter import ttk
+except ImportError:
+    # Máy headless không có Tk: chỉ dùng được CLI
+    tk = None
+
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from camoufox.sync_api import Camoufox
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
 from bs4 import BeautifulSoup
+from lxml import etree
+from lxml import html as lxml_html
 import time
+from collections import deque
+from contextlib import contextmanager
 
 # File organization function removed.
 # Files are now organized at download time using the file_path stored in DB
 # (download logic moves files into per-user images/videos when saving).
 
-def scrape_html(username, times=5):
+# ==================== METRICS ====================
+
+# Bucket (giây) của histogram thời gian
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Số mẫu tối đa giữ lại mỗi histogram để tính percentile (reservoir sampling)
+METRIC_MAX_SAMPLES = 10000
+
+
+class RunMetrics:
+    """
+    Counter và histogram thread-safe cho một lượt chạy (scrape / download / pipeline).
+
+    Tên metric theo quy ước Prometheus, label truyền dạng keyword, ví dụ
+    `metrics.observe("scrape_stage_seconds", 1.2, stage="goto")`. Kết quả xuất ra JSON
+    (`to_dict`) và Prometheus text format (`to_prometheus`).
+    """
+
+    def __init__(self, run_kind="run"):
+        self.run_kind = run_kind
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Cộng `value` vào counter `name`."""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Ghi một giá trị (thường là số giây) vào histogram `name`."""
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = {'count': 0, 'sum': 0.0, 'min': value, 'max': value,
+                        'buckets': [0] * len(METRIC_BUCKETS), 'samples': []}
+                self._histograms[key] = hist
+            hist['count'] += 1
+            hist['sum'] += value
+            hist['min'] = min(hist['min'], value)
+            hist['max'] = max(hist['max'], value)
+            for i, bound in enumerate(METRIC_BUCKETS):
+                if value <= bound:
+                    hist['buckets'][i] += 1
+                    break
+            if len(hist['samples']) < METRIC_MAX_SAMPLES:
+                hist['samples'].append(value)
+            else:
+                slot = random.randrange(hist['count'])
+                if slot < METRIC_MAX_SAMPLES:
+                    hist['samples'][slot] = value
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Đo thời gian của khối `with` vào histogram `name` (kể cả khi có exception)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def counter_value(self, name, **labels):
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+    @staticmethod
+    def _percentile(sorted_samples, fraction):
+        if not sorted_samples:
+            return None
+        index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+        return sorted_samples[index]
+
+    def to_dict(self):
+        """Tổng kết dạng JSON: counters, histograms (count/sum/min/max/p50/p90/p99) và throughput."""
+        elapsed = time.monotonic() - self._started
+        with self._lock:
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = []
+            for (name, labels), hist in sorted(self._histograms.items()):
+                samples = sorted(hist['samples'])
+                histograms.append({
+                    'name': name,
+                    'labels': dict(labels),
+                    'count': hist['count'],
+                    'sum': hist['sum'],
+                    'min': hist['min'],
+                    'max': hist['max'],
+                    'p50': self._percentile(samples, 0.50),
+                    'p90': self._percentile(samples, 0.90),
+                    'p99': self._percentile(samples, 0.99),
+                })
+        downloaded = sum(c['value'] for c in counters if c['name'] == 'download_bytes_total')
+        files = sum(c['value'] for c in counters if c['name'] == 'download_files_total' and c['labels'].get('result') == 'ok')
+        return {
+            'run': self.run_kind,
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            'seconds': elapsed,
+            'throughput': {
+                'files_per_second': files / elapsed if elapsed else 0.0,
+                'mb_per_second': downloaded / 1024 / 1024 / elapsed if elapsed else 0.0,
+            },
+            'counters': counters,
+            'histograms': histograms,
+        }
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        escaped = []
+        for key, value in items:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def to_prometheus(self, prefix="insta_"):
+        """Xuất metric theo Prometheus text exposition format (dùng cho node_exporter textfile collector)."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {prefix}{name} counter")
+                typed.add(name)
+            lines.append(f"{prefix}{name}{self._format_labels(labels)} {value}")
+        for (name, labels), hist in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {prefix}{name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(METRIC_BUCKETS, hist['buckets']):
+                cumulative += count
+                lines.append(f"{prefix}{name}_bucket{self._format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{prefix}{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {hist['count']}")
+            lines.append(f"{prefix}{name}_sum{self._format_labels(labels)} {hist['sum']}")
+            lines.append(f"{prefix}{name}_count{self._format_labels(labels)} {hist['count']}")
+        run_labels = [('run', self.run_kind)]
+        lines.append(f"# TYPE {prefix}run_duration_seconds gauge")
+        lines.append(f"{prefix}run_duration_seconds{self._format_labels(run_labels)} {time.monotonic() - self._started}")
+        lines.append(f"# TYPE {prefix}run_start_timestamp_seconds gauge")
+        lines.append(f"{prefix}run_start_timestamp_seconds{self._format_labels(run_labels)} {self.started_at}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, folder):
+        """
+        Ghi `<folder>/metrics/<run>-<thời gian>-<pid>.json` (một file mỗi lượt chạy) và
+        `<folder>/metrics/<run>.prom` (ghi đè, atomic) cho Prometheus.
+
+        :return: tuple (đường dẫn JSON, đường dẫn .prom)
+        """
+        metrics_dir = os.path.join(folder, "metrics")
+        os.makedirs(metrics_dir, exist_ok=True)
+        stamp = datetime.fromtimestamp(self.started_at).strftime("%Y%m%d-%H%M%S")
+        json_path = os.path.join(metrics_dir, f"{self.run_kind}-{stamp}-{os.getpid()}.json")
+        with open(json_path, "wb") as f:
+            f.write(orjson.dumps(self.to_dict(), option=orjson.OPT_INDENT_2))
+        prom_path = os.path.join(metrics_dir, f"{self.run_kind}.prom")
+        tmp_path = f"{prom_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, prom_path)
+        return json_path, prom_path
+
+
+def scrape_html(username, times=5, **scrape_options):
     with Camoufox() as browser:
         page = browser.new_page()
+        return scrape_page(page, username, times, **scrape_options)
+
+
+# ==================== RESOURCE FILTER ====================
+
+# Loại resource không cần cho việc đọc DOM của ul.profile-media-list
+DEFAULT_BLOCKED_RESOURCE_TYPES = ("image", "media", "font")
+# Tracker/quảng cáo phổ biến
+DEFAULT_BLOCKED_URL_PATTERNS = (
+    r"google-analytics\.com",
+    r"googletagmanager\.com",
+    r"doubleclick\.net",
+    r"googlesyndication\.com",
+    r"adservice\.google\.",
+    r"facebook\.net",
+    r"hotjar\.com",
+    r"clarity\.ms",
+)
+FIRST_PARTY_HOSTS = ("gramsnap.com",)
+
+
+class ResourceFilter:
+    """
+    Chặn request không cần thiết trong browser khi scrape (ảnh, video, font, tracker, ...).
+
+    Gắn vào page bằng `attach(page)` trước `page.goto`. Một instance có thể dùng chung cho
+    nhiều page/thread; số liệu được cộng dồn trong `stats`.
+    Byte của request bị chặn không thể biết (không tải), nên `bytes_loaded` ghi lại số byte thực
+    tế đã tải để so sánh với lần chạy không chặn.
+    """
+
+    def __init__(self, block_types=DEFAULT_BLOCKED_RESOURCE_TYPES, block_patterns=DEFAULT_BLOCKED_URL_PATTERNS,
+                 block_third_party=False, first_party_hosts=FIRST_PARTY_HOSTS):
+        self.block_types = set(block_types or ())
+        self.block_pattern = re.compile("|".join(block_patterns)) if block_patterns else None
+        self.block_third_party = block_third_party
+        self.first_party_hosts = tuple(first_party_hosts)
+        self._lock = threading.Lock()
+        self.stats = {'allowed': 0, 'blocked': 0, 'blocked_by_type': {}, 'bytes_loaded': 0}
+
+    def attach(self, page):
+        page.route("**/*", self._handle_route)
+        page.on("response", self._on_response)
+
+    def _is_first_party(self, url):
+        host = urlparse(url).hostname or ""
+        return any(host == h or host.endswith("." + h) for h in self.first_party_hosts)
+
+    def should_block(self, url, resource_type):
+        """True nếu request (url, resource_type) cần chặn."""
+        if resource_type in self.block_types:
+            return True
+        if self.block_pattern and self.block_pattern.search(url):
+            return True
+        if self.block_third_party and resource_type != "document" and not self._is_first_party(url):
+            return True
+        return False
+
+    def _handle_route(self, route):
+        request = route.request
+        resource_type = request.resource_type
+        if self.should_block(request.url, resource_type):
+            with self._lock:
+                self.stats['blocked'] += 1
+                by_type = self.stats['blocked_by_type']
+                by_type[resource_type] = by_type.get(resource_type, 0) + 1
+            route.abort()
+        else:
+            with self._lock:
+                self.stats['allowed'] += 1
+            route.continue_()
+
+    def _on_response(self, response):
+        try:
+            length = int(response.headers.get("content-length", 0))
+        except (TypeError, ValueError):
+            length = 0
+        with self._lock:
+            self.stats['bytes_loaded'] += length
+
+    def summary(self):
+        """Chuỗi tóm tắt số liệu để ghi log."""
+        with self._lock:
+            by_type = ", ".join(f"{k}={v}" for k, v in sorted(self.stats['blocked_by_type'].items()))
+            return (
+                f"Chặn {self.stats['blocked']} request ({by_type or 'không có'}), "
+                f"cho phép {self.stats['allowed']}, đã tải {self.stats['bytes_loaded'] / 1024 / 1024:.1f} MB"
+            )
+
+
+# ==================== JSON BACKEND ====================
+
+# Key chứa URL media / thời gian đăng trong JSON trả về từ XHR của trang (thử theo thứ tự)
+JSON_URL_KEYS = ("video_url", "download_url", "display_url", "image_url", "url", "src")
+JSON_TIME_KEYS = ("taken_at", "taken_at_timestamp", "timestamp", "created_at", "time", "date")
+_JSON_MEDIA_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp4", ".mov", ".webm")
+_JSON_MEDIA_HOST_PATTERN = re.compile(r"cdninstagram\.com|fbcdn\.net")
+
+
+class JsonResponseCollector:
+    """Ghi lại các response JSON (XHR/fetch) của page trong lúc search và scroll."""
+
+    def __init__(self):
+        self.responses = []
+
+    def attach(self, page):
+        page.on("response", self._on_response)
+
+    def _on_response(self, response):
+        if "json" in response.headers.get("content-type", ""):
+            self.responses.append(response)
+
+    def payloads(self):
+        """Đọc và parse (orjson) body của các response đã ghi lại; bỏ qua response lỗi."""
+        results = []
+        for response in self.responses:
+            try:
+                results.append(orjson.loads(response.body()))
+            except Exception:  # noqa: BLE001
+                continue
+        return results
+
+
+def _looks_like_media_url(url):
+    if not isinstance(url, str) or not url.lower().startswith(("http://", "https://")):
+        return False
+    parsed = urlparse(url)
+    return parsed.path.lower().endswith(_JSON_MEDIA_EXTENSIONS) or bool(_JSON_MEDIA_HOST_PATTERN.search(parsed.netloc))
+
+
+def _format_json_timestamp(value):
+    """
+    Chuyển timestamp trong JSON (epoch s/ms hoặc ISO 8601) về cùng định dạng với title trong HTML,
+    ví dụ "7/6/2025, 8:46:19 AM" (giờ local), để tên file và incremental sync khớp với đường HTML.
+    """
+    dt = None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        seconds = value / 1000 if value > 1e11 else value
+        dt = datetime.fromtimestamp(seconds)
+    elif isinstance(value, str):
+        if value.isdigit():
+            return _format_json_timestamp(int(value))
+        try:
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            if dt.tzinfo is not None:
+                dt = dt.astimezone().replace(tzinfo=None)
+        except ValueError:
+            return value
+    if dt is None:
+        return None
+    hour = dt.hour % 12 or 12
+    suffix = "AM" if dt.hour < 12 else "PM"
+    return f"{dt.month}/{dt.day}/{dt.year}, {hour}:{dt.minute:02d}:{dt.second:02d} {suffix}"
+
+
+def extract_media_from_json(payloads):
+    """
+    Duyệt đệ quy các payload JSON, lấy các object có URL media và thời gian đăng.
+
+    Object con (ví dụ từng ảnh trong carousel) không có thời gian sẽ dùng thời gian của object cha.
+
+    :return: list các tuple (url, timestamp) theo thứ tự xuất hiện, không trùng URL
+    """
+    results = []
+    seen = set()
+
+    def walk(node, inherited_time):
+        if isinstance(node, list):
+            for child in node:
+                walk(child, inherited_time)
+            return
+        if not isinstance(node, dict):
+            return
+
+        raw_time = next((node[k] for k in JSON_TIME_KEYS if node.get(k) not in (None, "")), None)
+        timestamp = _format_json_timestamp(raw_time) if raw_time is not None else inherited_time
+        url = next((node[k] for k in JSON_URL_KEYS if _looks_like_media_url(node.get(k))), None)
+        if url and timestamp and url not in seen:
+            seen.add(url)
+            results.append((url, timestamp))
+
+        for child in node.values():
+            if isinstance(child, (dict, list)):
+                walk(child, timestamp)
+
+    for payload in payloads:
+        walk(payload, None)
+    return results
+
+
+# Mỗi media item trong danh sách profile
+MEDIA_ITEM_SELECTOR = "ul.profile-media-list .media-content__info"
+_MEDIA_COUNT_GREW_JS = "([selector, count]) => document.querySelectorAll(selector).length > count"
+_MEDIA_TIMESTAMPS_JS = """(els, start) => els.slice(start).map(e => {
+    const p = e.querySelector('p.media-content__meta-time');
+    return p ? p.getAttribute('title') : null;
+})"""
+
+
+def scrape_page(page, username, times=5, adaptive=False, target_count=None,
+                idle_timeout=3.0, max_idle=2, max_scrolls=1000, known_timestamps=None, resource_filter=None,
+                json_media=None, stats=None, metrics=None):
+    """
+    Scrape danh sách media của `username` trên một page đã mở sẵn (dùng chung với BrowserPool).
+
+    :param times: số lượt scroll cố định (chế độ cũ, adaptive=False)
+    :param adaptive: True = chỉ chờ đến khi có item mới, tự dừng khi số item không tăng nữa
+    :param target_count: (adaptive) dừng khi đã có ít nhất ngần này item; None = tất cả
+    :param idle_timeout: (adaptive) số giây chờ item mới sau mỗi lượt scroll
+    :param max_idle: (adaptive) số lượt liên tiếp không có item mới thì dừng
+    :param max_scrolls: (adaptive) giới hạn an toàn số lượt scroll
+    :param known_timestamps: (incremental) tập timestamp đã có trong DB; dừng scroll ngay khi gặp
+    :param resource_filter: ResourceFilter (tùy chọn) để chặn ảnh/video/font/tracker khi scroll
+    :param json_media: list (tùy chọn) bật JSON backend: nhận các tuple (url, timestamp) lấy từ response
+        JSON của trang. Nếu lấy được, hàm trả về None (bỏ qua inner_html); nếu không có JSON nào
+        chứa media, fallback trả về HTML như bình thường.
+    :param stats: dict (tùy chọn) để nhận số liệu {'mode', 'scrolls', 'items', 'seconds', 'reached_known', 'backend'}
+    :param metrics: RunMetrics (tùy chọn) nhận thời gian từng giai đoạn (scrape_stage_seconds)
+    :return: HTML của ul.profile-media-list, hoặc None nếu đã lấy được media từ JSON
+    """
+    if metrics is None:
+        metrics = RunMetrics()
+    started = time.monotonic()
+    if resource_filter is not None:
+        resource_filter.attach(page)
+    json_collector = None
+    if json_media is not None:
+        json_collector = JsonResponseCollector()
+        json_collector.attach(page)
+    with metrics.time("scrape_stage_seconds", stage="goto"):
         page.goto("https://gramsnap.com/en/")
+    with metrics.time("scrape_stage_seconds", stage="search"):
         page.get_by_role("textbox", name="@username or link").fill(username)
         page.get_by_role("button", name="Search").click()
-        time.sleep(1)
+
+    scroll_started = time.perf_counter()
+    if adaptive:
+        try:
+            page.wait_for_selector(MEDIA_ITEM_SELECTOR, timeout=idle_timeout * 1000 * 5)
+        except PlaywrightTimeoutError:
+            pass
+        scrolls, items, reached_known = _scroll_until_stable(
+            page, target_count, idle_timeout, max_idle, max_scrolls, known_timestamps
+        )
+    else:
+        # page.wait_for_timeout thay cho time.sleep: sync API chỉ xử lý route handler (ResourceFilter)
+        # và event response (JSON backend) khi đang trong một lệnh Playwright, nên time.sleep sẽ giữ
+        # lại cả các XHR infinite-scroll cho đến lệnh kế tiếp
+        page.wait_for_timeout(1000)
         page.wait_for_load_state("load")
-        time.sleep(1)
-        for _ in range(times):
+        page.wait_for_timeout(1000)
+        scrolls, items = 0, None
+        reached_known = _reached_known_content(page, 0, known_timestamps)
+        while scrolls < times and not reached_known:
+            seen = page.locator(MEDIA_ITEM_SELECTOR).count() if known_timestamps else 0
             page.keyboard.press('End')
             page.wait_for_load_state("load")
-            time.sleep(1)
+            page.wait_for_timeout(1000)
             page.evaluate("window.scrollBy(0, -1000)")
             
             page.wait_for_load_state("load")
-            time.sleep(1)
-        time.sleep(5)
+            page.wait_for_timeout(1000)
+            scrolls += 1
+            reached_known = _reached_known_content(page, seen, known_timestamps)
+        if not reached_known:
+            page.wait_for_timeout(5000)
+    metrics.observe("scrape_stage_seconds", time.perf_counter() - scroll_started, stage="scroll")
+    metrics.inc("scrape_scrolls_total", scrolls)
+
+    html_content = None
+    if json_collector is not None:
+        with metrics.time("scrape_stage_seconds", stage="json_extract"):
+            json_media.extend(extract_media_from_json(json_collector.payloads()))
+    if not json_media:
+        with metrics.time("scrape_stage_seconds", stage="inner_html"):
+            html_content = page.locator("ul.profile-media-list").inner_html()
+        metrics.inc("scrape_html_bytes_total", len(html_content))
+    if stats is not None:
+        if items is None:
+            items = len(json_media) if json_media else html_content.count('media-content__info')
+        stats.update({
+            'mode': 'adaptive' if adaptive else 'fixed',
+            'scrolls': scrolls,
+            'items': items,
+            'seconds': time.monotonic() - started,
+            'reached_known': reached_known,
+            'backend': 'json' if json_media else 'html',
+        })
+    return html_content
+
+
+def _reached_known_content(page, start, known_timestamps):
+    """True nếu trong các item từ vị trí `start` trở đi có timestamp đã có trong DB."""
+    if not known_timestamps:
+        return False
+    timestamps = page.locator(MEDIA_ITEM_SELECTOR).evaluate_all(_MEDIA_TIMESTAMPS_JS, start)
+    return any(ts in known_timestamps for ts in timestamps if ts)
+
+
+def _scroll_until_stable(page, target_count=None, idle_timeout=3.0, max_idle=2, max_scrolls=1000,
+                         known_timestamps=None):
+    """
+    Scroll xuống cuối trang và chỉ chờ đến khi số media item tăng lên.
+
+    Dừng khi `max_idle` lượt liên tiếp không có item mới, khi đạt `target_count`, khi hết `max_scrolls`,
+    hoặc (incremental) khi gặp item có timestamp trong `known_timestamps`.
+
+    :return: tuple (số lượt scroll, số item hiện có, đã gặp nội dung cũ hay chưa)
+    """
+    count = page.locator(MEDIA_ITEM_SELECTOR).count()
+    reached_known = _reached_known_content(page, 0, known_timestamps)
+    scrolls = 0
+    idle = 0
+    while scrolls < max_scrolls and idle < max_idle and not reached_known:
+        if target_count and count >= target_count:
+            break
+        page.keyboard.press('End')
+        scrolls += 1
+        try:
+            page.wait_for_function(
+                _MEDIA_COUNT_GREW_JS,
+                arg=[MEDIA_ITEM_SELECTOR, count],
+                timeout=idle_timeout * 1000,
+            )
+            idle = 0
+        except PlaywrightTimeoutError:
+            idle += 1
+            # Kéo lên một đoạn để trang kích hoạt lại việc tải thêm ở lượt sau
+            page.evaluate("window.scrollBy(0, -1000)")
+        new_count = page.locator(MEDIA_ITEM_SELECTOR).count()
+        if new_count > count:
+            reached_known = _reached_known_content(page, count, known_timestamps)
+        count = new_count
+    return scrolls, count, reached_known
+
+
+# ==================== BROWSER POOL ====================
+
+class BrowserPool:
+    """
+    Giữ N browser Camoufox sống lâu để scrape nhiều username song song.
+
+    Playwright sync API không thread-safe nên mỗi browser thuộc về đúng một thread.
+    Mỗi username được scrape trên một page mới (context riêng) của browser đó.
+    Browser được khởi động lại sau `max_uses` lượt dùng hoặc khi thật sự crash (mất kết nối, không
+    mở được page); lỗi của riêng một username (timeout, profile private/rỗng) chỉ đóng page đó.
+    """
+
+    def __init__(self, size=2, max_uses=20, metrics=None, **launch_options):
+        self.size = max(1, int(size))
+        self.max_uses = max(1, int(max_uses))
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.launch_options = launch_options
+        self._stats_lock = threading.Lock()
+        self.stats = {'launches': 0, 'recycles': 0, 'crashes': 0, 'page_errors': 0}
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _launch(self):
+        with self.metrics.time("scrape_stage_seconds", stage="browser_launch"):
+            manager = Camoufox(**self.launch_options)
+            browser = manager.__enter__()
+        self._count('launches')
+        return manager, browser
+
+    @staticmethod
+    def _is_alive(browser):
+        """True nếu browser vẫn còn kết nối (dùng tiếp được cho username sau)."""
+        try:
+            return browser.is_connected()
+        except Exception:  # noqa: BLE001
+            return False
+
+    @staticmethod
+    def _shutdown(manager):
+        if manager is None:
+            return
+        try:
+            manager.__exit__(None, None, None)
+        except Exception:  # noqa: BLE001
+            pass
+
+    def scrape_many(self, usernames, scrape_func, on_result):
+        """
+        Scrape tất cả `usernames` với tối đa `size` browser song song.
+
+        :param usernames: list username
+        :param scrape_func: hàm scrape_func(page, username) -> html
+        :param on_result: callback on_result(username, html, error), gọi từ thread của browser
+        """
+        tasks = queue.Queue()
+        for username in usernames:
+            tasks.put(username)
+
+        threads = [
+            threading.Thread(target=self._worker, args=(tasks, scrape_func, on_result), daemon=True)
+            for _ in range(min(self.size, len(usernames)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _worker(self, tasks, scrape_func, on_result):
+        manager = None
+        browser = None
+        uses = 0
+        try:
+            while True:
+                try:
+                    username = tasks.get_nowait()
+                except queue.Empty:
+                    break
+
+                html_content = None
+                error = None
+                page = None
+                try:
+                    if browser is None:
+                        manager, browser = self._launch()
+                        uses = 0
+                    with self.metrics.time("scrape_stage_seconds", stage="new_page"):
+                        page = browser.new_page()
+                    html_content = scrape_func(page, username)
+                except Exception as e:  # noqa: BLE001
+                    error = e
+                    if page is not None and self._is_alive(browser):
+                        # Lỗi của riêng username này (timeout, profile private...): giữ browser
+                        self._count('page_errors')
+                    else:
+                        # Không launch / mở được page hoặc browser mất kết nối: khởi động lại ở lượt sau
+                        self._count('crashes')
+                        self._shutdown(manager)
+                        manager = browser = None
+                finally:
+                    if page is not None and browser is not None:
+                        try:
+                            page.close()
+                        except Exception:  # noqa: BLE001
+                            pass
+
+                uses += 1
+                if browser is not None and uses >= self.max_uses:
+                    self._count('recycles')
+                    self._shutdown(manager)
+                    manager = browser = None
+
+                on_result(username, html_content, error)
+        finally:
+            self._shutdown(manager)
+
+
+# ==================== HTTP CLIENT ====================
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+DEFAULT_TIMEOUT = 30
+
+
+class HttpClient:
+    """
+    HTTP client dùng chung cho mọi đường tải: một `requests.Session` với connection pool
+    (keep-alive), headers và timeout mặc định.
+
+    Session được dùng chung giữa các worker thread; urllib3 pool là thread-safe.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, headers=None, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS)
+        if headers:
+            self.session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._adapters = [adapter]
+
+    def get(self, url, **kwargs):
+        """GET qua session dùng chung (timeout mặc định nếu không truyền)."""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def head(self, url, **kwargs):
+        """HEAD qua session dùng chung (timeout mặc định nếu không truyền)."""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.head(url, **kwargs)
+
+    def get_stats(self):
+        """
+        Số liệu connection pool: tổng request, số kết nối mới, số lần tái sử dụng kết nối.
+
+        :return: dict {'requests', 'connections', 'reused', 'hosts'}
+        """
+        total_requests = 0
+        total_connections = 0
+        hosts = 0
+        for adapter in self._adapters:
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                hosts += 1
+                total_requests += pool.num_requests
+                total_connections += pool.num_connections
+        return {
+            'requests': total_requests,
+            'connections': total_connections,
+            'reused': max(0, total_requests - total_connections),
+            'hosts': hosts,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+# Lưu byte offset vào DB sau mỗi ~1 MB đã tải
+PROGRESS_SAVE_BYTES = 1024 * 1024
+
+
+def _content_range_start(response):
+    """Lấy byte bắt đầu từ header `Content-Range: bytes <start>-<end>/<total>`."""
+    match = re.match(r"bytes\s+(\d+)-", response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+def _response_total_size(response, offset=0):
+    """Tổng kích thước file (bytes) theo Content-Range/Content-Length, None nếu không rõ."""
+    match = re.match(r"bytes\s+\d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+    if match:
+        return int(match.group(1))
+    # Không tin Content-Length nếu body bị nén (requests tự giải nén)
+    if response.headers.get("Content-Encoding", "identity") not in ("", "identity"):
+        return None
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit():
+        return offset + int(length)
+    return None
+
+
+# Đọc body theo chunk thích ứng: bắt đầu 64 KB, tăng gấp đôi khi mạng nhanh (tối đa 1 MB),
+# giảm khi một lần đọc mất quá lâu để progress / rate limiter vẫn được cập nhật đều
+STREAM_CHUNK_MIN = 16 * 1024
+STREAM_CHUNK_START = 64 * 1024
+STREAM_CHUNK_MAX = 1024 * 1024
+# Thời gian mục tiêu (giây) cho mỗi lần đọc một chunk
+STREAM_READ_TARGET = 0.1
+
+_stream_buffers = threading.local()
+
+
+def _stream_buffer():
+    """memoryview của buffer đọc riêng cho thread hiện tại (dùng lại cho mọi file thread đó tải)."""
+    view = getattr(_stream_buffers, "view", None)
+    if view is None:
+        view = memoryview(bytearray(STREAM_CHUNK_MAX))
+        _stream_buffers.view = view
+    return view
+
+
+def _body_readinto(raw):
+    """
+    Hàm readinto(buffer) đọc body thẳng vào buffer của caller.
+
+    `urllib3.HTTPResponse.readinto` thực chất gọi read() rồi copy bytes vào buffer, nên đọc qua
+    `http.client.HTTPResponse` bên dưới (tự xử lý chunked transfer encoding và Content-Length).
+    Mỗi lần đọc vẫn chạy trong `_error_catcher` của urllib3 để lỗi socket được đổi sang lỗi
+    urllib3 và connection được trả về pool khi body đã đọc hết (giữ keep-alive).
+    Nếu phiên bản urllib3 không có các thuộc tính này thì dùng `raw.readinto`.
+    """
+    fp = getattr(raw, "_fp", None)
+    error_catcher = getattr(raw, "_error_catcher", None)
+    if fp is None or error_catcher is None or not hasattr(fp, "readinto"):
+        return raw.readinto
+
+    def readinto(buffer):
+        if fp.isclosed():
+            return 0
+        with error_catcher():
+            return fp.readinto(buffer)
+
+    return readinto
+
+
+def _iter_body(response):
+    """
+    Duyệt body của `response` (stream=True) thành các memoryview chỉ hợp lệ đến lần lặp kế tiếp.
+
+    Body không nén được đọc bằng `readinto` của http.client thẳng vào buffer dùng lại của thread
+    (không tạo object bytes cho mỗi chunk), kích thước chunk thích ứng theo tốc độ đọc. Body nén
+    (Content-Encoding) vẫn qua `iter_content` để requests giải nén.
+    """
+    if response.headers.get("Content-Encoding", "identity").lower() not in ("", "identity"):
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_START):
+            if chunk:
+                yield memoryview(chunk)
+        return
+
+    buffer = _stream_buffer()
+    readinto = _body_readinto(response.raw)
+    chunk_size = STREAM_CHUNK_START
+    while True:
+        started = time.monotonic()
+        count = readinto(buffer[:chunk_size])
+        if not count:
+            return
+        elapsed = time.monotonic() - started
+        yield buffer[:count]
+        if count == chunk_size and elapsed < STREAM_READ_TARGET / 2:
+            chunk_size = min(chunk_size * 2, STREAM_CHUNK_MAX)
+        elif elapsed > STREAM_READ_TARGET * 2:
+            chunk_size = max(chunk_size // 2, STREAM_CHUNK_MIN)
+
+
+def _write_all(f, view):
+    """Ghi hết `view` vào file mở không buffer (FileIO.write có thể ghi thiếu)."""
+    while view:
+        view = view[f.write(view):]
+
+
+def _preallocate(f, offset, total_bytes):
+    """
+    Cấp phát trước vùng [offset, total_bytes) bằng posix_fallocate (ít phân mảnh trên HDD).
+
+    :return: True nếu đã cấp phát (file lúc này dài đúng total_bytes), False nếu không hỗ trợ
+    """
+    if not hasattr(os, "posix_fallocate") or not total_bytes or total_bytes <= offset:
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), offset, total_bytes - offset)
+        return True
+    except OSError:
+        # Filesystem không hỗ trợ (ví dụ một số ổ mạng): ghi bình thường
+        return False
+
+
+# ==================== CONCURRENT DOWNLOAD ENGINE ====================
+
+class HostConcurrencyLimiter:
+    """Giới hạn số request đồng thời tới cùng một host (CDN)."""
+
+    def __init__(self, per_host=4):
+        self.per_host = max(1, int(per_host))
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _get_semaphore(self, url):
+        host = urlparse(url).netloc.lower()
+        with self._lock:
+            sem = self._semaphores.get(host)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.per_host)
+                self._semaphores[host] = sem
+            return sem
+
+    def run(self, url, func, *args, **kwargs):
+        """Chạy `func` khi còn slot cho host của `url`."""
+        sem = self._get_semaphore(url)
+        with sem:
+            return func(*args, **kwargs)
+
+
+# Mã HTTP coi như server đang throttle / quá tải: chờ rồi thử lại
+THROTTLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# Số lần thử lại một request bị throttle trước khi coi là lỗi
+THROTTLE_RETRIES = 4
+
+
+class TokenBucket:
+    """
+    Token bucket thread-safe: nạp `rate` token/giây, tối đa `capacity` token.
+
+    `reserve()` cho phép nợ token và trả về số giây phải chờ, nên request lớn (chunk lớn hơn
+    capacity) vẫn đi qua được và các thread chờ theo thứ tự đặt chỗ.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(self.rate, 1.0))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1.0):
+        """Lấy `amount` token; trả về số giây cần chờ trước khi dùng (0 nếu đủ token)."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+
+def _parse_retry_after(value):
+    """Số giây từ header `Retry-After` (dạng số giây hoặc HTTP date); None nếu không đọc được."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    """
+    Giới hạn tốc độ tải: request/giây và byte/giây, toàn cục và theo từng host (token bucket),
+    cộng thêm backoff thích ứng khi host trả 429/5xx.
+
+    Khi một host bị throttle, mọi request tới host đó chờ đến hết thời gian backoff
+    (theo `Retry-After` nếu có, nếu không thì lũy thừa 2 có jitter); mỗi response thành công
+    giảm dần mức backoff. Giá trị None / 0 nghĩa là không giới hạn.
+    """
+
+    def __init__(self, requests_per_second=None, bytes_per_second=None, host_requests_per_second=None,
+                 host_bytes_per_second=None, backoff_base=1.0, backoff_max=60.0):
+        self.requests_per_second = requests_per_second or None
+        self.bytes_per_second = bytes_per_second or None
+        self.host_requests_per_second = host_requests_per_second or None
+        self.host_bytes_per_second = host_bytes_per_second or None
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._request_bucket = TokenBucket(self.requests_per_second) if self.requests_per_second else None
+        self._byte_bucket = TokenBucket(self.bytes_per_second) if self.bytes_per_second else None
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self.stats = {'throttled': 0, 'waits': 0, 'wait_seconds': 0.0}
+
+    def _host_state(self, url):
+        host = urlparse(url).netloc.lower()
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                state = {
+                    'requests': TokenBucket(self.host_requests_per_second) if self.host_requests_per_second else None,
+                    'bytes': TokenBucket(self.host_bytes_per_second) if self.host_bytes_per_second else None,
+                    'backoff_until': 0.0,
+                    'strikes': 0,
+                }
+                self._hosts[host] = state
+            return state
+
+    def _sleep(self, seconds):
+        if seconds <= 0:
+            return
+        with self._lock:
+            self.stats['waits'] += 1
+            self.stats['wait_seconds'] += seconds
+        time.sleep(seconds)
+
+    def acquire_request(self, url):
+        """Chặn đến khi được phép gửi thêm một request tới host của `url`."""
+        state = self._host_state(url)
+        wait_for = max(0.0, state['backoff_until'] - time.monotonic())
+        if self._request_bucket:
+            wait_for = max(wait_for, self._request_bucket.reserve())
+        if state['requests']:
+            wait_for = max(wait_for, state['requests'].reserve())
+        self._sleep(wait_for)
+
+    def consume_bytes(self, url, amount):
+        """Tính `amount` byte vừa nhận vào giới hạn băng thông; chặn nếu đang vượt."""
+        if not self._byte_bucket and not self.host_bytes_per_second:
+            return
+        wait_for = self._byte_bucket.reserve(amount) if self._byte_bucket else 0.0
+        host_bucket = self._host_state(url)['bytes']
+        if host_bucket:
+            wait_for = max(wait_for, host_bucket.reserve(amount))
+        self._sleep(wait_for)
+
+    def on_throttled(self, url, retry_after=None):
+        """
+        Ghi nhận host trả 429/5xx: đặt thời gian backoff cho host.
+
+        :return: số giây backoff đã đặt
+        """
+        state = self._host_state(url)
+        with self._lock:
+            state['strikes'] += 1
+            self.stats['throttled'] += 1
+            if retry_after is not None:
+                delay = min(retry_after, self.backoff_max)
+            else:
+                # Exponential backoff với "equal jitter": tránh mọi worker thử lại cùng lúc
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (state['strikes'] - 1))
+                delay = delay / 2 + random.uniform(0, delay / 2)
+            state['backoff_until'] = max(state['backoff_until'], time.monotonic() + delay)
+        return delay
+
+    def on_success(self, url):
+        """Response thành công: giảm dần mức backoff của host."""
+        state = self._host_state(url)
+        if state['strikes']:
+            with self._lock:
+                state['strikes'] = max(0, state['strikes'] - 1)
+
+    def snapshot(self):
+        """Trạng thái hiện tại: số lần bị throttle, thời gian chờ, số host đang backoff."""
+        now = time.monotonic()
+        with self._lock:
+            backoff_hosts = sum(1 for state in self._hosts.values() if state['backoff_until'] > now)
+            return dict(self.stats, backoff_hosts=backoff_hosts)
+
+    def summary(self):
+        """Chuỗi mô tả ngắn cho progress / log."""
+        snap = self.snapshot()
+        text = f"throttle {snap['throttled']}, chờ {snap['wait_seconds']:.1f}s"
+        if snap['backoff_hosts']:
+            text += f", {snap['backoff_hosts']} host đang backoff"
+        return text
+
+
+class ConcurrentDownloadEngine:
+    """
+    Chạy nhiều download song song bằng thread pool.
+
+    Mỗi item được xử lý bởi `handler(item)`; handler tự tải file và cập nhật DB.
+    Handler trả về True/False (thành công / lỗi tải) hoặc một chuỗi kết quả khác (ví dụ 'expired',
+    'skipped') cho item bị bỏ qua mà không phải lỗi; các kết quả này được đếm riêng.
+    Số item đang chạy được giới hạn ở `max_workers * 2` để không nạp hết hàng đợi vào pool.
+    """
+
+    def __init__(self, max_workers=8, per_host=4):
+        self.max_workers = max(1, int(max_workers))
+        self.host_limiter = HostConcurrencyLimiter(per_host)
+
+    def run(self, items, handler, on_done=None):
+        """
+        Xử lý tất cả `items` bằng `handler`.
+
+        :param items: iterable các item (ví dụ: row pending từ DB)
+        :param handler: hàm handler(item) -> bool (True nếu thành công) hoặc chuỗi kết quả
+        :param on_done: callback on_done(done_count, item, ok) sau mỗi item
+        :return: dict số item theo kết quả: {'success', 'failed'} và mỗi chuỗi kết quả handler trả về
+        """
+        counts = {'success': 0, 'failed': 0}
+        done_count = 0
+        max_in_flight = self.max_workers * 2
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = {}
+            item_iter = iter(items)
+            exhausted = False
+
+            while in_flight or not exhausted:
+                while not exhausted and len(in_flight) < max_in_flight:
+                    try:
+                        item = next(item_iter)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    in_flight[executor.submit(handler, item)] = item
+
+                if not in_flight:
+                    break
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    item = in_flight.pop(future)
+                    try:
+                        outcome = future.result()
+                    except Exception:  # noqa: BLE001
+                        outcome = False
+                    if not isinstance(outcome, str):
+                        outcome = 'success' if outcome else 'failed'
+                    counts[outcome] = counts.get(outcome, 0) + 1
+                    done_count += 1
+                    if on_done:
+                        on_done(done_count, item, outcome == 'success')
+
+        return counts
+
+
+# Các format timestamp (title của <p class="media-content__meta-time">)
+TIMESTAMP_FORMATS = ["%m/%d/%Y, %I:%M:%S %p", "%d/%m/%Y, %H:%M:%S", "%Y-%m-%d, %H:%M:%S"]
+
+# XPath biên dịch sẵn cho lxml parser (tương đương class_=... của BeautifulSoup)
+_XPATH_MEDIA_INFO_DIVS = etree.XPath(
+    "//div[contains(concat(' ', normalize-space(@class), ' '), ' media-content__info ')]"
+)
+_XPATH_META_TIME = etree.XPath(
+    ".//p[contains(concat(' ', normalize-space(@class), ' '), ' media-content__meta-time ')]"
+)
+
+
+# ==================== SIGNED CDN URL ====================
+
+# Query param đổi theo mỗi lần scrape (chữ ký, hạn dùng, routing cache), không xác định media
+_VOLATILE_URL_PARAMS = {"oe", "oh", "ccb", "efg", "edm", "ig_cache_key"}
+_VOLATILE_URL_PARAM_PREFIXES = ("_nc_",)
+# Link proxy (ví dụ nút Download của trang scrape) bọc URL CDN thật trong query param
+_WRAPPED_URL_PARAMS = ("url", "uri", "u")
+# Link còn hạn dưới bấy nhiêu giây được coi như đã hết hạn (không kịp tải)
+URL_EXPIRY_MARGIN = 60
+
+
+def _unwrap_media_url(url):
+    """Trả về URL CDN bên trong nếu `url` là link proxy dạng ...?url=https://..., ngược lại trả về `url`."""
+    query = parse_qs(urlparse(url).query)
+    for key in _WRAPPED_URL_PARAMS:
+        for value in query.get(key, ()):
+            if value.lower().startswith(("http://", "https://")):
+                return value
+    return url
+
+
+def canonical_media_url(url):
+    """
+    Khóa chuẩn hóa của một media URL: bỏ chữ ký / hạn dùng / param cache và gộp các edge host
+    của CDN, nên cùng một file scrape ở hai thời điểm khác nhau cho ra cùng một khóa.
+    """
+    parsed = urlparse(_unwrap_media_url(url))
+    host = parsed.netloc.lower()
+    cdn_match = _JSON_MEDIA_HOST_PATTERN.search(host)
+    if cdn_match:
+        # scontent-xxx.cdninstagram.com, scontent.fxyz.fbcdn.net, ... phục vụ cùng một path
+        host = cdn_match.group(0)
+    params = sorted(
+        (key, value) for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if key not in _VOLATILE_URL_PARAMS and not key.startswith(_VOLATILE_URL_PARAM_PREFIXES)
+    )
+    return urlunparse(("https", host, parsed.path, "", urlencode(params), ""))
+
+
+def media_url_expiry(url):
+    """Thời điểm hết hạn (unix seconds) từ param `oe=` (hex) của link CDN đã ký; None nếu không có."""
+    values = parse_qs(urlparse(_unwrap_media_url(url)).query).get("oe")
+    try:
+        return int(values[0], 16)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+# ==================== FILE PLACEMENT ====================
+
+class FilePlacer:
+    """
+    Chọn tên file cuối cùng không trùng và đặt file đã tải xong vào đó mà không ghi đè.
+
+    Mỗi thư mục chỉ được `os.scandir` một lần để dựng index tên file; sau đó giữ chỗ một tên
+    (`reserve`) chỉ là tra set dưới lock, kể cả khi nhiều worker cùng đặt file trùng timestamp
+    (name.jpg, name_1.jpg, name_2.jpg...). `place` đổi file tạm sang tên cuối bằng `os.link`
+    (thất bại nếu tên đã tồn tại, kể cả do process khác tạo) nên không bao giờ có file ghi dở
+    hay file bị ghi đè ở tên cuối cùng.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # thư mục -> set tên (os.path.normcase) đã có trên đĩa hoặc đã được giữ chỗ
+        self._taken = {}
+        # (thư mục, base, ext) -> hậu tố _N thử tiếp theo
+        self._counters = {}
+
+    def _names(self, directory):
+        names = self._taken.get(directory)
+        if names is None:
+            try:
+                with os.scandir(directory) as entries:
+                    names = {os.path.normcase(entry.name) for entry in entries}
+            except FileNotFoundError:
+                names = set()
+            self._taken[directory] = names
+        return names
+
+    def reserve(self, path):
+        """Giữ chỗ `path`, hoặc `<base>_<N><ext>` nhỏ nhất còn trống nếu đã bị dùng; trả về path đã giữ."""
+        directory, file_name = os.path.split(os.path.abspath(path))
+        with self._lock:
+            names = self._names(directory)
+            if os.path.normcase(file_name) not in names:
+                names.add(os.path.normcase(file_name))
+                return os.path.join(directory, file_name)
+            base, ext = os.path.splitext(file_name)
+            key = (directory, os.path.normcase(base), os.path.normcase(ext))
+            counter = self._counters.get(key, 1)
+            while os.path.normcase(f"{base}_{counter}{ext}") in names:
+                counter += 1
+            self._counters[key] = counter + 1
+            file_name = f"{base}_{counter}{ext}"
+            names.add(os.path.normcase(file_name))
+            return os.path.join(directory, file_name)
+
+    def release(self, path):
+        """Bỏ giữ chỗ (file ở `path` đã bị xóa / chuyển đi)."""
+        directory, file_name = os.path.split(os.path.abspath(path))
+        with self._lock:
+            names = self._taken.get(directory)
+            if names is not None:
+                names.discard(os.path.normcase(file_name))
+
+    def place(self, source, path):
+        """
+        Chuyển file `source` (đã ghi đủ) sang tên trống gần `path` nhất, atomically và không ghi đè.
+
+        :return: đường dẫn absolute cuối cùng của file
+        """
+        while True:
+            target = self.reserve(path)
+            try:
+                os.link(source, target)
+            except FileExistsError:
+                # Tên bị tạo sau khi dựng index (process khác / bên ngoài): vẫn giữ trong index, thử tên kế
+                continue
+            except OSError:
+                # Filesystem không hỗ trợ hardlink: giữ tên bằng O_EXCL rồi os.replace đè lên file rỗng đó
+                if not self._replace_exclusive(source, target):
+                    continue
+                return target
+            os.remove(source)
+            return target
+
+    def _replace_exclusive(self, source, target):
+        try:
+            fd = os.open(target, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        except OSError:
+            self.release(target)
+            raise
+        os.close(fd)
+        try:
+            os.replace(source, target)
+        except OSError:
+            os.remove(target)
+            self.release(target)
+            raise
+        return True
+
+
+# Windows: so khớp đường dẫn không phân biệt hoa thường (os.path.normcase)
+_CASE_INSENSITIVE_PATHS = os.path.normcase("A") != "A"
+
+
+def _scan_tree(root, prefix):
+    """os.scandir đệ quy (không theo symlink); trả về dict {relpath (normcase): kích thước}."""
+    sizes = {}
+    normcase = os.path.normcase if _CASE_INSENSITIVE_PATHS else None
+    stack = [(root, prefix + os.sep)]
+    while stack:
+        path, rel_dir = stack.pop()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file(follow_symlinks=False):
+                            rel_path = rel_dir + entry.name
+                            sizes[normcase(rel_path) if normcase else rel_path] = entry.stat(follow_symlinks=False).st_size
+                        elif entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, rel_dir + entry.name + os.sep))
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return sizes
+
+
+def scan_folder_sizes(folder, workers=8):
+    """
+    Kích thước mọi file trong `folder`, duyệt một lần bằng os.scandir, song song theo từng
+    thư mục con cấp 1 (mỗi username một thư mục).
+
+    :return: dict {relpath so với folder (normcase): kích thước bytes}
+    """
+    sizes = {}
+    subdirs = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append((entry.path, entry.name))
+                elif entry.is_file(follow_symlinks=False):
+                    sizes[os.path.normcase(entry.name)] = entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for subtree in executor.map(lambda item: _scan_tree(*item), subdirs):
+            sizes.update(subtree)
+    return sizes
+
+
+# ==================== DATABASE FUNCTIONS ====================
+
+# Retry khi tải lỗi: chờ RETRY_BASE_SECONDS * 2^(lần thử - 1), tối đa RETRY_MAX_SECONDS;
+# sau MAX_DOWNLOAD_ATTEMPTS lần lỗi row chuyển sang 'failed' và không được tải tự động nữa
+MAX_DOWNLOAD_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 6 * 3600
+# Row 'failed' vì CDN từ chối link cũ (chữ ký hết hạn / không hợp lệ) được thử lại khi scrape ra link mới;
+# last_error lưu thông báo của raise_for_status ("403 Client Error: ...")
+LINK_REJECTED_STATUS_CODES = (403, 410)
+# Lease của một worker trên các row đã claim; heartbeat gia hạn mỗi LEASE_SECONDS / 3
+LEASE_SECONDS = 300
+# Số row 'ready' đọc mỗi trang khi đối chiếu DB với ổ đĩa
+RECONCILE_BATCH_SIZE = 50000
+
+
+def make_worker_id():
+    """ID duy nhất của một worker: host + pid + hậu tố ngẫu nhiên."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+class DownloadDatabase:
+    """
+    Quản lý SQLite database cho tracking downloads.
+
+    Dùng một connection sống lâu (WAL mode) cho cả object; connection được chia sẻ giữa các
+    thread nên mọi truy cập đi qua `self._lock`.
+    """
+    
+    def __init__(self, db_path, wal=True):
+        self.db_path = db_path
+        self.wal = wal
+        # Thời gian từng thao tác DB (db_op_seconds{op=...}); core gán RunMetrics của lượt chạy
+        self.metrics = RunMetrics()
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self._configure_connection()
+        self.init_database()
+
+    def _configure_connection(self):
+        """Bật WAL và các pragma phù hợp cho ghi nhiều, đọc song song."""
+        try:
+            with self._lock:
+                # WAL cần shared memory trên cùng một máy; DB trên ổ mạng dùng chung
+                # giữa nhiều host phải dùng rollback journal (wal=False)
+                self.conn.execute('PRAGMA journal_mode=WAL' if self.wal else 'PRAGMA journal_mode=DELETE')
+                # WAL + NORMAL: an toàn khi crash ứng dụng, chỉ fsync ở checkpoint
+                self.conn.execute('PRAGMA synchronous=NORMAL')
+                self.conn.execute('PRAGMA busy_timeout=30000')
+                self.conn.execute('PRAGMA temp_store=MEMORY')
+                self.conn.execute('PRAGMA cache_size=-16000')
+        except sqlite3.Error as e:
+            print(f"Cảnh báo: Không thể cấu hình pragma: {e}", file=sys.stderr)
+
+    def close(self):
+        """Đóng connection (checkpoint WAL)."""
+        with self._lock:
+            try:
+                self.conn.close()
+            except sqlite3.Error as e:
+                print(f"Lỗi đóng database: {e}", file=sys.stderr)
+    
+    def init_database(self):
+        """Tạo database và bảng nếu chưa tồn tại."""
+        try:
+            with self._lock:
+                cursor = self.conn.cursor()
+                
+                # Tạo bảng downloads
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS downloads (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        username TEXT NOT NULL,
+                        url TEXT NOT NULL UNIQUE,
+                        timestamp TEXT,
+                        file_path TEXT,
+                        status TEXT DEFAULT 'pending',
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                
+                self.conn.commit()
+                # Tạo index UNIQUE trên file_path để dùng file_path làm khóa trùng lặp
+                try:
+                    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_downloads_file_path ON downloads(file_path)')
+                    self.conn.commit()
+                except sqlite3.Error:
+                    # Nếu không thể tạo index (ví dụ do dữ liệu trùng lặp cũ), bỏ qua nhưng log
+                    print("Cảnh báo: Không thể tạo unique index trên file_path - có thể có các giá trị trùng lặp cũ.", file=sys.stderr)
+
+                # Bảng high-water mark cho incremental sync: bài mới nhất đã thấy của mỗi username
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS sync_state (
+                        username TEXT PRIMARY KEY,
+                        newest_timestamp TEXT,
+                        newest_url TEXT,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                cursor.execute('CREATE INDEX IF NOT EXISTS ix_downloads_username ON downloads(username)')
+                # Hàng đợi pending: lọc theo status và duyệt theo id (keyset pagination)
+                cursor.execute('CREATE INDEX IF NOT EXISTS ix_downloads_status_id ON downloads(status, id)')
+
+                # Migrate DB cũ: thêm các cột mới nếu chưa có
+                existing_columns = {row[1] for row in cursor.execute('PRAGMA table_info(downloads)')}
+                for column, column_type in (
+                    ('bytes_downloaded', 'INTEGER DEFAULT 0'),
+                    ('total_bytes', 'INTEGER'),
+                    ('content_hash', 'TEXT'),
+                    ('canonical_url', 'TEXT'),
+                    ('expires_at', 'INTEGER'),
+                    ('attempts', 'INTEGER DEFAULT 0'),
+                    ('last_error', 'TEXT'),
+                    ('next_retry_at', 'INTEGER'),
+                    ('lease_owner', 'TEXT'),
+                    ('lease_expires_at', 'REAL'),
+                    ('etag', 'TEXT'),
+                ):
+                    if column not in existing_columns:
+                        cursor.execute(f'ALTER TABLE downloads ADD COLUMN {column} {column_type}')
+                # Tìm file trùng nội dung theo hash
+                cursor.execute('CREATE INDEX IF NOT EXISTS ix_downloads_content_hash ON downloads(content_hash)')
+                # Link đã ký đổi theo mỗi lần scrape: trùng lặp theo URL chuẩn hóa, không theo chuỗi URL
+                cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_downloads_canonical_url ON downloads(canonical_url)')
+                # Worker tải các link sắp hết hạn trước
+                cursor.execute('CREATE INDEX IF NOT EXISTS ix_downloads_status_expiry ON downloads(status, expires_at, id)')
+                # Lease hết hạn của worker bị crash (partial index: chỉ chứa các row đang tải)
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS ix_downloads_lease ON downloads(lease_expires_at) WHERE status = 'downloading'"
+                )
+                self._backfill_canonical_urls(cursor)
+                self.conn.commit()
+        except sqlite3.Error as e:
+            print(f"Lỗi tạo database: {e}", file=sys.stderr)
+    
+    def _backfill_canonical_urls(self, cursor):
+        """Điền canonical_url / expires_at cho các row cũ (trước khi có 2 cột này)."""
+        rows = cursor.execute('SELECT id, url FROM downloads WHERE canonical_url IS NULL').fetchall()
+        if not rows:
+            return
+        # OR IGNORE: các row cũ trùng nhau chỉ giữ canonical_url ở row đầu tiên
+        cursor.executemany(
+            'UPDATE OR IGNORE downloads SET canonical_url = ?, expires_at = ? WHERE id = ?',
+            [(canonical_media_url(url), media_url_expiry(url), download_id) for download_id, url in rows]
+        )
+
+    def insert_many(self, username, rows):
+        """
+        INSERT OR IGNORE nhiều bản ghi của một username trong một transaction.
+
+        :param rows: iterable các tuple (url, timestamp, file_path)
+        :return: tuple (inserted, skipped); (0, 0) nếu lỗi (transaction được rollback)
+        """
+        rows = list(rows)
+        if not rows:
+            return 0, 0
+        try:
+            with self.metrics.time("db_op_seconds", op="insert_many"), self._lock, self.conn:
+                before = self.conn.total_changes
+                self.conn.executemany('''
+                    INSERT OR IGNORE INTO downloads 
+                    (username, url, timestamp, file_path, status, canonical_url, expires_at)
+                    VALUES (?, ?, ?, ?, 'pending', ?, ?)
+                ''', [
+                    (username, url, timestamp, file_path, canonical_media_url(url), media_url_expiry(url))
+                    for url, timestamp, file_path in rows
+                ])
+                inserted = self.conn.total_changes - before
+            self.metrics.inc("db_rows_inserted_total", inserted)
+            return inserted, len(rows) - inserted
+        except sqlite3.Error as e:
+            print(f"Lỗi insert: {e}", file=sys.stderr)
+            return 0, 0
+
+    def refresh_signed_urls(self, urls):
+        """
+        Cập nhật link mới (chữ ký + hạn dùng mới) cho các row chưa tải có cùng URL chuẩn hóa;
+        row 'expired' được đưa lại về 'pending' và được thử lại ngay. Row 'failed' chỉ được đưa lại
+        nếu lỗi do link cũ bị từ chối (LINK_REJECTED_STATUS_CODES); số lần thử được giữ nguyên nên
+        row lỗi vì lý do khác vẫn ở 'failed' (dùng `--retry-failed` để thử lại).
+
+        :param urls: iterable các URL vừa scrape
+        :return: số row được làm mới
+        """
+        rejected = tuple(f"{code} %" for code in LINK_REJECTED_STATUS_CODES)
+        params = [
+            (url, media_url_expiry(url), canonical_media_url(url), url) + rejected
+            for url in urls
+        ]
+        if not params:
+            return 0
+        try:
+            with self.metrics.time("db_op_seconds", op="refresh_signed_urls"), self._lock, self.conn:
+                before = self.conn.total_changes
+                self.conn.executemany(f'''
+                    UPDATE OR IGNORE downloads
+                    SET url = ?, expires_at = ?, status = 'pending', next_retry_at = NULL,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE canonical_url = ? AND url != ?
+                      AND (status IN ('pending', 'expired')
+                           OR (status = 'failed' AND ({" OR ".join(["last_error LIKE ?"] * len(rejected))})))
+                ''', params)
+                return self.conn.total_changes - before
+        except sqlite3.Error as e:
+            print(f"Lỗi update: {e}", file=sys.stderr)
+            return 0
+
+    def expire_pending(self, deadline):
+        """
+        Đánh dấu 'expired' các row pending có link hết hạn trước `deadline` (unix seconds);
+        các row này chờ scrape lại để lấy link mới.
+
+        :return: số row bị đánh dấu
+        """
+        try:
+            with self.metrics.time("db_op_seconds", op="expire_pending"), self._lock, self.conn:
+                cursor = self.conn.execute('''
+                    UPDATE downloads SET status = 'expired', updated_at = CURRENT_TIMESTAMP
+                    WHERE status = 'pending' AND expires_at IS NOT NULL AND expires_at <= ?
+                ''', (int(deadline),))
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"Lỗi update: {e}", file=sys.stderr)
+            return 0
+
+    def get_expired_usernames(self):
+        """Các username còn row 'expired' (cần scrape lại)."""
+        try:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT DISTINCT username FROM downloads WHERE status = 'expired' ORDER BY username"
+                ).fetchall()
+            return [row[0] for row in rows]
+        except sqlite3.Error as e:
+            print(f"Lỗi query: {e}", file=sys.stderr)
+            return []
+    
+    def get_pending_for_username(self, username):
+        """Lấy các downloads pending đã đến lượt tải của một username (dùng index username)."""
+        try:
+            with self.metrics.time("db_op_seconds", op="get_pending_for_username"), self._lock:
+                return self.conn.execute('''
+                    SELECT id, username, url, timestamp, file_path, expires_at FROM downloads
+                    WHERE username = ? AND status = 'pending' AND (next_retry_at IS NULL OR next_retry_at <= ?)
+                    ORDER BY expires_at IS NULL, expires_at, id
+                ''', (username, int(time.time()))).fetchall()
+        except sqlite3.Error as e:
+            print(f"Lỗi query: {e}", file=sys.stderr)
+            return []
+
+    def count_pending(self, eligible_only=True):
+        """Đếm số downloads pending (dùng index status); mặc định chỉ đếm row đã đến lượt tải."""
+        try:
+            with self._lock:
+                if eligible_only:
+                    return self.conn.execute('''
+                        SELECT COUNT(*) FROM downloads
+                        WHERE status = 'pending' AND (next_retry_at IS NULL OR next_retry_at <= ?)
+                    ''', (int(time.time()),)).fetchone()[0]
+                return self.conn.execute("SELECT COUNT(*) FROM downloads WHERE status = 'pending'").fetchone()[0]
+        except sqlite3.Error as e:
+            print(f"Lỗi query: {e}", file=sys.stderr)
+            return 0
+
+    def _pending_page(self, now, limit, last_expiry=-1, last_id=0):
+        """
+        Một trang row pending đã đến lượt tải theo thứ tự hàng đợi, ngay sau khóa (last_expiry, last_id):
+        link có hạn trước theo (expires_at, id), sau đó link không có hạn theo id.
+
+        Cả hai query đi thẳng theo index ix_downloads_status_expiry (keyset, không OFFSET, không sort
+        tạm) nên chi phí mỗi trang không phụ thuộc độ dài hàng đợi. Caller phải giữ `self._lock`.
+
+        :param last_expiry: expires_at của row cuối trang trước; -1 = từ đầu, None = đang ở phần không có hạn
+        """
+        rows = []
+        if last_expiry is not None:
+            rows = self.conn.execute('''
+                SELECT id, username, url, timestamp, file_path, expires_at FROM downloads
+                WHERE status = 'pending' AND expires_at IS NOT NULL
+                  AND (expires_at > ? OR (expires_at = ? AND id > ?))
+                  AND (next_retry_at IS NULL OR next_retry_at <= ?)
+                ORDER BY expires_at, id
+                LIMIT ?
+            ''', (last_expiry, last_expiry, last_id, now, limit)).fetchall()
+            if len(rows) >= limit:
+                return rows
+            last_id = 0
+        return rows + self.conn.execute('''
+            SELECT id, username, url, timestamp, file_path, expires_at FROM downloads
+            WHERE status = 'pending' AND expires_at IS NULL AND id > ?
+              AND (next_retry_at IS NULL OR next_retry_at <= ?)
+            ORDER BY id
+            LIMIT ?
+        ''', (last_id, now, limit - len(rows))).fetchall()
+
+    def iter_pending_downloads(self, batch_size=500):
+        """
+        Duyệt tất cả downloads pending đã đến lượt tải theo từng trang, link sắp hết hạn trước
+        (xem `_pending_page`). Row đang chờ retry (next_retry_at trong tương lai) bị bỏ qua.
+
+        Mỗi trang chỉ giữ `batch_size` row trong bộ nhớ và không giữ lock giữa các trang,
+        nên bộ nhớ không phụ thuộc vào độ dài hàng đợi.
+        """
+        now = int(time.time())
+        last_expiry, last_id = -1, 0
+        while True:
+            try:
+                with self._lock:
+                    rows = self._pending_page(now, batch_size, last_expiry, last_id)
+            except sqlite3.Error as e:
+                print(f"Lỗi query: {e}", file=sys.stderr)
+                return
+            if not rows:
+                return
+            yield from rows
+            last_expiry, last_id = rows[-1]['expires_at'], rows[-1]['id']
+
+    def claim_batch(self, owner, limit, lease_seconds=LEASE_SECONDS):
+        """
+        Claim nguyên tử tối đa `limit` row cho worker `owner` (→ downloading, kèm lease):
+        trước hết các row 'downloading' có lease đã hết hạn (worker bị crash giữa lượt chạy),
+        sau đó row pending đã đến lượt tải theo thứ tự hàng đợi (`_pending_page`).
+
+        Chọn id và UPDATE ... RETURNING nằm trong một transaction BEGIN IMMEDIATE nên nhiều process
+        cùng claim trên một DB không bao giờ nhận trùng row; mọi bước đi theo index nên thời gian
+        claim không tăng theo số row pending.
+
+        :return: list các row đã claim, link sắp hết hạn trước
+        """
+        now = time.time()
+        try:
+            with self.metrics.time("db_op_seconds", op="claim_batch"), self._lock, self.conn:
+                self.conn.execute('BEGIN IMMEDIATE')
+                ids = [row[0] for row in self.conn.execute('''
+                    SELECT id FROM downloads INDEXED BY ix_downloads_lease
+                    WHERE status = 'downloading' AND lease_expires_at < ? LIMIT ?
+                ''', (now, limit))]
+                if len(ids) < limit:
+                    ids += [row['id'] for row in self._pending_page(int(now), limit - len(ids))]
+                if not ids:
+                    return []
+                rows = self.conn.execute(f'''
+                    UPDATE downloads
+                    SET status = 'downloading', lease_owner = ?, lease_expires_at = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id IN ({", ".join("?" * len(ids))})
+                      AND (status = 'pending' OR (status = 'downloading' AND lease_expires_at < ?))
+                    RETURNING id, username, url, timestamp, file_path, expires_at
+                ''', (owner, now + lease_seconds, *ids, now)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Lỗi claim: {e}", file=sys.stderr)
+            return []
+        return sorted(rows, key=lambda row: (row['expires_at'] is None, row['expires_at'] or 0, row['id']))
+
+    def mark_downloading(self, download_id, owner=None, lease_seconds=LEASE_SECONDS):
+        """
+        Đánh dấu row đang được tải bởi `owner` (pending → downloading, hoặc gia hạn lease nếu row
+        đã được chính `owner` claim); False nếu row đã thuộc worker khác hoặc không còn pending.
+        """
+        try:
+            with self.metrics.time("db_op_seconds", op="mark_downloading"), self._lock, self.conn:
+                cursor = self.conn.execute('''
+                    UPDATE downloads
+                    SET status = 'downloading', lease_owner = ?, lease_expires_at = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND (status = 'pending' OR (status = 'downloading' AND lease_owner IS ?))
+                ''', (owner, time.time() + lease_seconds, download_id, owner))
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            print(f"Lỗi update: {e}", file=sys.stderr)
+            return False
+
+    def heartbeat(self, owner, lease_seconds=LEASE_SECONDS):
+        """Gia hạn lease của mọi row `owner` đang tải; trả về số row."""
+        try:
+            with self.metrics.time("db_op_seconds", op="heartbeat"), self._lock, self.conn:
+                cursor = self.conn.execute('''
+                    UPDATE downloads SET lease_expires_at = ?
+                    WHERE status = 'downloading' AND lease_owner = ?
+                ''', (time.time() + lease_seconds, owner))
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"Lỗi heartbeat: {e}", file=sys.stderr)
+            return 0
+
+    def release_expired_leases(self):
+        """
+        Đưa các row 'downloading' có lease đã hết hạn (worker bị crash / bị kill) về 'pending';
+        row 'downloading' không có lease (DB cũ) cũng được trả lại. Trả về số row.
+        """
+        try:
+            with self._lock, self.conn:
+                cursor = self.conn.execute('''
+                    UPDATE downloads
+                    SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+                    WHERE status = 'downloading' AND (lease_expires_at IS NULL OR lease_expires_at < ?)
+                ''', (time.time(),))
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"Lỗi update: {e}", file=sys.stderr)
+            return 0
+
+    def release_leases(self, owner):
+        """Trả các row `owner` đã claim nhưng chưa tải về 'pending' (khi worker dừng); trả về số row."""
+        try:
+            with self._lock, self.conn:
+                cursor = self.conn.execute('''
+                    UPDATE downloads
+                    SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+                    WHERE status = 'downloading' AND lease_owner = ?
+                ''', (owner,))
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"Lỗi update: {e}", file=sys.stderr)
+            return 0
+
+    def record_download_failure(self, download_id, error, max_attempts=MAX_DOWNLOAD_ATTEMPTS):
+        """
+        Ghi nhận một lần tải lỗi: tăng attempts, lưu last_error và hẹn lần thử tiếp theo
+        (exponential backoff); sau `max_attempts` lần lỗi chuyển row sang 'failed'.
+
+        :return: tuple (status mới, số lần đã thử, next_retry_at hoặc None)
+        """
+        try:
+            with self.metrics.time("db_op_seconds", op="record_download_failure"), self._lock, self.conn:
+                row = self.conn.execute('SELECT attempts FROM downloads WHERE id = ?', (download_id,)).fetchone()
+                attempts = ((row[0] or 0) if row else 0) + 1
+                if attempts >= max_attempts:
+                    status, next_retry_at = 'failed', None
+                else:
+                    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+                    status, next_retry_at = 'pending', int(time.time() + delay)
+                self.conn.execute('''
+                    UPDATE downloads
+                    SET status = ?, attempts = ?, last_error = ?, next_retry_at = ?,
+                        lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (status, attempts, str(error)[:500] if error else None, next_retry_at, download_id))
+            return status, attempts, next_retry_at
+        except sqlite3.Error as e:
+            print(f"Lỗi update: {e}", file=sys.stderr)
+            return 'pending', None, None
+
+    def get_ready_files(self, after_id=0, limit=RECONCILE_BATCH_SIZE):
+        """
+        Một trang các row 'ready' (keyset theo id, dùng index status) để đối chiếu với ổ đĩa.
+
+        :return: list tuple (id, username, url, file_path, total_bytes, etag) với id > after_id
+            (tuple thay vì sqlite3.Row cho nhanh khi đọc hàng triệu row)
+        """
+        try:
+            with self.metrics.time("db_op_seconds", op="get_ready_files"), self._lock:
+                cursor = self.conn.cursor()
+                cursor.row_factory = None
+                return cursor.execute('''
+                    SELECT id, username, url, file_path, total_bytes, etag FROM downloads
+                    WHERE status = 'ready' AND id > ?
+                    ORDER BY id LIMIT ?
+                ''', (after_id, limit)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Lỗi query: {e}", file=sys.stderr)
+            return []
+
+    def requeue_downloads(self, items):
+        """
+        Đưa các row 'ready' có file mất / thiếu về 'pending' để tải lại (attempts = 0).
+
+        :param items: iterable các tuple (id, lý do) - lý do được lưu vào last_error
+        :return: set các id đã thực sự được đưa lại hàng đợi (rỗng nếu lỗi - transaction được rollback)
+        """
+        items = list(items)
+        if not items:
+            return set()
+        try:
+            with self.metrics.time("db_op_seconds", op="requeue_downloads"), self._lock, self.conn:
+                requeued = set()
+                for download_id, reason in items:
+                    cursor = self.conn.execute('''
+                        UPDATE downloads SET status = 'pending', attempts = 0, next_retry_at = NULL,
+                            bytes_downloaded = 0, last_error = ?, updated_at = CURRENT_TIMESTAMP
+                        WHERE id = ? AND status = 'ready'
+                    ''', (reason, download_id))
+                    if cursor.rowcount > 0:
+                        requeued.add(download_id)
+                return requeued
+        except sqlite3.Error as e:
+            print(f"Lỗi update: {e}", file=sys.stderr)
+            return set()
+
+    def set_total_bytes(self, items):
+        """Lưu kích thước file đã xác nhận; items là iterable các tuple (id, total_bytes)."""
+        items = [(total_bytes, download_id) for download_id, total_bytes in items]
+        if not items:
+            return 0
+        try:
+            with self._lock, self.conn:
+                self.conn.executemany('''
+                    UPDATE downloads SET total_bytes = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+                ''', items)
+            return len(items)
+        except sqlite3.Error as e:
+            print(f"Lỗi update: {e}", file=sys.stderr)
+            return 0
+
+    def reset_failed(self):
+        """Đưa các row 'failed' về 'pending' để thử lại từ đầu (attempts = 0); trả về số row."""
+        try:
+            with self._lock, self.conn:
+                cursor = self.conn.execute('''
+                    UPDATE downloads SET status = 'pending', attempts = 0, next_retry_at = NULL,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE status = 'failed'
+                ''')
+                return cursor.rowcount
+        except sqlite3.Error as e:
+            print(f"Lỗi update: {e}", file=sys.stderr)
+            return 0
+    
+    def update_download_status(self, download_id, status, file_path=None):
+        """Update status và file_path của một download."""
+        try:
+            with self.metrics.time("db_op_seconds", op="update_download_status"), self._lock, self.conn:
+                if file_path:
+                    self.conn.execute('''
+                        UPDATE downloads 
+                        SET status = ?, file_path = ?, lease_owner = NULL, lease_expires_at = NULL,
+                            updated_at = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    ''', (status, file_path, download_id))
+                else:
+                    self.conn.execute('''
+                        UPDATE downloads 
+                        SET status = ?, lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    ''', (status, download_id))
+            return True
+        except sqlite3.Error as e:
+            print(f"Lỗi update: {e}", file=sys.stderr)
+            return False
+    
+    def update_download_progress(self, download_id, bytes_downloaded, total_bytes=None):
+        """Lưu byte offset đã tải (và tổng kích thước nếu biết) để resume khi bị ngắt."""
+        try:
+            with self.metrics.time("db_op_seconds", op="update_download_progress"), self._lock, self.conn:
+                self.conn.execute('''
+                    UPDATE downloads
+                    SET bytes_downloaded = ?, total_bytes = COALESCE(?, total_bytes), updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (bytes_downloaded, total_bytes, download_id))
+            return True
+        except sqlite3.Error as e:
+            print(f"Lỗi update progress: {e}", file=sys.stderr)
+            return False
+
+    def set_content_hash(self, download_id, content_hash, etag=None):
+        """Lưu SHA-256 của file đã tải (và ETag của server nếu có, dùng khi kiểm tra lại bằng If-None-Match)."""
+        try:
+            with self.metrics.time("db_op_seconds", op="set_content_hash"), self._lock, self.conn:
+                self.conn.execute('''
+                    UPDATE downloads SET content_hash = ?, etag = COALESCE(?, etag), updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (content_hash, etag, download_id))
+            return True
+        except sqlite3.Error as e:
+            print(f"Lỗi update hash: {e}", file=sys.stderr)
+            return False
+
+    def find_ready_by_hash(self, content_hash, exclude_id=None):
+        """Lấy các download đã ready có cùng nội dung (hash), trừ `exclude_id`."""
+        try:
+            with self.metrics.time("db_op_seconds", op="find_ready_by_hash"), self._lock:
+                return self.conn.execute('''
+                    SELECT id, username, file_path FROM downloads
+                    WHERE content_hash = ? AND status = 'ready' AND id != ?
+                    ORDER BY id
+                ''', (content_hash, exclude_id if exclude_id is not None else -1)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Lỗi query: {e}", file=sys.stderr)
+            return []
+
+    def get_known_timestamps(self, username):
+        """Lấy tập timestamp đã có trong DB của một username (dùng cho incremental sync)."""
+        try:
+            with self.metrics.time("db_op_seconds", op="get_known_timestamps"), self._lock:
+                cursor = self.conn.cursor()
+
+                cursor.execute('''
+                    SELECT DISTINCT timestamp FROM downloads
+                    WHERE username = ? AND timestamp IS NOT NULL
+                ''', (username,))
+                known = {row[0] for row in cursor.fetchall()}
+
+                cursor.execute('SELECT newest_timestamp FROM sync_state WHERE username = ?', (username,))
+                row = cursor.fetchone()
+                if row and row[0]:
+                    known.add(row[0])
+
+                return known
+        except sqlite3.Error as e:
+            print(f"Lỗi query: {e}", file=sys.stderr)
+            return set()
+
+    def get_sync_state(self, username):
+        """Lấy high-water mark (newest_timestamp, newest_url) của một username, None nếu chưa có."""
+        try:
+            with self._lock:
+                cursor = self.conn.execute('SELECT * FROM sync_state WHERE username = ?', (username,))
+                return cursor.fetchone()
+        except sqlite3.Error as e:
+            print(f"Lỗi query: {e}", file=sys.stderr)
+            return None
+
+    def update_sync_state(self, username, newest_timestamp, newest_url):
+        """Lưu high-water mark của một username (bài mới nhất đã thấy)."""
+        try:
+            with self._lock, self.conn:
+                self.conn.execute('''
+                    INSERT INTO sync_state (username, newest_timestamp, newest_url, updated_at)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(username) DO UPDATE SET
+                        newest_timestamp = excluded.newest_timestamp,
+                        newest_url = excluded.newest_url,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', (username, newest_timestamp, newest_url))
+            return True
+        except sqlite3.Error as e:
+            print(f"Lỗi update sync_state: {e}", file=sys.stderr)
+            return False
+
+    def get_download_by_id(self, download_id):
+        """Lấy thông tin một download theo ID."""
+        try:
+            with self._lock:
+                cursor = self.conn.execute('SELECT * FROM downloads WHERE id = ?', (download_id,))
+                return cursor.fetchone()
+        except sqlite3.Error as e:
+            print(f"Lỗi query: {e}", file=sys.stderr)
+            return None
+    
+    def get_stats(self):
+        """
+        Lấy số liệu thống kê: total, pending, ready (một query GROUP BY status).
+
+        :return: dict {'total', 'pending', 'ready', 'by_status': {status: count}}
+        """
+        try:
+            with self._lock:
+                rows = self.conn.execute(
+                    'SELECT status, COUNT(*) FROM downloads GROUP BY status'
+                ).fetchall()
+            by_status = {row[0]: row[1] for row in rows}
+            return {
+                'total': sum(by_status.values()),
+                'pending': by_status.get('pending', 0),
+                'ready': by_status.get('ready', 0),
+                'by_status': by_status,
+            }
+        except sqlite3.Error as e:
+            print(f"Lỗi query stats: {e}", file=sys.stderr)
+            return {'total': 0, 'pending': 0, 'ready': 0, 'by_status': {}}
+
+    def get_stats_by_username(self):
+        """
+        Số liệu theo từng username (một query GROUP BY username, status).
+
+        :return: dict {username: {status: count}}
+        """
+        try:
+            with self._lock:
+                rows = self.conn.execute(
+                    'SELECT username, status, COUNT(*) FROM downloads GROUP BY username, status'
+                ).fetchall()
+            stats = {}
+            for username, status, count in rows:
+                stats.setdefault(username, {})[status] = count
+            return stats
+        except sqlite3.Error as e:
+            print(f"Lỗi query stats: {e}", file=sys.stderr)
+            return {}
+
+class LeaseHeartbeat:
+    """Thread nền gia hạn lease của một worker mỗi `lease_seconds / 3` giây cho đến khi `stop()`."""
+
+    def __init__(self, db, owner, lease_seconds=LEASE_SECONDS):
+        self.db = db
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            self.db.heartbeat(self.owner, self.lease_seconds)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+# ==================== LOG WRITER ====================
+
+# Kích thước tối đa của log.txt trước khi xoay vòng sang log.txt.1 (0 = không xoay vòng)
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+# Số dòng tối đa gom vào một lần ghi
+LOG_BATCH_SIZE = 1000
+LOG_FORMATS = ("text", "jsonl")
+
+
+class LogWriter:
+    """
+    Ghi log qua hàng đợi: `write()` chỉ đưa dòng vào queue, một thread nền gom các dòng đang chờ
+    thành batch và ghi mỗi file một lần (file được giữ mở giữa các batch thay vì mở/đóng mỗi dòng).
+
+    - Xoay vòng theo kích thước: log.txt → log.txt.1 → ... → log.txt.<backup_count>.
+    - `fmt="jsonl"`: mỗi dòng là một object JSON {time, message, ...field riêng của item}.
+    - `flush()` chờ đến khi mọi dòng đã gửi được ghi xuống file; `close()` được gọi cả khi thoát (atexit).
+    """
+
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT, fmt="text"):
+        if fmt not in LOG_FORMATS:
+            raise ValueError(f"fmt phải là một trong {LOG_FORMATS}")
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.fmt = fmt
+        self._queue = queue.Queue()
+        self._files = {}
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def write(self, path, message, **fields):
+        """Đưa một dòng log vào hàng đợi (không chặn caller vì I/O)."""
+        self._ensure_thread()
+        self._queue.put((path, datetime.now(), message, fields))
+
+    def flush(self, timeout=10):
+        """Chờ thread nền ghi xong mọi dòng đã gửi trước lời gọi này."""
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                return
+        done = threading.Event()
+        self._queue.put((self._FLUSH, done))
+        done.wait(timeout)
+
+    def close(self, timeout=10):
+        """Ghi nốt các dòng đang chờ, đóng file và dừng thread nền (gọi lại `write` sẽ khởi động lại)."""
+        with self._thread_lock:
+            thread = self._thread
+            if thread is None or not thread.is_alive():
+                return
+            self._queue.put((self._STOP, None))
+            self._thread = None
+        thread.join(timeout)
+
+    def _ensure_thread(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = {}
+            for path, *rest in batch:
+                if path is self._FLUSH or path is self._STOP:
+                    # Ghi các dòng đứng trước marker rồi mới báo xong / dừng
+                    self._write_lines(lines)
+                    lines = {}
+                    self._close_files()
+                    if path is self._STOP:
+                        return
+                    rest[0].set()
+                    continue
+                lines.setdefault(path, []).append(self._format(*rest))
+            self._write_lines(lines)
+
+    def _format(self, when, message, fields):
+        if self.fmt == "jsonl":
+            record = {"time": when.isoformat(timespec="milliseconds"), "message": message, **fields}
+            return json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        return f"[{when:%Y-%m-%d %H:%M:%S}] {message}\n"
+
+    def _write_lines(self, lines):
+        for path, chunk in lines.items():
+            data = "".join(chunk)
+            try:
+                f = self._open(path)
+                # Kích thước thực trên đĩa (process khác có thể cũng đang ghi vào cùng file)
+                size = os.fstat(f.fileno()).st_size
+                if self.max_bytes and size and size + len(data.encode("utf-8")) > self.max_bytes:
+                    f = self._rotate(path)
+                f.write(data)
+                f.flush()
+            except Exception as e:
+                print(f"Lỗi ghi log: {e}", file=sys.stderr)
+
+    def _open(self, path):
+        f = self._files.get(path)
+        if f is None:
+            f = open(path, "a", encoding="utf-8")
+            self._files[path] = f
+        return f
+
+    def _rotate(self, path):
+        self._files.pop(path).close()
+        try:
+            if self.backup_count > 0:
+                for index in range(self.backup_count - 1, 0, -1):
+                    source = f"{path}.{index}"
+                    if os.path.exists(source):
+                        os.replace(source, f"{path}.{index + 1}")
+                os.replace(path, f"{path}.1")
+            else:
+                open(path, "w", encoding="utf-8").close()
+        except OSError as e:
+            # Ví dụ Windows: process khác đang mở file; tiếp tục ghi vào file hiện tại
+            print(f"Lỗi xoay vòng log: {e}", file=sys.stderr)
+        return self._open(path)
+
+    def _close_files(self):
+        for f in self._files.values():
+            try:
+                f.close()
+            except OSError:
+                pass
+        self._files.clear()
+
+
+# ==================== PROGRESS ====================
+
+# Khoảng thời gian (giây) dùng để tính tốc độ items/s, MB/s hiện tại
+PROGRESS_RATE_WINDOW = 5.0
+# Nhịp GUI đọc lại tiến trình (ms), khoảng 5 khung hình/giây
+PROGRESS_POLL_MS = 200
+
+
+class ProgressTracker:
+    """
+    Gom tiến trình từ nhiều worker thread để UI đọc theo nhịp cố định thay vì nhận một event mỗi item.
+
+    Worker chỉ cập nhật vài biến đếm dưới lock (`callback`, `add_bytes`); UI gọi `snapshot()`
+    định kỳ để lấy số item đã xong, message mới nhất, items/s, MB/s và ETA.
+    """
+
+    def __init__(self, rate_window=PROGRESS_RATE_WINDOW):
+        self.rate_window = rate_window
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, total=0, message=""):
+        """Bắt đầu lượt mới: xóa biến đếm và mẫu tốc độ."""
+        with self._lock:
+            self._done = 0
+            self._total = total
+            self._bytes = 0
+            self._message = message
+            self._started = time.monotonic()
+            self._samples = deque([(self._started, 0, 0)])
+
+    def callback(self, idx, total, url, msg):
+        """Dùng làm `progress_callback(idx, total, url, msg)`; gọi được từ mọi thread."""
+        with self._lock:
+            if total is not None:
+                self._total = total
+            if idx is not None and total is not None:
+                self._done = idx
+            if msg:
+                self._message = msg
+
+    def add_bytes(self, count):
+        """Cộng số byte vừa tải (gọi từ vòng lặp ghi file của worker)."""
+        with self._lock:
+            self._bytes += count
+
+    def snapshot(self):
+        """
+        Trạng thái hiện tại; tốc độ tính trên `rate_window` giây gần nhất.
+
+        :return: dict {'done', 'total', 'message', 'bytes', 'elapsed', 'items_per_second',
+            'mb_per_second', 'eta_seconds'}; eta_seconds là None khi chưa ước lượng được
+        """
+        now = time.monotonic()
+        with self._lock:
+            done, total, total_bytes, message = self._done, self._total, self._bytes, self._message
+            samples = self._samples
+            samples.append((now, done, total_bytes))
+            while len(samples) > 2 and now - samples[1][0] >= self.rate_window:
+                samples.popleft()
+            first_time, first_done, first_bytes = samples[0]
+            started = self._started
+
+        span = now - first_time
+        items_per_second = (done - first_done) / span if span > 0 else 0.0
+        mb_per_second = (total_bytes - first_bytes) / 1024 / 1024 / span if span > 0 else 0.0
+        eta = None
+        if total and done < total and items_per_second > 0:
+            eta = (total - done) / items_per_second
+        return {
+            'done': done,
+            'total': total,
+            'message': message,
+            'bytes': total_bytes,
+            'elapsed': now - started,
+            'items_per_second': items_per_second,
+            'mb_per_second': mb_per_second,
+            'eta_seconds': eta,
+        }
+
+
+class InstaDownloaderCore:
+    """
+    Logic scrape / parse / download dùng chung cho GUI và CLI (không phụ thuộc Tkinter).
+
+    Tiến trình được báo qua `progress_callback(idx, total, url, msg)`; callback được gọi từ
+    worker thread nên GUI phải tự chuyển về Tk thread.
+    """
+
+    def __init__(self):
+        self.db = None
+        self.db_path = None
+        self._stats_lock = threading.Lock()
+        # Log ghi qua thread nền; CLI thay bằng LogWriter có cấu hình xoay vòng / JSON lines
+        self.log = LogWriter()
+        self.http = HttpClient()
+        self.rate_limiter = RateLimiter()
+        self.placer = FilePlacer()
+        # ID worker dùng cho lease khi nhiều process / host cùng tải từ một downloads.db
+        self.worker_id = make_worker_id()
+        self.wal = True
+        # Metric của lượt chạy hiện tại; `_begin_metrics` tạo mới, `_end_metrics` xuất file
+        self.metrics = RunMetrics()
+        self._metrics_depth = 0
+        # ProgressTracker (tùy chọn) nhận số byte đã tải để UI tính MB/s
+        self.progress_tracker = None
+
+    def _open_database(self, folder):
+        """Mở `<folder>/downloads.db` (dùng lại connection nếu cùng file)."""
+        self.db_path = os.path.join(folder, "downloads.db")
+        if not self.db or self.db.db_path != self.db_path:
+            if self.db:
+                self.db.close()
+            self.db = DownloadDatabase(self.db_path, wal=self.wal)
+        self.db.metrics = self.metrics
+        return self.db
+
+    def _begin_metrics(self, run_kind):
+        """Bắt đầu thu metric cho một lượt chạy; lượt lồng nhau (run_scrape trong pipeline) dùng chung."""
+        if self._metrics_depth == 0:
+            self.metrics = RunMetrics(run_kind)
+            if self.db:
+                self.db.metrics = self.metrics
+        self._metrics_depth += 1
+
+    def _end_metrics(self, folder, log_path):
+        """Kết thúc lượt chạy: lượt ngoài cùng xuất metric ra JSON + Prometheus text file."""
+        self._metrics_depth -= 1
+        if self._metrics_depth:
+            return
+        try:
+            json_path, prom_path = self.metrics.export(folder)
+            self._write_log(log_path, f"Metrics: {os.path.relpath(json_path, folder)}, {os.path.relpath(prom_path, folder)}")
+        except OSError as e:
+            self._write_log(log_path, f"⚠ Không ghi được metrics: {e}")
+
+    def close(self):
+        """Ghi nốt log, đóng HTTP session và database."""
+        self.log.close()
+        self.http.close()
+        if self.db:
+            self.db.close()
+
+    def _parse_links_from_text(self, text, engine="lxml"):
+        """
+        Parse tất cả URLs + metadata từ text, chỉ từ bên trong <div class="media-content__info">.
+        Lấy URL và timestamp từ title attribute để tạo tên file.
+
+        :param text: nội dung text từ widget (HTML)
+        :param engine: "lxml" (mặc định, nhanh) hoặc "bs4" (BeautifulSoup + html.parser, cách cũ)
+        :return: list các dict {'url': '...', 'filename': '...'}, xử lý trùng lặp tên file
+        """
+        if not text or not text.strip():
+            return []
+
+        parse_started = time.perf_counter()
+        if engine == "bs4":
+            items = self._iter_media_items_bs4(text)
+        else:
+            items = self._iter_media_items_lxml(text)
+
+        results = []
+        # Format timestamp được dò một lần rồi dùng lại cho cả trang
+        format_cache = {}
+
+        for url, timestamp in items:
+            # Chuyển timestamp thành tên file hợp lệ (dùng đuôi từ url nếu có)
+            filename = self._timestamp_to_filename(timestamp, url, format_cache=format_cache)
+
+            results.append({
+                'url': url,
+                'filename': filename,
+                'timestamp': timestamp
+            })
+
+        results = self._dedupe_filenames(results)
+        self.metrics.observe("parse_seconds", time.perf_counter() - parse_started, engine=engine)
+        self.metrics.inc("parse_items_total", len(results), engine=engine)
+        return results
+
+    def _iter_media_items_lxml(self, text):
+        """Duyệt các <div class="media-content__info"> bằng lxml, trả về (url, timestamp) cho item có URL."""
+        try:
+            root = lxml_html.document_fromstring(text)
+        except etree.ParserError:
+            # Trang chỉ có khoảng trắng/comment => "Document is empty", giống bs4: không có item nào
+            return
+        for div in _XPATH_MEDIA_INFO_DIVS(root):
+            url = None
+            for tag in div.iter('a', 'img', 'video', 'source'):
+                url = self._clean_url(tag.get('href') or tag.get('src') or tag.get('data-src'))
+                if url:
+                    break
+            if not url:
+                continue
+
+            p_tags = _XPATH_META_TIME(div)
+            timestamp = p_tags[0].get('title') if p_tags else None
+            yield url, timestamp
+
+    def _iter_media_items_bs4(self, text):
+        """Duyệt các <div class="media-content__info"> bằng BeautifulSoup (html.parser)."""
+        soup = BeautifulSoup(text, 'html.parser')
+
+        # Tìm tất cả div có class "media-content__info"
+        for div in soup.find_all('div', class_='media-content__info'):
+            # Lấy URL từ div
+            url = self._extract_url_from_content(div)
+            if not url:
+                continue
+
+            # Lấy timestamp từ <p class="media-content__meta-time" title="...">
+            yield url, self._extract_timestamp_from_content(div)
+
+    def _parse_links_from_json(self, json_media):
+        """
+        Tạo danh sách link từ media lấy được qua JSON backend (cùng định dạng với `_parse_links_from_text`).
+
+        :param json_media: list các tuple (url, timestamp) từ `extract_media_from_json`
+        :return: list các dict {'url', 'filename', 'timestamp'}, xử lý trùng lặp tên file
+        """
+        results = []
+        for url, timestamp in json_media or []:
+            results.append({
+                'url': url,
+                'filename': self._timestamp_to_filename(timestamp, url),
+                'timestamp': timestamp
+            })
+        return self._dedupe_filenames(results)
+
+    def _dedupe_filenames(self, results):
+        """Xử lý trùng lặp tên file: đánh số thứ tự ở cuối."""
+        filename_count = {}
+        for item in results:
+            filename = item['filename']
+            if filename in filename_count:
+                filename_count[filename] += 1
+                base, ext = os.path.splitext(filename)
+                item['filename'] = f"{base}_{filename_count[filename]}{ext}"
+            else:
+                filename_count[filename] = 1
+
+        return results
+
+    def _extract_url_from_content(self, div_element):
+        """Trích xuất URL từ BeautifulSoup div element."""
+        # Tìm tất cả thẻ a, img, video, source...
+        for tag in div_element.find_all(['a', 'img', 'video', 'source']):
+            url = self._clean_url(tag.get('href') or tag.get('src') or tag.get('data-src'))
+            if url:
+                return url
+
+        return None
+
+    def _clean_url(self, url):
+        """Chuẩn hóa URL lấy từ attribute; None nếu không phải URL http(s)."""
+        if not url:
+            return None
+        url = html.unescape(str(url)).strip()
+        if url.startswith('//'):
+            url = 'https:' + url
+        url = url.strip('"\'')
+        url = url.rstrip('.,;:!?)"\'')
+        if url.lower().startswith('http://') or url.lower().startswith('https://'):
+            return url
+        return None
+
+    def _extract_timestamp_from_content(self, div_element):
+        """Trích xuất timestamp từ title attribute của <p class="media-content__meta-time">."""
+        p_tag = div_element.find('p', class_='media-content__meta-time')
+        if p_tag:
+            return p_tag.get('title')
+        return None
+
+    def _timestamp_to_filename(self, timestamp, url=None, format_cache=None):
+        """
+        Chuyển timestamp thành tên file hợp lệ.
+        Nếu `url` được cung cấp, sẽ lấy phần đuôi (extension) từ path của URL và gán cho file.
+        Ví dụ: "7/6/2025, 8:46:19 AM" + url ending with .jpg -> "2025-07-06_08-46-19.jpg"
+
+        :param format_cache: dict dùng chung trong một trang để nhớ format timestamp đã khớp
+        """
+        # Helper: lấy extension từ URL nếu có
+        ext = ""
+        try:
+            if url:
+                _, ext = os.path.splitext(url or "")
+                if ext:
+                    ext = ext.lower()
+        except Exception:
+            ext = ""
+
+        if not timestamp:
+            return "file" + (ext if ext else ".bin")
+
+        try:
+            # Thử parse timestamp (ví dụ: "7/6/2025, 8:46:19 AM")
+            dt = self._timestamp_to_datetime(timestamp, format_cache)
+            if dt:
+                return dt.strftime("%Y-%m-%d_%H-%M-%S") + (ext if ext else ".bin")
+            
+            # Nếu không parse được, dùng timestamp trực tiếp, loại bỏ ký tự không hợp lệ
+            filename = re.sub(r'[<>:"/\\|?*]', '_', timestamp)
+            return filename + (ext if ext else ".bin")
+        except Exception:
+            return "file" + (ext if ext else ".bin")
+
+    def _timestamp_to_datetime(self, timestamp, format_cache=None):
+        """
+        Parse timestamp từ title (thử các format của gramsnap), None nếu không parse được.
+
+        :param format_cache: dict (tùy chọn); format khớp lần trước được thử đầu tiên và được cập nhật
+        """
+        if not timestamp:
+            return None
+        value = timestamp.strip()
+        cached = format_cache.get('format') if format_cache is not None else None
+        if cached:
+            try:
+                return datetime.strptime(value, cached)
+            except ValueError:
+                pass
+        for fmt in TIMESTAMP_FORMATS:
+            if fmt == cached:
+                continue
+            try:
+                dt = datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            if format_cache is not None:
+                format_cache['format'] = fmt
+            return dt
+        return None
+
+    def _update_high_water_mark(self, username, links_data):
+        """Cập nhật bài mới nhất đã thấy của username vào sync_state (chỉ tiến, không lùi)."""
+        newest = None
+        newest_dt = None
+        for item in links_data:
+            dt = self._timestamp_to_datetime(item['timestamp'])
+            if dt and (newest_dt is None or dt > newest_dt):
+                newest, newest_dt = item, dt
+        if newest is None:
+            return
+
+        state = self.db.get_sync_state(username)
+        if state:
+            state_dt = self._timestamp_to_datetime(state['newest_timestamp'])
+            if state_dt and state_dt >= newest_dt:
+                return
+        self.db.update_sync_state(username, newest['timestamp'], newest['url'])
+
+    def _write_log(self, log_path, message, **fields):
+        """
+        Ghi log vào file (qua hàng đợi của `self.log`, không chặn worker vì I/O).
+
+        :param log_path: đường dẫn file log
+        :param message: nội dung message cần ghi
+        :param fields: field riêng của item (id, username, bytes, duration...), chỉ xuất hiện ở định dạng jsonl
+        """
+        self.log.write(log_path, message, **fields)
+
+    def _download_link(self, url, file_path, index=None, progress_callback=None, download_id=None,
+                       download_info=None):
+        """
+        Download một link cụ thể và lưu trực tiếp vào `file_path` (absolute path or path relative to process cwd).
+
+        Dữ liệu được ghi vào `<file_path>.part`; nếu file `.part` đã tồn tại từ lần chạy trước bị
+        ngắt, tải tiếp bằng header `Range` (khi server hỗ trợ). Chỉ khi tải đủ, file `.part` mới
+        được `self.placer` đặt vào tên cuối cùng (thêm hậu tố _N nếu tên đã có, không ghi đè).
+
+        :param url: URL cần download
+        :param file_path: đường dẫn file đầy đủ (absolute) hoặc tương đối để lưu
+        :param index: số thứ tự (dùng khi cần hiển thị progress)
+        :param progress_callback: hàm callback (index, total, url, status_msg)
+        :param download_id: ID trong DB để lưu byte offset (bytes_downloaded) khi đang tải
+        :param download_info: dict (tùy chọn) để nhận {'sha256', 'bytes'} của file đã tải,
+            hoặc {'error'} nếu thất bại
+        :return: saved absolute file path as string nếu thành công, None nếu thất bại
+        """
+        part_path = None
+        try:
+            if progress_callback:
+                progress_callback(index, None, url, f"Đang tải {url}...")
+
+            # File tạm .part gắn với đường dẫn đích ban đầu để lần chạy sau tìm lại được
+            dir_name = os.path.dirname(file_path)
+            part_name = re.sub(r'[<>:"/\\|?*]', "_", os.path.basename(file_path)) + ".part"
+            part_path = os.path.join(dir_name, part_name)
+            offset = self._resume_offset(part_path, download_id)
+
+            # Request GET qua session dùng chung (keep-alive, headers giả lập browser),
+            # qua rate limiter; 429/5xx: backoff theo Retry-After / jitter rồi thử lại
+            limiter = self.rate_limiter
+            metrics = self.metrics
+            for attempt in range(THROTTLE_RETRIES + 1):
+                limiter.acquire_request(url)
+                request_headers = {"Range": f"bytes={offset}-"} if offset else None
+                # stream=True: get() trả về ngay khi nhận xong header => time-to-first-byte
+                with metrics.time("http_ttfb_seconds"):
+                    response = self.http.get(url, stream=True, headers=request_headers)
+                metrics.inc("http_responses_total", code=response.status_code)
+                if response.status_code == 416 and offset:
+                    # Range không hợp lệ (file .part hỏng hoặc server đã đổi nội dung): tải lại từ đầu
+                    response.close()
+                    offset = 0
+                    limiter.acquire_request(url)
+                    with metrics.time("http_ttfb_seconds"):
+                        response = self.http.get(url, stream=True)
+                    metrics.inc("http_responses_total", code=response.status_code)
+                if response.status_code not in THROTTLE_STATUS_CODES or attempt == THROTTLE_RETRIES:
+                    break
+                delay = limiter.on_throttled(url, _parse_retry_after(response.headers.get("Retry-After")))
+                response.close()
+                if progress_callback:
+                    progress_callback(index, None, url, f"HTTP {response.status_code}, chờ {delay:.1f}s rồi thử lại")
+            response.raise_for_status()
+            limiter.on_success(url)
+
+            # Server chỉ hỗ trợ resume nếu trả 206 với Content-Range bắt đầu đúng offset
+            if offset and response.status_code == 206 and _content_range_start(response) == offset:
+                mode = "r+b"
+            else:
+                offset = 0
+                mode = "wb"
+            total_bytes = _response_total_size(response, offset)
+
+            # Nếu file_path không có extension, thử đoán từ Content-Type
+            base, ext = os.path.splitext(file_path)
+            if not ext or ext == "":
+                content_type = response.headers.get("Content-Type", "")
+                if "image/jpeg" in content_type or "image/jpg" in content_type:
+                    file_path = f"{base}.jpg"
+                elif "image/png" in content_type:
+                    file_path = f"{base}.png"
+                elif "video/mp4" in content_type:
+                    file_path = f"{base}.mp4"
+                elif "image/gif" in content_type:
+                    file_path = f"{base}.gif"
+                else:
+                    # fallback to .bin
+                    file_path = f"{base}.bin"
+
+            # Hash nội dung trong lúc tải; khi resume, hash lại phần đã có trong .part trước
+            hasher = hashlib.sha256()
+            if offset:
+                with open(part_path, "rb") as existing:
+                    remaining = offset
+                    while remaining:
+                        block = existing.read(min(remaining, 1024 * 1024))
+                        if not block:
+                            break
+                        hasher.update(block)
+                        remaining -= len(block)
+
+            # Download vào file .part (không buffer, chunk lớn), lưu offset vào DB định kỳ
+            written = offset
+            last_saved = offset
+            body_started = time.perf_counter()
+            tracker = self.progress_tracker
+            with open(part_path, mode, buffering=0) as f:
+                if offset:
+                    f.seek(offset)
+                f.truncate()
+                # Chỉ cấp phát trước khi offset được lưu trong DB: sau crash, kích thước .part
+                # (đã cấp phát đủ) không còn cho biết đã tải tới đâu
+                preallocated = download_id is not None and _preallocate(f, offset, total_bytes)
+                try:
+                    for chunk in _iter_body(response):
+                        _write_all(f, chunk)
+                        hasher.update(chunk)
+                        size = len(chunk)
+                        written += size
+                        limiter.consume_bytes(url, size)
+                        if tracker:
+                            tracker.add_bytes(size)
+                        if download_id is not None and written - last_saved >= PROGRESS_SAVE_BYTES:
+                            self.db.update_download_progress(download_id, written, total_bytes)
+                            last_saved = written
+                finally:
+                    if preallocated and written != total_bytes:
+                        # Bỏ vùng cấp phát trước chưa có dữ liệu để lần sau resume đúng offset
+                        f.truncate(written)
+                file_size = os.fstat(f.fileno()).st_size
+
+            metrics.observe("download_body_seconds", time.perf_counter() - body_started)
+            metrics.inc("download_bytes_total", written - offset)
+            if total_bytes is not None and written != total_bytes:
+                raise IOError(f"Tải thiếu dữ liệu: {written}/{total_bytes} bytes")
+            if file_size != written:
+                raise IOError(f"Kích thước file không khớp: {file_size} bytes trên đĩa, đã tải {written} bytes")
+
+            # Đảm bảo filename không có ký tự không hợp lệ
+            dir_name = os.path.dirname(file_path)
+            file_name = os.path.basename(file_path)
+            file_name = re.sub(r'[<>:"/\\|?*]', "_", file_name)
+            file_path = os.path.join(dir_name, file_name)
+
+            # File đã đủ: đặt atomically vào tên cuối cùng chưa dùng (name.jpg, name_1.jpg, ...)
+            file_path = self.placer.place(part_path, file_path)
+            digest = hasher.hexdigest()
+            if download_id is not None:
+                self.db.update_download_progress(download_id, written, written)
+                self.db.set_content_hash(download_id, digest, response.headers.get("ETag"))
+            if download_info is not None:
+                download_info.update({'sha256': digest, 'bytes': written})
+            metrics.inc("download_files_total", result="ok")
+
+            if progress_callback:
+                progress_callback(index, None, url, f"Đã tải: {os.path.basename(file_path)}")
+
+            # Trả về đường dẫn file đã lưu (absolute path) để caller có thể cập nhật DB chính xác
+            return os.path.abspath(file_path)
+
+        except Exception as e:  # noqa: BLE001
+            self.metrics.inc("download_files_total", result="error")
+            if download_info is not None:
+                download_info['error'] = str(e)
+            # Giữ lại file .part và offset để lần chạy sau tải tiếp
+            if download_id is not None and part_path and os.path.isfile(part_path):
+                self.db.update_download_progress(download_id, os.path.getsize(part_path))
+            if progress_callback:
+                progress_callback(index, None, url, f"Lỗi: {e}")
+            return None
+
+    def _resume_offset(self, part_path, download_id):
+        """
+        Byte offset để tải tiếp `part_path`: kích thước file .part, nhưng không vượt quá
+        bytes_downloaded đã lưu trong DB (file .part có thể đã được cấp phát trước đủ kích thước
+        nếu process bị kill giữa chừng). 0 nếu chưa có file .part.
+        """
+        if not os.path.isfile(part_path):
+            return 0
+        offset = os.path.getsize(part_path)
+        if download_id is not None and offset:
+            row = self.db.get_download_by_id(download_id) if self.db else None
+            offset = min(offset, (row['bytes_downloaded'] or 0) if row else 0)
+        return offset
+
+    def run_scrape(self, folder, usernames, times=5, browsers=2, browser_max_uses=20, adaptive=False,
+                   target_count=None, incremental=False, block_resources=True, json_backend=False,
+                   progress_callback=None, on_stored=None):
+        """
+        Chỉ scrape và insert vào DB, không download file (nhiều username song song qua BrowserPool).
+
+        :param on_stored: callback on_stored(username) sau khi link của username đã vào DB
+            (gọi từ thread của browser; dùng cho pipeline)
+
+        :return: dict {'usernames', 'failed', 'inserted', 'skipped'}
+        """
+        # Khởi tạo database (dùng lại connection nếu cùng file)
+        self._open_database(folder)
+        self._begin_metrics("scrape")
+        summary = {'usernames': len(usernames), 'failed': 0, 'inserted': 0, 'skipped': 0}
+
+        def scrape_progress_callback(idx, total, msg):
+            if progress_callback:
+                progress_callback(idx, total, "", msg)
+
+        # Tạo file log
+        log_path = os.path.join(folder, "log.txt")
+        self._write_log(log_path, "="*50)
+        self._write_log(log_path, f"Bắt đầu scrape lúc: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        self._write_log(log_path, f"Số trình duyệt song song: {browsers}")
+        if adaptive:
+            self._write_log(log_path, f"Scroll thích ứng: bật (số bài tối đa: {target_count or 'tất cả'})")
+        if incremental:
+            self._write_log(log_path, "Incremental: dừng scroll khi gặp bài đã có trong DB")
+        self._write_log(log_path, "="*50)
+
+        # Username có link hết hạn phải scroll lại toàn bộ để lấy link mới (bỏ qua incremental)
+        expired_usernames = set(self.db.get_expired_usernames()) if incremental else set()
+
+        pool = BrowserPool(size=browsers, max_uses=browser_max_uses, metrics=self.metrics)
+        resource_filter = ResourceFilter() if block_resources else None
+        if not block_resources:
+            self._write_log(log_path, "Chặn resource: tắt (debug)")
+        try:
+            total_usernames = len(usernames)
+            done_lock = threading.Lock()
+            done = [0]
+
+            scrape_progress_callback(0, total_usernames, f"Scraping {total_usernames} username(s)...")
+
+            def on_result(username, scraped, error):
+                try:
+                    if error is not None:
+                        raise error
+                    inserted, skipped, result_msg = self._store_scraped_links(
+                        folder, username, scraped['html'], log_path, json_media=scraped['media']
+                    )
+                    with done_lock:
+                        summary['inserted'] += inserted
+                        summary['skipped'] += skipped
+                    if on_stored:
+                        on_stored(username)
+                except Exception as e:
+                    with done_lock:
+                        summary['failed'] += 1
+                    result_msg = f"✗ {username}: Lỗi - {str(e)[:50]}"
+                    self._write_log(log_path, f"✗ {username}: Lỗi - {str(e)}")
+                with done_lock:
+                    done[0] += 1
+                    user_idx = done[0]
+                scrape_progress_callback(user_idx, total_usernames, result_msg)
+
+            def scrape_func(page, username):
+                scroll_stats = {}
+                json_media = [] if json_backend else None
+                known_timestamps = (
+                    self.db.get_known_timestamps(username)
+                    if incremental and username not in expired_usernames else None
+                )
+                html_content = scrape_page(
+                    page, username, times=times, adaptive=adaptive, target_count=target_count,
+                    known_timestamps=known_timestamps, resource_filter=resource_filter, json_media=json_media,
+                    stats=scroll_stats, metrics=self.metrics
+                )
+                self._write_log(
+                    log_path,
+                    f"↻ {username}: {scroll_stats['scrolls']} lượt scroll, {scroll_stats['items']} item, "
+                    f"{scroll_stats['seconds']:.1f}s ({scroll_stats['mode']}, {scroll_stats['backend']})"
+                    + (", dừng tại bài đã có" if scroll_stats['reached_known'] else "")
+                )
+                return {'html': html_content, 'media': json_media}
+
+            pool.scrape_many(usernames, scrape_func, on_result)
+
+        finally:
+            # Ghi thống kê vào log
+            stats = self.db.get_stats()
+            self._write_log(
+                log_path,
+                f"Browser: {pool.stats['launches']} lần khởi động, {pool.stats['recycles']} lần recycle, "
+                f"{pool.stats['crashes']} crash, {pool.stats['page_errors']} username lỗi (giữ browser)"
+            )
+            if resource_filter is not None:
+                self._write_log(log_path, f"Resource filter: {resource_filter.summary()}")
+            self._write_log(log_path, f"Thống kê DB: Total={stats['total']}, Pending={stats['pending']}, Ready={stats['ready']}")
+            self._end_metrics(folder, log_path)
+            self._write_log(log_path, "="*50)
+            self._write_log(log_path, f"Kết thúc lúc: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            self._write_log(log_path, "="*50)
+            self.log.flush()
+
+        return summary
+
+    def _store_scraped_links(self, folder, username, html_content, log_path, json_media=None):
+        """
+        Parse HTML (hoặc media từ JSON backend nếu có) đã scrape của một username và INSERT vào DB.
+
+        :return: tuple (số insert, số skip, message kết quả để hiển thị)
+        """
+        # Xác định thư mục lưu cho username này
+        save_dir = os.path.join(folder, username)
+        os.makedirs(save_dir, exist_ok=True)
+
+        # Parse links từ JSON (nếu có) hoặc HTML
+        if json_media:
+            links_data = self._parse_links_from_json(json_media)
+        else:
+            links_data = self._parse_links_from_text(html_content)
+        if not links_data:
+            self._write_log(log_path, f"❌ {username}: Không tìm thấy link (0 file)")
+            return 0, 0, f"⚠ {username}: Không tìm thấy link"
+
+        # INSERT vào database trong một transaction (sử dụng file_path làm khóa trùng lặp)
+        rows = []
+        for link_data in links_data:
+            url = link_data['url']
+            timestamp = link_data['timestamp']
+            filename = link_data['filename']
+
+            # Xác định thư mục relative theo loại file (images/videos) dựa trên ext
+            base, ext = os.path.splitext(filename)
+            ext = ext.lower()
+            image_extensions = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
+            video_extensions = {".mp4", ".mov", ".avi", ".mkv", ".webm", ".flv"}
+
+            if ext in image_extensions:
+                rel_dir = os.path.join(username, "images")
+            elif ext in video_extensions:
+                rel_dir = os.path.join(username, "videos")
+            else:
+                rel_dir = username
+
+            file_path = os.path.join(rel_dir, filename)
+            rows.append((url, timestamp, file_path))
+
+        # Link mới của media đã có (chữ ký/hạn dùng mới) thay cho link cũ chưa tải được
+        refresh_count = self.db.refresh_signed_urls(row[0] for row in rows)
+        insert_count, skip_count = self.db.insert_many(username, rows)
+
+        self._update_high_water_mark(username, links_data)
+        self._write_log(
+            log_path,
+            f"✓ {username}: {insert_count} insert, {skip_count} skip"
+            + (f", {refresh_count} link được làm mới" if refresh_count else "")
+        )
+        return insert_count, skip_count, f"✓ {username}: {insert_count} insert, {skip_count} skip (trùng lặp)"
+
+    def run_download(self, folder, max_workers=8, per_host=4, progress_callback=None, dedupe="hardlink",
+                     rate_limits=None, max_attempts=MAX_DOWNLOAD_ATTEMPTS, retry_failed=False):
+        """
+        Download tất cả pending items từ database (song song).
+
+        Link sắp hết hạn được tải trước; link đã hết hạn được đánh dấu 'expired' và username
+        của chúng được trả về trong 'rescrape' để scrape lại. Chỉ tải row đã đến lượt
+        (next_retry_at đã qua); `retry_failed=True` đưa các row 'failed' về hàng đợi trước khi chạy.
+
+        Row được claim theo batch kèm lease (`self.worker_id`), nên có thể chạy nhiều process /
+        nhiều máy cùng lúc trên một downloads.db mà không worker nào tải trùng row.
+
+        :return: dict {'total', 'success', 'failed', 'expired', 'skipped', 'rescrape', 'waiting'}; total=0 nếu
+            không có gì để tải; 'failed' chỉ gồm lỗi tải, 'expired' gồm cả link hết hạn trong lúc chờ,
+            'skipped' là row đã được worker khác nhận; 'waiting' là số row pending chưa đến giờ thử lại
+        """
+        self._open_database(folder)
+        self._begin_metrics("download")
+        summary = {'total': 0, 'success': 0, 'failed': 0, 'expired': 0, 'skipped': 0, 'rescrape': [], 'waiting': 0}
+
+        log_path = os.path.join(folder, "log.txt")
+        self._write_log(log_path, "="*50)
+        self._write_log(log_path, f"Bắt đầu worker download lúc: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        self._write_log(log_path, f"Số luồng tải: {max_workers}, tối đa {per_host} kết nối/host")
+        self._write_log(log_path, "="*50)
+
+        try:
+            self._prepare_queue(log_path, retry_failed=retry_failed)
+            summary['expired'] = self._expire_pending_links(log_path)
+            summary['rescrape'] = self.db.get_expired_usernames()
+            total = self.db.count_pending()
+            summary['total'] = total
+            summary['waiting'] = self.db.count_pending(eligible_only=False) - total
+            if not total:
+                return summary
+
+            # Claim từng batch nhỏ (bộ nhớ không tăng theo số row pending, worker khác vẫn có việc);
+            # heartbeat giữ lease trong lúc các row đã claim đang chờ / đang tải
+            claim_size = max(1, max_workers * 2)
+
+            def claimed_rows():
+                while True:
+                    batch = self.db.claim_batch(self.worker_id, claim_size)
+                    if not batch:
+                        return
+                    yield from batch
+
+            self._write_log(log_path, f"Worker: {self.worker_id}")
+            try:
+                with LeaseHeartbeat(self.db, self.worker_id):
+                    counts = self._download_rows(
+                        folder, claimed_rows(), lambda: total, max_workers, per_host, log_path, progress_callback,
+                        dedupe=dedupe, rate_limits=rate_limits, max_attempts=max_attempts
+                    )
+            finally:
+                # Row đã claim nhưng chưa xử lý (bị dừng giữa chừng) trả lại hàng đợi ngay
+                self.db.release_leases(self.worker_id)
+            summary['success'] = counts['success']
+            summary['failed'] = counts['failed']
+            summary['expired'] += counts['expired']
+            summary['skipped'] = counts['skipped']
+            if counts['expired']:
+                summary['rescrape'] = self.db.get_expired_usernames()
+            
+            # Files are already moved into per-user images/videos during download; no extra organization step needed.
+            stats = self.db.get_stats()
+            self._write_log(log_path, f"Kết quả: {self._format_counts(counts)}")
+            http_stats = self.http.get_stats()
+            self._write_log(
+                log_path,
+                f"HTTP: {http_stats['requests']} request, {http_stats['connections']} kết nối mới, "
+                f"{http_stats['reused']} lần tái sử dụng kết nối ({http_stats['hosts']} host)"
+            )
+            self._write_log(log_path, f"Thống kê DB: Total={stats['total']}, Pending={stats['pending']}, Ready={stats['ready']}")
+            
+        finally:
+            self._end_metrics(folder, log_path)
+            self._write_log(log_path, "="*50)
+            self._write_log(log_path, f"Kết thúc lúc: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            self._write_log(log_path, "="*50)
+            self.log.flush()
+
+        return summary
+
+    def _prepare_queue(self, log_path, retry_failed=False):
+        """Trả lại hàng đợi các row có lease đã hết hạn (worker bị crash) và tùy chọn thử lại row 'failed'."""
+        stale = self.db.release_expired_leases()
+        if stale:
+            self._write_log(log_path, f"↺ {stale} file có lease hết hạn (worker bị ngắt) được đưa lại hàng đợi")
+        if retry_failed:
+            revived = self.db.reset_failed()
+            if revived:
+                self._write_log(log_path, f"↺ {revived} file failed được đưa lại hàng đợi")
+
+    @staticmethod
+    def _format_counts(counts):
+        """Chuỗi kết quả tải cho log: thành công / thất bại, kèm số row hết hạn / bị bỏ qua nếu có."""
+        text = f"{counts['success']} thành công, {counts['failed']} thất bại"
+        if counts['expired']:
+            text += f", {counts['expired']} hết hạn chờ scrape lại"
+        if counts['skipped']:
+            text += f", {counts['skipped']} đã được worker khác nhận"
+        return text
+
+    def _expire_pending_links(self, log_path):
+        """Đánh dấu 'expired' các link pending không còn kịp tải; trả về số row bị đánh dấu."""
+        expired = self.db.expire_pending(time.time() + URL_EXPIRY_MARGIN)
+        if expired:
+            self._write_log(log_path, f"⌛ {expired} link đã hết hạn, chờ scrape lại")
+        return expired
+
+    def _download_rows(self, folder, rows, get_total, max_workers, per_host, log_path, progress_callback=None,
+                       dedupe="hardlink", rate_limits=None, max_attempts=MAX_DOWNLOAD_ATTEMPTS):
+        """
+        Tải song song các row pending (iterable, có thể là generator chặn chờ như trong pipeline).
+
+        :param get_total: hàm trả về tổng số row hiện biết (dùng cho progress)
+        :param dedupe: "hardlink" hoặc "off" (xem `_dedupe_file`)
+        :param rate_limits: dict tham số của `RateLimiter` (requests_per_second, bytes_per_second, ...)
+        :param max_attempts: số lần tải lỗi tối đa trước khi row chuyển sang 'failed'
+        :return: dict {'success', 'failed', 'expired', 'skipped'}: 'failed' chỉ gồm lỗi tải thật; 'expired' là
+            link hết hạn trong lúc chờ, 'skipped' là row đã được worker khác nhận
+        """
+        dedupe_stats = {'files': 0, 'bytes': 0}
+        retry_stats = {'retry': 0, 'failed': 0}
+        self.rate_limiter = RateLimiter(**(rate_limits or {}))
+        # Index tên file dựng lại mỗi lượt tải (file có thể đã bị xóa / thêm giữa hai lượt)
+        self.placer = FilePlacer()
+        engine = ConcurrentDownloadEngine(max_workers=max_workers, per_host=per_host)
+        # Pool mỗi host đủ lớn cho số kết nối đồng thời tối đa tới host đó
+        self.http.close()
+        self.http = HttpClient(pool_maxsize=max(per_host, 1))
+
+        def handle_row(row):
+            return self._download_pending_row(
+                folder, row, engine.host_limiter, log_path, dedupe=dedupe, dedupe_stats=dedupe_stats,
+                max_attempts=max_attempts, retry_stats=retry_stats
+            )
+
+        def on_done(done_count, row, ok):
+            if progress_callback:
+                total = get_total()
+                progress_callback(
+                    done_count,
+                    total,
+                    row['url'][:50] + "...",
+                    f"Tải ({done_count}/{total}): {row['username']} [{self.rate_limiter.summary()}]"
+                )
+
+        counts = engine.run(rows, handle_row, on_done=on_done)
+        self._write_log(log_path, f"Rate limiter: {self.rate_limiter.summary()}")
+        if retry_stats['retry'] or retry_stats['failed']:
+            self._write_log(
+                log_path,
+                f"Retry: {retry_stats['retry']} file hẹn thử lại, {retry_stats['failed']} file bỏ qua (failed)"
+            )
+        if dedupe != "off":
+            self._write_log(
+                log_path,
+                f"Dedupe: {dedupe_stats['files']} file trùng nội dung, "
+                f"tiết kiệm {dedupe_stats['bytes'] / 1024 / 1024:.1f} MB dung lượng đĩa"
+            )
+        return {key: counts.get(key, 0) for key in ('success', 'failed', 'expired', 'skipped')}
 
-        return page.locator("ul.profile-media-list").inner_html()
-    
+    def run_pipeline(self, folder, usernames, max_workers=8, per_host=4, queue_size=None,
+                     progress_callback=None, dedupe="hardlink", rescrape_expired=True, rate_limits=None,
+                     max_attempts=MAX_DOWNLOAD_ATTEMPTS, **scrape_options):
+        """
+        Scrape và download cùng lúc: link của mỗi username vừa insert vào DB được đưa vào một
+        hàng đợi giới hạn (`queue_size`) để worker tải ngay trong khi username tiếp theo đang scrape.
+        Khi hàng đợi đầy, thread scrape bị chặn lại (backpressure). DB vẫn là bản ghi bền vững:
+        row chưa tải xong vẫn ở trạng thái pending cho lần chạy sau.
 
-# ==================== DATABASE FUNCTIONS ====================
+        :param rescrape_expired: scrape lại cả các username có link đã hết hạn trong DB
+        :param scrape_options: tham số của `run_scrape` (times, browsers, adaptive, ...)
+        :return: dict {'scrape': summary của run_scrape,
+            'download': {'total', 'success', 'failed', 'expired', 'skipped'}, 'seconds'};
+            nếu thread scrape gặp exception thì 'scrape' là None và 'scrape_error' chứa thông báo lỗi
+        """
+        started = time.monotonic()
+        self._open_database(folder)
+        link_queue = queue.Queue(maxsize=queue_size or max_workers * 4)
+        end_marker = object()
+        queued_ids = set()
+        queued_lock = threading.Lock()
+        result = {'scrape': None, 'download': {'total': 0, 'success': 0, 'failed': 0, 'expired': 0, 'skipped': 0}}
 
-class DownloadDatabase:
-    """Quản lý SQLite database cho tracking downloads."""
-    
-    def __init__(self, db_path):
-        self.db_path = db_path
-        self.init_database()
-    
-    def init_database(self):
-        """Tạo database và bảng nếu chưa tồn tại."""
+        log_path = os.path.join(folder, "log.txt")
+        self._begin_metrics("pipeline")
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Tạo bảng downloads
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS downloads (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT NOT NULL,
-                    url TEXT NOT NULL UNIQUE,
-                    timestamp TEXT,
-                    file_path TEXT,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            conn.commit()
-            # Tạo index UNIQUE trên file_path để dùng file_path làm khóa trùng lặp
+            self._write_log(log_path, f"Pipeline: scrape + download song song (hàng đợi tối đa {link_queue.maxsize} link)")
+            self._prepare_queue(log_path)
+            self._expire_pending_links(log_path)
+            if rescrape_expired:
+                extra = [u for u in self.db.get_expired_usernames() if u not in usernames]
+                if extra:
+                    self._write_log(log_path, f"Scrape lại {len(extra)} username có link hết hạn: {', '.join(extra)}")
+                    usernames = list(usernames) + extra
+
+            def enqueue_user(username):
+                for row in self.db.get_pending_for_username(username):
+                    with queued_lock:
+                        if row['id'] in queued_ids:
+                            continue
+                        queued_ids.add(row['id'])
+                    # Chặn khi hàng đợi đầy: scraper không chạy quá xa downloader
+                    link_queue.put(row)
+
+            def scrape_progress(idx, total, url, msg):
+                # done/total của progress là số row đã tải; tiến độ scrape (đếm theo username)
+                # chỉ gửi dưới dạng message để hai bộ đếm không ghi đè lẫn nhau
+                if progress_callback:
+                    progress_callback(None, None, url, f"Scrape {idx}/{total}: {msg}" if total else msg)
+
+            def producer():
+                try:
+                    result['scrape'] = self.run_scrape(
+                        folder, usernames, progress_callback=scrape_progress, on_stored=enqueue_user, **scrape_options
+                    )
+                except Exception as e:  # noqa: BLE001
+                    # Link đã vào hàng đợi vẫn được tải; caller thấy lỗi qua result['scrape_error']
+                    result['scrape_error'] = str(e)
+                    self._write_log(log_path, f"❌ Scrape dừng vì lỗi: {e}")
+                finally:
+                    link_queue.put(end_marker)
+
+            def queued_rows():
+                while True:
+                    row = link_queue.get()
+                    if row is end_marker:
+                        return
+                    yield row
+
+            scrape_thread = threading.Thread(target=producer, daemon=True)
+            scrape_thread.start()
+
+            def get_total():
+                with queued_lock:
+                    return len(queued_ids)
+
+            # Mỗi row được claim (lease) ngay trước khi tải; heartbeat giữ lease trong lúc tải
             try:
-                cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_downloads_file_path ON downloads(file_path)')
-                conn.commit()
-            except sqlite3.Error:
-                # Nếu không thể tạo index (ví dụ do dữ liệu trùng lặp cũ), bỏ qua nhưng log
-                print("Cảnh báo: Không thể tạo unique index trên file_path - có thể có các giá trị trùng lặp cũ.")
-            conn.close()
-        except sqlite3.Error as e:
-            print(f"Lỗi tạo database: {e}")
-    
-    def insert_or_ignore(self, username, url, timestamp, file_path):
-        """INSERT OR IGNORE một bản ghi vào DB với status=pending.
+                with LeaseHeartbeat(self.db, self.worker_id):
+                    counts = self._download_rows(
+                        folder, queued_rows(), get_total, max_workers, per_host, log_path, progress_callback,
+                        dedupe=dedupe, rate_limits=rate_limits, max_attempts=max_attempts
+                    )
+            finally:
+                self.db.release_leases(self.worker_id)
+            scrape_thread.join()
+
+            result['download'] = dict(counts, total=get_total())
+            result['seconds'] = time.monotonic() - started
+            stats = self.db.get_stats()
+            self._write_log(
+                log_path,
+                f"Pipeline xong sau {result['seconds']:.1f}s: {self._format_counts(counts)}"
+            )
+            self._write_log(log_path, f"Thống kê DB: Total={stats['total']}, Pending={stats['pending']}, Ready={stats['ready']}")
+        finally:
+            self._end_metrics(folder, log_path)
+            self.log.flush()
+        return result
 
-        Sử dụng `file_path` (relative path) làm khóa để kiểm tra trùng lặp.
+    def _download_pending_row(self, folder, row, host_limiter, log_path, dedupe="hardlink", dedupe_stats=None,
+                              max_attempts=MAX_DOWNLOAD_ATTEMPTS, retry_stats=None):
         """
+        Tải một row pending và cập nhật DB. Được gọi song song từ ConcurrentDownloadEngine.
+
+        Trạng thái: pending → downloading → ready; khi lỗi quay về pending với next_retry_at
+        (backoff) hoặc sang failed sau `max_attempts` lần.
+
+        :param dedupe: xử lý file trùng nội dung với file đã có: "hardlink" hoặc "off"
+        :param dedupe_stats: dict {'files', 'bytes'} cộng dồn số file/byte tiết kiệm được
+        :param retry_stats: dict {'retry', 'failed'} cộng dồn số row hẹn thử lại / bỏ hẳn
+        :return: True nếu tải thành công, False nếu lỗi tải; 'expired' nếu link hết hạn trong lúc chờ,
+            'skipped' nếu row đã được worker khác nhận (không phải lỗi tải)
+        """
+        download_id = None
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT OR IGNORE INTO downloads 
-                (username, url, timestamp, file_path, status)
-                VALUES (?, ?, ?, ?, 'pending')
-            ''', (username, url, timestamp, file_path))
-            
-            conn.commit()
-            conn.close()
-            return True
-        except sqlite3.Error as e:
-            print(f"Lỗi insert: {e}")
-            return False
-    
-    def get_pending_downloads(self, limit=None):
-        """Lấy tất cả downloads với status=pending."""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+            # Support sqlite3.Row or tuple
+            download_id = row['id'] if hasattr(row, 'keys') else row[0]
+            username = row['username'] if hasattr(row, 'keys') else row[1]
+            url = row['url'] if hasattr(row, 'keys') else row[2]
+            timestamp = row['timestamp'] if hasattr(row, 'keys') else row[3]
+            orig_file_path = row['file_path'] if hasattr(row, 'keys') else (row[4] if len(row) > 4 else None)
+            expires_at = row['expires_at'] if hasattr(row, 'keys') and 'expires_at' in row.keys() else None
+
+            # Link hết hạn trong lúc chờ trong hàng đợi: tải sẽ chỉ nhận 403, trả về để scrape lại
+            if expires_at is not None and expires_at <= time.time() + URL_EXPIRY_MARGIN:
+                self.db.update_download_status(download_id, 'expired')
+                self._write_log(
+                    log_path, f"⌛ ID={download_id}, {username}: Link hết hạn, chờ scrape lại",
+                    id=download_id, username=username, status='expired'
+                )
+                self.metrics.inc("download_files_total", result="expired")
+                return 'expired'
+
+            if not self.db.mark_downloading(download_id, owner=self.worker_id):
+                self._write_log(
+                    log_path, f"⚠ ID={download_id}, {username}: Đã được worker khác nhận, bỏ qua",
+                    id=download_id, username=username, status='skipped'
+                )
+                self.metrics.inc("download_files_total", result="skipped")
+                return 'skipped'
             
-            if limit:
-                cursor.execute('''
-                    SELECT id, username, url, timestamp, file_path FROM downloads 
-                    WHERE status = 'pending'
-                    LIMIT ?
-                ''', (limit,))
+            # Tạo thư mục và xác định nơi lưu file dựa trên file_path trong DB (nếu có)
+            if orig_file_path:
+                # Nếu DB đã có relative file_path (ví dụ: username/images/file.jpg), ghi trực tiếp vào thư mục đó
+                rel_dir = os.path.dirname(orig_file_path) or username
+                save_dir = os.path.join(folder, rel_dir)
+                filename_base = os.path.basename(orig_file_path)
             else:
-                cursor.execute('''
-                    SELECT id, username, url, timestamp, file_path FROM downloads 
-                    WHERE status = 'pending'
-                ''')
-            
-            results = cursor.fetchall()
-            conn.close()
-            return results
-        except sqlite3.Error as e:
-            print(f"Lỗi query: {e}")
-            return []
-    
-    def update_download_status(self, download_id, status, file_path=None):
-        """Update status và file_path của một download."""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            if file_path:
-                cursor.execute('''
-                    UPDATE downloads 
-                    SET status = ?, file_path = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (status, file_path, download_id))
+                save_dir = os.path.join(folder, username)
+                filename_base = self._timestamp_to_filename(timestamp, url)
+
+            os.makedirs(save_dir, exist_ok=True)
+
+            # Download file (returns absolute saved path or None)
+            target_path = os.path.join(save_dir, filename_base)
+            download_info = {}
+            started = time.perf_counter()
+            saved_abspath = host_limiter.run(
+                url, self._download_link, url, target_path, index=download_id, download_id=download_id,
+                download_info=download_info
+            )
+            if not saved_abspath:
+                self._record_failure(
+                    download_id, f"{username}: Lỗi tải", download_info.get('error'), max_attempts, retry_stats,
+                    log_path, username=username, duration=round(time.perf_counter() - started, 3)
+                )
+                return False
+
+            if orig_file_path:
+                # File đã được lưu ngay vào vị trí mong muốn; cập nhật DB bằng relative path
+                rel_path = os.path.relpath(saved_abspath, folder)
             else:
-                cursor.execute('''
-                    UPDATE downloads 
-                    SET status = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (status, download_id))
-            
-            conn.commit()
-            conn.close()
+                # Xác định thư mục đích theo loại file (images/videos) cho các mục không có file_path trong DB
+                _, ext = os.path.splitext(saved_abspath)
+                ext = ext.lower()
+                image_extensions = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
+                video_extensions = {".mp4", ".mov", ".avi", ".mkv", ".webm", ".flv"}
+
+                if ext in image_extensions:
+                    dest_dir = os.path.join(folder, username, "images")
+                elif ext in video_extensions:
+                    dest_dir = os.path.join(folder, username, "videos")
+                else:
+                    dest_dir = os.path.join(folder, username)
+
+                os.makedirs(dest_dir, exist_ok=True)
+                dest_path = os.path.join(dest_dir, os.path.basename(saved_abspath))
+
+                # Move file to destination if needed (không ghi đè file đã có ở thư mục đích)
+                try:
+                    if os.path.abspath(saved_abspath) != os.path.abspath(dest_path):
+                        dest_path = self.placer.place(saved_abspath, dest_path)
+                        self.placer.release(saved_abspath)
+                except Exception as e:
+                    # Nếu không thể move, log và tiếp tục với đường dẫn gốc
+                    self._write_log(log_path, f"⚠ ID={download_id}, {username}: Không thể di chuyển file: {e}")
+                    dest_path = saved_abspath
+
+                # Lưu relative path so với base folder trong DB
+                rel_path = os.path.relpath(dest_path, folder)
+
+            if dedupe != "off" and download_info.get('sha256'):
+                rel_path = self._dedupe_file(
+                    folder, download_id, rel_path, download_info, dedupe_stats, log_path
+                )
+
+            self.db.update_download_status(download_id, 'ready', rel_path)
+            self._write_log(
+                log_path, f"✓ ID={download_id}, {username}: {rel_path}",
+                id=download_id, username=username, status='ready', file_path=rel_path,
+                bytes=download_info.get('bytes'), duration=round(time.perf_counter() - started, 3)
+            )
             return True
-        except sqlite3.Error as e:
-            print(f"Lỗi update: {e}")
+
+        except Exception as e:
+            if download_id is not None:
+                self._record_failure(download_id, "Exception", str(e), max_attempts, retry_stats, log_path)
+            else:
+                self._write_log(log_path, f"✗ Exception ID={download_id}: {str(e)}")
             return False
-    
-    def get_download_by_id(self, download_id):
-        """Lấy thông tin một download theo ID."""
+
+    def _record_failure(self, download_id, label, error, max_attempts, retry_stats, log_path, **fields):
+        """Lưu lần tải lỗi vào DB (attempts / last_error / next_retry_at) và ghi log."""
+        status, attempts, next_retry_at = self.db.record_download_failure(download_id, error, max_attempts)
+        if status == 'failed':
+            detail = f"bỏ qua sau {attempts} lần thử"
+        elif next_retry_at:
+            detail = f"lần {attempts}/{max_attempts}, thử lại lúc {datetime.fromtimestamp(next_retry_at):%H:%M:%S}"
+        else:
+            detail = "thử lại lần sau"
+        if retry_stats is not None:
+            with self._stats_lock:
+                retry_stats['failed' if status == 'failed' else 'retry'] += 1
+        self._write_log(
+            log_path, f"✗ ID={download_id}, {label} ({detail}): {error or 'không rõ lỗi'}",
+            id=download_id, status=status, attempts=attempts, error=error, **fields
+        )
+
+
+    def _dedupe_file(self, folder, download_id, rel_path, download_info, dedupe_stats, log_path):
+        """
+        Nếu đã có file ready cùng SHA-256 và cùng kích thước, thay file vừa tải bằng hardlink tới file đó.
+        Mỗi row vẫn giữ file_path riêng (UNIQUE) nhưng chỉ tốn dung lượng đĩa một lần.
+
+        :return: relative path cần lưu vào DB cho download này
+        """
+        new_path = os.path.join(folder, rel_path)
+        size = download_info['bytes']
+        for existing in self.db.find_ready_by_hash(download_info['sha256'], exclude_id=download_id):
+            if not existing['file_path']:
+                continue
+            existing_path = os.path.join(folder, existing['file_path'])
+            try:
+                if not os.path.isfile(existing_path) or os.path.getsize(existing_path) != size:
+                    continue
+                if os.path.samefile(existing_path, new_path):
+                    return rel_path
+                # Tạo link ở tên tạm rồi os.replace để không bao giờ mất file ở tên cuối
+                tmp_link = new_path + ".link.tmp"
+                if os.path.lexists(tmp_link):
+                    os.remove(tmp_link)
+                os.link(existing_path, tmp_link)
+                os.replace(tmp_link, new_path)
+            except OSError as e:
+                # Ví dụ: khác ổ đĩa / filesystem không hỗ trợ hardlink: giữ nguyên file
+                self._write_log(log_path, f"⚠ ID={download_id}: Không thể dedupe ({e})")
+                return rel_path
+
+            if dedupe_stats is not None:
+                with self._stats_lock:
+                    dedupe_stats['files'] += 1
+                    dedupe_stats['bytes'] += size
+            self._write_log(log_path, f"≡ ID={download_id}: trùng nội dung với ID={existing['id']}, đã hardlink")
+            return rel_path
+        return rel_path
+
+    def run_reconcile(self, folder, workers=8, verify_remote=False, per_host=4, dry_run=False,
+                      progress_callback=None):
+        """
+        Đối chiếu các row 'ready' với file thực tế trên đĩa: file mất hoặc thiếu dữ liệu (nhỏ hơn
+        total_bytes) được đưa lại hàng đợi pending; file thiếu bị xóa để lần tải sau ghi đúng tên.
+
+        Ổ đĩa được duyệt một lần bằng os.scandir (song song theo thư mục username), DB được đọc
+        theo trang; không có lệnh stat riêng cho từng row.
+
+        :param verify_remote: gửi HEAD cho file nghi thiếu (kèm If-None-Match nếu có ETag) và file chưa
+            biết kích thước, để xác nhận kích thước trên server mà không tải lại
+        :param dry_run: chỉ báo cáo, không sửa DB / xóa file
+        :return: dict {'ready', 'ok', 'missing', 'short', 'requeued', 'verified', 'unverified',
+            'disk_files', 'seconds'}
+        """
+        started = time.monotonic()
+        self._open_database(folder)
+        self._begin_metrics("reconcile")
+        log_path = os.path.join(folder, "log.txt")
+        summary = {'ready': 0, 'ok': 0, 'missing': 0, 'short': 0, 'requeued': 0, 'verified': 0,
+                   'unverified': 0, 'disk_files': 0, 'seconds': 0.0}
+
+        def report(msg):
+            if progress_callback:
+                progress_callback(summary['ready'], None, "", msg)
+
         try:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT * FROM downloads WHERE id = ?', (download_id,))
-            result = cursor.fetchone()
-            conn.close()
-            return result
-        except sqlite3.Error as e:
-            print(f"Lỗi query: {e}")
-            return None
-    
-    def get_stats(self):
-        """Lấy số liệu thống kê: total, pending, ready."""
+            self._write_log(log_path, "="*50)
+            self._write_log(log_path, f"Bắt đầu đối chiếu DB với ổ đĩa lúc: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            with self.metrics.time("reconcile_stage_seconds", stage="scan"):
+                disk_sizes = scan_folder_sizes(folder, workers)
+            summary['disk_files'] = len(disk_sizes)
+            report(f"Đã quét {len(disk_sizes)} file trên đĩa")
+
+            # (row, kích thước trên đĩa, lý do) của các row cần xem xét thêm
+            suspects = []
+            unknown_size = []
+            requeue = []
+            with self.metrics.time("reconcile_stage_seconds", stage="compare"):
+                after_id = 0
+                ok_count = 0
+                while True:
+                    rows = self.db.get_ready_files(after_id)
+                    if not rows:
+                        break
+                    after_id = rows[-1][0]
+                    summary['ready'] += len(rows)
+                    for download_id, username, url, file_path, expected, etag in rows:
+                        size = disk_sizes.get(file_path)
+                        if size is None and file_path:
+                            # Đường dẫn lưu khác dạng với khi quét (dấu phân cách, hoa thường trên Windows)
+                            size = disk_sizes.get(os.path.normcase(os.path.normpath(file_path)))
+                        if size is not None and size == expected:
+                            ok_count += 1
+                            continue
+                        row = {'id': download_id, 'username': username, 'url': url, 'file_path': file_path,
+                               'etag': etag}
+                        if size is None:
+                            summary['missing'] += 1
+                            requeue.append((row, None, "reconcile: file không tồn tại"))
+                        elif size == 0 or (expected is not None and size != expected):
+                            suspects.append((row, size, f"reconcile: file thiếu ({size}/{expected or '?'} bytes)"))
+                        else:
+                            unknown_size.append((row, size))
+                    report(f"Đã đối chiếu {summary['ready']} file ready")
+                summary['ok'] = ok_count
+
+            confirmed_sizes = []
+            if verify_remote and (suspects or unknown_size):
+                with self.metrics.time("reconcile_stage_seconds", stage="verify"):
+                    suspects, unknown_size, confirmed_sizes = self._verify_remote_sizes(
+                        suspects, unknown_size, workers, per_host, summary
+                    )
+            summary['ok'] += len(unknown_size) + len(confirmed_sizes)
+            summary['short'] = len(suspects)
+            requeue.extend(suspects)
+
+            if not dry_run:
+                self.db.set_total_bytes(confirmed_sizes)
+                requeued = self.db.requeue_downloads((row['id'], reason) for row, _, reason in requeue)
+                summary['requeued'] = len(requeued)
+                if len(requeued) < len(requeue):
+                    self._write_log(
+                        log_path, f"⚠ {len(requeue) - len(requeued)} file không đưa lại hàng đợi được, giữ nguyên file"
+                    )
+                for row, size, reason in requeue:
+                    # Chỉ xóa file của row đã thực sự về 'pending': row còn 'ready' phải giữ file
+                    if row['id'] not in requeued:
+                        continue
+                    self._write_log(
+                        log_path, f"↺ ID={row['id']}, {row['username']}: {row['file_path']} - {reason}",
+                        id=row['id'], username=row['username'], status='pending', bytes=size
+                    )
+                    if size is not None:
+                        try:
+                            os.remove(os.path.join(folder, row['file_path']))
+                        except OSError as e:
+                            self._write_log(log_path, f"⚠ ID={row['id']}: Không thể xóa file thiếu ({e})")
+
+            summary['seconds'] = time.monotonic() - started
+            self._write_log(
+                log_path,
+                f"Đối chiếu: {summary['ready']} file ready, {summary['ok']} OK, {summary['missing']} mất, "
+                f"{summary['short']} thiếu dữ liệu, {summary['requeued']} đưa lại hàng đợi"
+                + (f", {summary['verified']} kiểm tra HEAD ({summary['unverified']} không kiểm tra được)"
+                   if verify_remote else "")
+                + (" (dry run)" if dry_run else "")
+                + f" trong {summary['seconds']:.1f}s"
+            )
+        finally:
+            self._end_metrics(folder, log_path)
+            self._write_log(log_path, "="*50)
+            self.log.flush()
+        return summary
+
+    def _verify_remote_sizes(self, suspects, unknown_size, workers, per_host, summary):
+        """
+        Xác nhận kích thước trên server bằng HEAD cho file nghi thiếu và file chưa biết kích thước.
+
+        :return: tuple (suspects còn lại - cần tải lại, unknown_size còn lại, [(id, kích thước đã xác nhận)])
+        """
+        host_limiter = HostConcurrencyLimiter(per_host)
+        checks = [(row, size, reason) for row, size, reason in suspects] + [
+            (row, size, None) for row, size in unknown_size
+        ]
+
+        def check(item):
+            row, _, reason = item
+            # File nghi thiếu: 304 (ETag khớp) xác nhận total_bytes đã lưu vẫn đúng với nội dung trên server;
+            # file chưa biết kích thước: cần Content-Length nên HEAD không điều kiện
+            etag = row['etag'] if reason else None
+            return host_limiter.run(row['url'], self._head_media, row['url'], etag)
+
+        still_suspect, still_unknown, confirmed = [], [], []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for (row, size, reason), (result, remote_size) in zip(checks, executor.map(check, checks)):
+                if result == 'unknown':
+                    summary['unverified'] += 1
+                else:
+                    summary['verified'] += 1
+                if result == 'size' and remote_size == size:
+                    # Kích thước trong DB sai / chưa có: file trên đĩa đúng bằng file trên server
+                    confirmed.append((row['id'], size))
+                elif result == 'size' or reason:
+                    # Server có file lớn hơn, hoặc file đã nghi thiếu (304 = nội dung không đổi)
+                    still_suspect.append((row, size, reason or f"reconcile: file thiếu ({size}/{remote_size} bytes)"))
+                else:
+                    still_unknown.append((row, size))
+        return still_suspect, still_unknown, confirmed
+
+    def _head_media(self, url, etag=None):
+        """
+        HEAD một media URL (kèm If-None-Match nếu có ETag) qua rate limiter.
+
+        :return: tuple (kết quả, kích thước): ('unchanged', None) khi 304, ('size', n) khi server trả
+            Content-Length, ('unknown', None) khi link đã hết hạn / lỗi
+        """
+        expires_at = media_url_expiry(url)
+        if expires_at is not None and expires_at <= time.time():
+            return 'unknown', None
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT COUNT(*) FROM downloads')
-            total = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM downloads WHERE status = 'pending'")
-            pending = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM downloads WHERE status = 'ready'")
-            ready = cursor.fetchone()[0]
-            
-            conn.close()
-            return {'total': total, 'pending': pending, 'ready': ready}
-        except sqlite3.Error as e:
-            print(f"Lỗi query stats: {e}")
-            return {'total': 0, 'pending': 0, 'ready': 0}
+            self.rate_limiter.acquire_request(url)
+            response = self.http.head(url, headers={"If-None-Match": etag} if etag else None, allow_redirects=True)
+        except requests.RequestException:
+            return 'unknown', None
+        self.metrics.inc("http_responses_total", code=response.status_code)
+        if response.status_code == 304:
+            return 'unchanged', None
+        length = response.headers.get("Content-Length")
+        if response.ok and length and length.isdigit() and response.headers.get("Content-Encoding", "identity") in ("", "identity"):
+            return 'size', int(length)
+        return 'unknown', None
+
 
-class TASK2ManualInstaGuiApp:
-    def __init__(self, root: tk.Tk):
+class TASK2ManualInstaGuiApp(InstaDownloaderCore):
+    def __init__(self, root: "tk.Tk"):
+        super().__init__()
         self.root = root
         self.root.title("TASK2 Manual Instagram Downloader")
-        self.root.geometry("700x600")
+        self.root.geometry("700x760")
         self.config_path = os.path.join(os.path.dirname(__file__), "config.json")
-        self.db = None
-        self.db_path = None
 
         # Biến trạng thái
         self.folder_var = tk.StringVar()
         self.status_var = tk.StringVar(value="Chọn folder và nhập usernames.")
+        self.rate_var = tk.StringVar(value="")
+        # Worker chỉ cập nhật tracker; Tk thread đọc lại mỗi PROGRESS_POLL_MS
+        self.progress_tracker = ProgressTracker()
+        self._progress_polling = False
 
         self._build_ui()
         self._load_config()
@@ -249,252 +3535,130 @@ class TASK2ManualInstaGuiApp:
         times_frame = ttk.Frame(self.root, padding=10)
         times_frame.pack(fill="x")
 
-        ttk.Label(times_frame, text="Số lượt scroll (mặc định: 5):").pack(anchor="w")
+        ttk.Label(times_frame, text="Số lượt scroll (mặc định: 5):").grid(row=0, column=0, sticky="w")
 
         self.times_var = tk.StringVar(value="5")
         times_entry = ttk.Entry(times_frame, textvariable=self.times_var, width=10)
-        times_entry.pack(anchor="w", pady=(2, 5))
+        times_entry.grid(row=1, column=0, sticky="w", pady=(2, 5))
 
-        # Thanh tiến trình + trạng thái
-        progress_frame = ttk.Frame(self.root, padding=10)
-        progress_frame.pack(fill="x")
+        ttk.Label(times_frame, text="Số trình duyệt song song (mặc định: 2):").grid(row=0, column=1, sticky="w", padx=(20, 0))
+        self.browsers_var = tk.StringVar(value="2")
+        browsers_entry = ttk.Entry(times_frame, textvariable=self.browsers_var, width=10)
+        browsers_entry.grid(row=1, column=1, sticky="w", padx=(20, 0), pady=(2, 5))
 
-        self.progress = ttk.Progressbar(
-            progress_frame,
-            mode="determinate",
+        self.adaptive_var = tk.BooleanVar(value=True)
+        adaptive_check = ttk.Checkbutton(
+            times_frame,
+            text="Scroll thích ứng (tự dừng khi hết bài mới)",
+            variable=self.adaptive_var,
         )
-        self.progress.pack(fill="x")
-
-        self.status_label = ttk.Label(progress_frame, textvariable=self.status_var)
-        self.status_label.pack(anchor="w", pady=(5, 0))
-
-        # Nút bắt đầu
-        button_frame = ttk.Frame(self.root, padding=10)
-        button_frame.pack(fill="x")
+        adaptive_check.grid(row=2, column=0, sticky="w")
 
-        self.start_button = ttk.Button(
-            button_frame,
-            text="Bắt đầu scrape & insert DB",
-            command=self.on_start,
+        self.incremental_var = tk.BooleanVar(value=False)
+        incremental_check = ttk.Checkbutton(
+            times_frame,
+            text="Chỉ lấy bài mới (incremental)",
+            variable=self.incremental_var,
         )
-        self.start_button.pack(side="right")
+        incremental_check.grid(row=2, column=1, columnspan=2, sticky="w", padx=(20, 0))
 
-        # Nút tải file từ DB (worker)
-        self.worker_button = ttk.Button(
-            button_frame,
-            text="Tải file từ DB",
-            command=self.on_start_worker,
-            state="disabled",
+        self.block_resources_var = tk.BooleanVar(value=True)
+        block_check = ttk.Checkbutton(
+            times_frame,
+            text="Chặn ảnh/video/font/tracker khi scrape (bỏ chọn để debug)",
+            variable=self.block_resources_var,
         )
-        self.worker_button.pack(side="right", padx=(0, 8))
+        block_check.grid(row=3, column=0, columnspan=3, sticky="w")
 
-        # Nút lưu config
-        save_btn = ttk.Button(
-            button_frame,
-            text="Lưu cấu hình",
-            command=self._save_config,
+        self.json_backend_var = tk.BooleanVar(value=False)
+        json_check = ttk.Checkbutton(
+            times_frame,
+            text="Đọc JSON response của trang (fallback HTML nếu không có)",
+            variable=self.json_backend_var,
         )
-        save_btn.pack(side="right", padx=(0, 8))
-
-    def browse_folder(self):
-        folder = filedialog.askdirectory()
-        if folder:
-            self.folder_var.set(folder)
-
-    def _parse_links_from_text(self, text):
-        """
-        Parse tất cả URLs + metadata từ text, chỉ từ bên trong <div class="media-content__info">.
-        Lấy URL và timestamp từ title attribute để tạo tên file.
-
-        :param text: nội dung text từ widget (HTML)
-        :return: list các dict {'url': '...', 'filename': '...'}, xử lý trùng lặp tên file
-        """
-        if not text:
-            return []
-
-        soup = BeautifulSoup(text, 'html.parser')
-        results = []
-
-        # Tìm tất cả div có class "media-content__info"
-        divs = soup.find_all('div', class_='media-content__info')
-
-        for div in divs:
-            # Lấy URL từ div
-            url = self._extract_url_from_content(div)
-            if not url:
-                continue
-
-            # Lấy timestamp từ <p class="media-content__meta-time" title="...">
-            timestamp = self._extract_timestamp_from_content(div)
-            
-            # Chuyển timestamp thành tên file hợp lệ (dùng đuôi từ url nếu có)
-            filename = self._timestamp_to_filename(timestamp, url) 
-
-            results.append({
-                'url': url,
-                'filename': filename,
-                'timestamp': timestamp
-            })
-
-        # Xử lý trùng lặp tên file: đánh số thứ tự ở cuối
-        filename_count = {}
-        for item in results:
-            filename = item['filename']
-            if filename in filename_count:
-                filename_count[filename] += 1
-                base, ext = os.path.splitext(filename)
-                item['filename'] = f"{base}_{filename_count[filename]}{ext}"
-            else:
-                filename_count[filename] = 1
-
-        return results
-
-    def _extract_url_from_content(self, div_element):
-        """Trích xuất URL từ BeautifulSoup div element."""
-        import html as _html
-
-        # Tìm tất cả thẻ a, img, video, source...
-        for tag in div_element.find_all(['a', 'img', 'video', 'source']):
-            url = tag.get('href') or tag.get('src') or tag.get('data-src')
-            if url:
-                url = _html.unescape(str(url)).strip()
-                if url.startswith('//'):
-                    url = 'https:' + url
-                url = url.strip('"\'')
-                url = url.rstrip('.,;:!?)"\'')
-                if url.lower().startswith('http://') or url.lower().startswith('https://'):
-                    return url
-
-        return None
-
-    def _extract_timestamp_from_content(self, div_element):
-        """Trích xuất timestamp từ title attribute của <p class="media-content__meta-time">."""
-        p_tag = div_element.find('p', class_='media-content__meta-time')
-        if p_tag:
-            return p_tag.get('title')
-        return None
-
-    def _timestamp_to_filename(self, timestamp, url=None):
-        """
-        Chuyển timestamp thành tên file hợp lệ.
-        Nếu `url` được cung cấp, sẽ lấy phần đuôi (extension) từ path của URL và gán cho file.
-        Ví dụ: "7/6/2025, 8:46:19 AM" + url ending with .jpg -> "2025-07-06_08-46-19.jpg"
-        """
-        # Helper: lấy extension từ URL nếu có
-        ext = ""
-        try:
-            if url:
-                _, ext = os.path.splitext(url or "")
-                if ext:
-                    ext = ext.lower()
-        except Exception:
-            ext = ""
-
-        if not timestamp:
-            return "file" + (ext if ext else ".bin")
+        json_check.grid(row=4, column=0, columnspan=3, sticky="w")
 
-        try:
-            # Thử parse timestamp (ví dụ: "7/6/2025, 8:46:19 AM")
-            from datetime import datetime
-            # Thử các format khác nhau
-            for fmt in ["%m/%d/%Y, %I:%M:%S %p", "%d/%m/%Y, %H:%M:%S", "%Y-%m-%d, %H:%M:%S"]:
-                try:
-                    dt = datetime.strptime(timestamp.strip(), fmt)
-                    return dt.strftime("%Y-%m-%d_%H-%M-%S") + (ext if ext else ".bin")
-                except ValueError:
-                    continue
-            
-            # Nếu không parse được, dùng timestamp trực tiếp, loại bỏ ký tự không hợp lệ
-            filename = re.sub(r'[<>:"/\\|?*]', '_', timestamp)
-            return filename + (ext if ext else ".bin")
-        except Exception:
-            return "file" + (ext if ext else ".bin")
+        ttk.Label(times_frame, text="Số bài tối đa (0 = tất cả):").grid(row=0, column=2, sticky="w", padx=(20, 0))
+        self.target_count_var = tk.StringVar(value="0")
+        target_entry = ttk.Entry(times_frame, textvariable=self.target_count_var, width=10)
+        target_entry.grid(row=1, column=2, sticky="w", padx=(20, 0), pady=(2, 5))
 
-    def _write_log(self, log_path, message):
-        """
-        Ghi log vào file.
+        # Khung cấu hình tải song song
+        workers_frame = ttk.Frame(self.root, padding=10)
+        workers_frame.pack(fill="x")
 
-        :param log_path: đường dẫn file log
-        :param message: nội dung message cần ghi
-        """
-        try:
-            with open(log_path, "a", encoding="utf-8") as f:
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                f.write(f"[{timestamp}] {message}\n")
-        except Exception as e:
-            print(f"Lỗi ghi log: {e}")
+        ttk.Label(workers_frame, text="Số luồng tải (mặc định: 8):").grid(row=0, column=0, sticky="w")
+        self.workers_var = tk.StringVar(value="8")
+        workers_entry = ttk.Entry(workers_frame, textvariable=self.workers_var, width=10)
+        workers_entry.grid(row=1, column=0, sticky="w", pady=(2, 5))
 
-    def _download_link(self, url, file_path, index=None, progress_callback=None):
-        """
-        Download một link cụ thể và lưu trực tiếp vào `file_path` (absolute path or path relative to process cwd).
+        ttk.Label(workers_frame, text="Kết nối tối đa mỗi host (mặc định: 4):").grid(row=0, column=1, sticky="w", padx=(20, 0))
+        self.per_host_var = tk.StringVar(value="4")
+        per_host_entry = ttk.Entry(workers_frame, textvariable=self.per_host_var, width=10)
+        per_host_entry.grid(row=1, column=1, sticky="w", padx=(20, 0), pady=(2, 5))
 
-        :param url: URL cần download
-        :param file_path: đường dẫn file đầy đủ (absolute) hoặc tương đối để lưu
-        :param index: số thứ tự (dùng khi cần hiển thị progress)
-        :param progress_callback: hàm callback (index, total, url, status_msg)
-        :return: saved absolute file path as string nếu thành công, None nếu thất bại
-        """
-        try:
-            # Headers giả lập browser
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-            }
+        # Thanh tiến trình + trạng thái
+        progress_frame = ttk.Frame(self.root, padding=10)
+        progress_frame.pack(fill="x")
 
-            if progress_callback:
-                progress_callback(index, None, url, f"Đang tải {url}...")
+        self.progress = ttk.Progressbar(
+            progress_frame,
+            mode="determinate",
+        )
+        self.progress.pack(fill="x")
 
-            # Request GET
-            response = requests.get(url, headers=headers, timeout=30, stream=True)
-            response.raise_for_status()
+        self.status_label = ttk.Label(progress_frame, textvariable=self.status_var)
+        self.status_label.pack(anchor="w", pady=(5, 0))
 
-            # Nếu file_path không có extension, thử đoán từ Content-Type
-            base, ext = os.path.splitext(file_path)
-            if not ext or ext == "":
-                content_type = response.headers.get("Content-Type", "")
-                if "image/jpeg" in content_type or "image/jpg" in content_type:
-                    file_path = f"{base}.jpg"
-                elif "image/png" in content_type:
-                    file_path = f"{base}.png"
-                elif "video/mp4" in content_type:
-                    file_path = f"{base}.mp4"
-                elif "image/gif" in content_type:
-                    file_path = f"{base}.gif"
-                else:
-                    # fallback to .bin
-                    file_path = f"{base}.bin"
+        self.rate_label = ttk.Label(progress_frame, textvariable=self.rate_var)
+        self.rate_label.pack(anchor="w")
 
-            # Đảm bảo filename không có ký tự không hợp lệ
-            dir_name = os.path.dirname(file_path)
-            file_name = os.path.basename(file_path)
-            file_name = re.sub(r'[<>:"/\\|?*]', "_", file_name)
-            file_path = os.path.join(dir_name, file_name)
+        # Nút bắt đầu
+        button_frame = ttk.Frame(self.root, padding=10)
+        button_frame.pack(fill="x")
+
+        self.start_button = ttk.Button(
+            button_frame,
+            text="Bắt đầu scrape & insert DB",
+            command=self.on_start,
+        )
+        self.start_button.pack(side="right")
 
-            # Tránh overwrite nếu file đã tồn tại
-            if os.path.exists(file_path):
-                base, ext = os.path.splitext(file_name)
-                counter = 1
-                while os.path.exists(os.path.join(dir_name, f"{base}_{counter}{ext}")):
-                    counter += 1
-                file_path = os.path.join(dir_name, f"{base}_{counter}{ext}")
+        # Nút pipeline: scrape và tải cùng lúc
+        self.pipeline_button = ttk.Button(
+            button_frame,
+            text="Scrape + tải song song",
+            command=self.on_start_pipeline,
+        )
+        self.pipeline_button.pack(side="right", padx=(0, 8))
 
-            # Download và lưu file
-            with open(file_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+        # Nút tải file từ DB (worker)
+        self.worker_button = ttk.Button(
+            button_frame,
+            text="Tải file từ DB",
+            command=self.on_start_worker,
+            state="disabled",
+        )
+        self.worker_button.pack(side="right", padx=(0, 8))
 
-            if progress_callback:
-                progress_callback(index, None, url, f"Đã tải: {os.path.basename(file_path)}")
+        # Nút lưu config
+        save_btn = ttk.Button(
+            button_frame,
+            text="Lưu cấu hình",
+            command=self._save_config,
+        )
+        save_btn.pack(side="right", padx=(0, 8))
 
-            # Trả về đường dẫn file đã lưu (absolute path) để caller có thể cập nhật DB chính xác
-            return os.path.abspath(file_path)
+    def browse_folder(self):
+        folder = filedialog.askdirectory()
+        if folder:
+            self.folder_var.set(folder)
 
-        except Exception as e:  # noqa: BLE001
-            if progress_callback:
-                progress_callback(index, None, url, f"Lỗi: {e}")
-            return None
+    def on_start_pipeline(self):
+        """Scrape và tải file cùng lúc (pipeline)."""
+        self.on_start(pipeline=True)
 
-    def on_start(self):
+    def on_start(self, pipeline=False):
         folder = self.folder_var.get().strip()
         usernames_text = self.username_text.get("1.0", "end")
         times_str = self.times_var.get().strip()
@@ -522,25 +3686,81 @@ class TASK2ManualInstaGuiApp:
             messagebox.showerror("Lỗi", "Số lượt scroll phải là số nguyên dương.")
             return
 
-        # Cài đặt progress bar
+        # Validate số trình duyệt song song
+        try:
+            browsers_str = self.browsers_var.get().strip()
+            browsers = int(browsers_str) if browsers_str else 2
+            if browsers < 1:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Lỗi", "Số trình duyệt song song phải là số nguyên dương.")
+            return
+
+        adaptive = bool(self.adaptive_var.get())
+        incremental = bool(self.incremental_var.get())
+        block_resources = bool(self.block_resources_var.get())
+        json_backend = bool(self.json_backend_var.get())
+        try:
+            target_str = self.target_count_var.get().strip()
+            target_count = int(target_str) if target_str else 0
+            if target_count < 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Lỗi", "Số bài tối đa phải là số nguyên không âm.")
+            return
+
+        download_settings = self._read_download_settings() if pipeline else None
+        if pipeline and download_settings is None:
+            return
+
+        # Cài đặt progress bar: scrape đếm theo username, pipeline đếm theo file đã tải
         self.progress["value"] = 0
         self.progress["maximum"] = len(usernames)
         self.status_var.set(f"Chuẩn bị scrape {len(usernames)} username(s)...")
+        self._start_progress_polling(0 if pipeline else len(usernames), self.status_var.get())
 
         # Disable nút trong khi đang chạy
         self.start_button.config(state="disabled")
+        self.pipeline_button.config(state="disabled")
+        self.worker_button.config(state="disabled")
 
         # Lưu config
         self._save_config()
 
         # Chạy trong thread riêng
-        thread = threading.Thread(
-            target=self._run_scrape_only_multi_thread,
-            args=(folder, usernames, times),
-            daemon=True,
-        )
+        if pipeline:
+            scrape_options = {
+                'times': times, 'browsers': browsers, 'adaptive': adaptive, 'target_count': target_count or None,
+                'incremental': incremental, 'block_resources': block_resources, 'json_backend': json_backend,
+            }
+            thread = threading.Thread(
+                target=self._run_pipeline_thread,
+                args=(folder, usernames, download_settings[0], download_settings[1], scrape_options),
+                daemon=True,
+            )
+        else:
+            thread = threading.Thread(
+                target=self._run_scrape_only_multi_thread,
+                args=(folder, usernames, times, browsers, 20, adaptive, target_count or None, incremental,
+                      block_resources, json_backend),
+                daemon=True,
+            )
         thread.start()
 
+    def _read_download_settings(self):
+        """Đọc và validate số luồng tải / số kết nối mỗi host; None nếu không hợp lệ."""
+        try:
+            workers_str = self.workers_var.get().strip()
+            per_host_str = self.per_host_var.get().strip()
+            max_workers = int(workers_str) if workers_str else 8
+            per_host = int(per_host_str) if per_host_str else 4
+            if max_workers < 1 or per_host < 1:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Lỗi", "Số luồng tải và số kết nối mỗi host phải là số nguyên dương.")
+            return None
+        return max_workers, per_host
+
     def on_start_worker(self):
         """Bắt đầu worker download từ các pending items trong DB."""
         if not self.db_path or not os.path.isfile(self.db_path):
@@ -551,244 +3771,113 @@ class TASK2ManualInstaGuiApp:
         if not folder or not os.path.isdir(folder):
             messagebox.showerror("Lỗi", "Folder lưu không hợp lệ.")
             return
+
+        # Validate số luồng tải
+        download_settings = self._read_download_settings()
+        if download_settings is None:
+            return
+        max_workers, per_host = download_settings
         
         # Cập nhật progress bar
         self.progress["value"] = 0
         self.status_var.set("Chuẩn bị tải file từ database...")
+        self._start_progress_polling(0, self.status_var.get())
         
         # Disable nút trong khi đang chạy
         self.worker_button.config(state="disabled")
         self.start_button.config(state="disabled")
+        self.pipeline_button.config(state="disabled")
         
         # Chạy trong thread riêng
         thread = threading.Thread(
             target=self._run_download_worker_thread,
-            args=(folder,),
+            args=(folder, max_workers, per_host),
             daemon=True,
         )
         thread.start()
 
-    def _run_scrape_only_multi_thread(self, folder, usernames, times=5):
-        """Chỉ scrape và insert vào DB, không download file."""
-        # Khởi tạo database
-        self.db_path = os.path.join(folder, "downloads.db")
-        self.db = DownloadDatabase(self.db_path)
-        
-        def scrape_progress_callback(idx, total, msg):
-            self.root.after(
-                0,
-                self._update_progress_ui,
-                idx,
-                total,
-                "",
-                msg,
-            )
-
-        # Tạo file log
-        log_path = os.path.join(folder, "log.txt")
-        self._write_log(log_path, "="*50)
-        self._write_log(log_path, f"Bắt đầu scrape lúc: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        self._write_log(log_path, "="*50)
-
-        try:
-            total_usernames = len(usernames)
-            for user_idx, username in enumerate(usernames, start=1):
-                try:
-                    # Xác định thư mục lưu cho username này
-                    save_dir = os.path.join(folder, username)
-                    os.makedirs(save_dir, exist_ok=True)
-
-                    # Cập nhật status - scraping
-                    scrape_progress_callback(
-                        user_idx - 1, 
-                        total_usernames, 
-                        f"Scraping {username} ({user_idx}/{total_usernames})..."
-                    )
-
-                    # Scrape HTML từ web
-                    html_content = scrape_html(username, times=times)
-
-                    # Parse links từ HTML
-                    links_data = self._parse_links_from_text(html_content)
-                    if not links_data:
-                        msg = f"⚠ {username}: Không tìm thấy link"
-                        self._write_log(log_path, f"❌ {username}: Không tìm thấy link (0 file)")
-                        scrape_progress_callback(user_idx, total_usernames, msg)
-                        continue
-
-                    # INSERT vào database (sử dụng file_path làm khóa trùng lặp)
-                    insert_count = 0
-                    skip_count = 0
-                    for link_data in links_data:
-                        url = link_data['url']
-                        timestamp = link_data['timestamp']
-                        filename = link_data['filename']
-
-                        # Xác định thư mục relative theo loại file (images/videos) dựa trên ext
-                        base, ext = os.path.splitext(filename)
-                        ext = ext.lower()
-                        image_extensions = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
-                        video_extensions = {".mp4", ".mov", ".avi", ".mkv", ".webm", ".flv"}
-
-                        if ext in image_extensions:
-                            rel_dir = os.path.join(username, "images")
-                        elif ext in video_extensions:
-                            rel_dir = os.path.join(username, "videos")
-                        else:
-                            rel_dir = username
-
-                        file_path = os.path.join(rel_dir, filename)
+    def _gui_progress_callback(self, idx, total, url, msg):
+        """Progress từ worker thread: chỉ cập nhật tracker, UI tự đọc lại theo nhịp `PROGRESS_POLL_MS`."""
+        self.progress_tracker.callback(idx, total, url, msg)
 
-                        if self.db.insert_or_ignore(username, url, timestamp, file_path):
-                            insert_count += 1
-                        else:
-                            skip_count += 1
+    def _start_progress_polling(self, total, message):
+        self.progress_tracker.reset(total, message)
+        if not self._progress_polling:
+            self._progress_polling = True
+            self.root.after(PROGRESS_POLL_MS, self._poll_progress)
 
-                    result_msg = f"✓ {username}: {insert_count} insert, {skip_count} skip (trùng lặp)"
-                    scrape_progress_callback(user_idx, total_usernames, result_msg)
-                    self._write_log(log_path, f"✓ {username}: {insert_count} insert, {skip_count} skip")
+    def _stop_progress_polling(self):
+        """Dừng polling sau khi vẽ trạng thái cuối cùng."""
+        self._progress_polling = False
+        self._update_progress_ui(self.progress_tracker.snapshot())
 
-                except Exception as e:
-                    error_msg = f"✗ {username}: Lỗi - {str(e)[:50]}"
-                    scrape_progress_callback(user_idx, total_usernames, error_msg)
-                    self._write_log(log_path, f"✗ {username}: Lỗi - {str(e)}")
-                    continue
+    def _poll_progress(self):
+        if not self._progress_polling:
+            return
+        self._update_progress_ui(self.progress_tracker.snapshot())
+        self.root.after(PROGRESS_POLL_MS, self._poll_progress)
 
+    def _run_scrape_only_multi_thread(self, folder, usernames, times=5, browsers=2, browser_max_uses=20,
+                                      adaptive=False, target_count=None, incremental=False, block_resources=True,
+                                      json_backend=False):
+        """Thread scrape của GUI: chạy `run_scrape` rồi báo kết quả trên Tk thread."""
+        try:
+            self.run_scrape(
+                folder, usernames, times=times, browsers=browsers, browser_max_uses=browser_max_uses,
+                adaptive=adaptive, target_count=target_count, incremental=incremental,
+                block_resources=block_resources, json_backend=json_backend,
+                progress_callback=self._gui_progress_callback,
+            )
         finally:
-            # Ghi thống kê vào log
-            stats = self.db.get_stats()
-            self._write_log(log_path, f"Thống kê DB: Total={stats['total']}, Pending={stats['pending']}, Ready={stats['ready']}")
-            self._write_log(log_path, "="*50)
-            self._write_log(log_path, f"Kết thúc lúc: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            self._write_log(log_path, "="*50)
             self.root.after(0, self._on_scrape_finished)
 
-    def _run_download_worker_thread(self, folder):
-        """Worker thread để download tất cả pending items từ database."""
-        if not self.db:
-            self.db = DownloadDatabase(self.db_path)
-        
-        log_path = os.path.join(folder, "log.txt")
-        self._write_log(log_path, "="*50)
-        self._write_log(log_path, f"Bắt đầu worker download lúc: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        self._write_log(log_path, "="*50)
-
+    def _run_download_worker_thread(self, folder, max_workers=8, per_host=4):
+        """Worker thread của GUI: chạy `run_download` rồi báo kết quả trên Tk thread."""
         try:
-            pending = self.db.get_pending_downloads()
-            if not pending:
+            summary = self.run_download(
+                folder, max_workers=max_workers, per_host=per_host,
+                progress_callback=self._gui_progress_callback,
+            )
+            if not summary['total']:
                 self.root.after(0, lambda: messagebox.showinfo("Info", "Không có file pending để tải."))
-                return
-            
-            total = len(pending)
-            self.progress["maximum"] = total
-            
-            success_count = 0
-            fail_count = 0
-            
-            for idx, row in enumerate(pending, start=1):
-                try:
-                    # Support sqlite3.Row or tuple
-                    download_id = row['id'] if hasattr(row, 'keys') else row[0]
-                    username = row['username'] if hasattr(row, 'keys') else row[1]
-                    url = row['url'] if hasattr(row, 'keys') else row[2]
-                    timestamp = row['timestamp'] if hasattr(row, 'keys') else row[3]
-                    orig_file_path = row['file_path'] if hasattr(row, 'keys') else (row[4] if len(row) > 4 else None)
-                    
-                    # Tạo thư mục và xác định nơi lưu file dựa trên file_path trong DB (nếu có)
-                    if orig_file_path:
-                        # Nếu DB đã có relative file_path (ví dụ: username/images/file.jpg), ghi trực tiếp vào thư mục đó
-                        rel_dir = os.path.dirname(orig_file_path) or username
-                        save_dir = os.path.join(folder, rel_dir)
-                        filename_base = os.path.basename(orig_file_path)
-                    else:
-                        save_dir = os.path.join(folder, username)
-                        filename_base = self._timestamp_to_filename(timestamp, url)
-
-                    os.makedirs(save_dir, exist_ok=True)
-
-                    # Update progress
-                    self.root.after(
-                        0,
-                        self._update_progress_ui,
-                        idx,
-                        total,
-                        url[:50] + "...",
-                        f"Tải ({idx}/{total}): {username}"
-                    )
+        finally:
+            self.root.after(0, self._on_worker_finished)
 
-                    # Download file (returns absolute saved path or None)
-                    target_path = os.path.join(save_dir, filename_base)
-                    saved_abspath = self._download_link(url, target_path, index=idx)
-                    if saved_abspath:
-                        if orig_file_path:
-                            # File đã được lưu ngay vào vị trí mong muốn; cập nhật DB bằng relative path
-                            rel_path = os.path.relpath(saved_abspath, folder)
-                            self.db.update_download_status(download_id, 'ready', rel_path)
-                            success_count += 1
-                            self._write_log(log_path, f"✓ ID={download_id}, {username}: {rel_path}")
-                        else:
-                            # Xác định thư mục đích theo loại file (images/videos) cho các mục không có file_path trong DB
-                            _, ext = os.path.splitext(saved_abspath)
-                            ext = ext.lower()
-                            image_extensions = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
-                            video_extensions = {".mp4", ".mov", ".avi", ".mkv", ".webm", ".flv"}
-
-                            if ext in image_extensions:
-                                dest_dir = os.path.join(folder, username, "images")
-                            elif ext in video_extensions:
-                                dest_dir = os.path.join(folder, username, "videos")
-                            else:
-                                dest_dir = os.path.join(folder, username)
-
-                            os.makedirs(dest_dir, exist_ok=True)
-                            dest_path = os.path.join(dest_dir, os.path.basename(saved_abspath))
-
-                            # Move file to destination if needed
-                            try:
-                                if os.path.abspath(saved_abspath) != os.path.abspath(dest_path):
-                                    shutil.move(saved_abspath, dest_path)
-                            except Exception as e:
-                                # Nếu không thể move, log và tiếp tục với đường dẫn gốc
-                                self._write_log(log_path, f"⚠ ID={download_id}, {username}: Không thể di chuyển file: {e}")
-                                dest_path = saved_abspath
-
-                            # Lưu relative path so với base folder trong DB
-                            rel_path = os.path.relpath(dest_path, folder)
-                            self.db.update_download_status(download_id, 'ready', rel_path)
-                            success_count += 1
-                            self._write_log(log_path, f"✓ ID={download_id}, {username}: {rel_path}")
-                    else:
-                        fail_count += 1
-                        self._write_log(log_path, f"✗ ID={download_id}, {username}: Lỗi tải")
-                    
-                except Exception as e:
-                    fail_count += 1
-                    self._write_log(log_path, f"✗ Exception: {str(e)}")
-                    continue
-            
-            # Files are already moved into per-user images/videos during download; no extra organization step needed.
-            stats = self.db.get_stats()
-            self._write_log(log_path, f"Kết quả: {success_count} thành công, {fail_count} thất bại")
-            self._write_log(log_path, f"Thống kê DB: Total={stats['total']}, Pending={stats['pending']}, Ready={stats['ready']}")
-            
+    def _run_pipeline_thread(self, folder, usernames, max_workers, per_host, scrape_options):
+        """Thread pipeline của GUI: chạy `run_pipeline` rồi báo kết quả trên Tk thread."""
+        try:
+            self.run_pipeline(
+                folder, usernames, max_workers=max_workers, per_host=per_host,
+                progress_callback=self._gui_progress_callback, **scrape_options
+            )
         finally:
-            self._write_log(log_path, "="*50)
-            self._write_log(log_path, f"Kết thúc lúc: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            self._write_log(log_path, "="*50)
             self.root.after(0, self._on_worker_finished)
 
-    def _update_progress_ui(self, idx, total, url, msg):
-        self.progress["value"] = idx
-        if url:
-            # Hiển thị URL ngắn gọn
-            url_display = url[:50] + "..." if len(url) > 50 else url
-            self.status_var.set(f"{msg} ({idx}/{total}) - {url_display}")
-        else:
-            self.status_var.set(f"{msg} ({idx}/{total})")
+    def _update_progress_ui(self, snapshot):
+        """Vẽ một snapshot của `ProgressTracker` (chỉ gọi trên Tk thread)."""
+        done, total = snapshot['done'], snapshot['total']
+        if total:
+            self.progress["maximum"] = total
+        self.progress["value"] = done
+        self.status_var.set(snapshot['message'])
+
+        parts = [f"{done}/{total}" if total else str(done), f"{snapshot['items_per_second']:.1f} item/s"]
+        if snapshot['bytes']:
+            parts.append(f"{snapshot['mb_per_second']:.1f} MB/s")
+            parts.append(f"{snapshot['bytes'] / 1024 / 1024:.0f} MB")
+        eta = snapshot['eta_seconds']
+        if eta is not None:
+            minutes, seconds = divmod(int(eta), 60)
+            parts.append(f"còn ~{minutes // 60}:{minutes % 60:02d}:{seconds:02d}" if minutes >= 60
+                         else f"còn ~{minutes}:{seconds:02d}")
+        parts.append(f"đã chạy {int(snapshot['elapsed'])}s")
+        self.rate_var.set(" | ".join(parts))
 
     def _on_scrape_finished(self):
         """Callback khi scrape xong."""
+        self._stop_progress_polling()
         self.start_button.config(state="normal")
+        self.pipeline_button.config(state="normal")
         self.worker_button.config(state="normal")
         stats = self.db.get_stats() if self.db else {}
         msg = f"Scrape hoàn thành!\n\nDB Stats:\nTotal: {stats.get('total', 0)}\nPending: {stats.get('pending', 0)}\nReady: {stats.get('ready', 0)}\n\nBấm nút 'Tải file từ DB' để tải file."
@@ -796,14 +3885,20 @@ class TASK2ManualInstaGuiApp:
 
     def _on_worker_finished(self):
         """Callback khi worker download xong."""
+        self._stop_progress_polling()
         self.worker_button.config(state="normal")
         self.start_button.config(state="normal")
+        self.pipeline_button.config(state="normal")
         stats = self.db.get_stats() if self.db else {}
         msg = f"Download hoàn thành!\n\nDB Stats:\nTotal: {stats.get('total', 0)}\nPending: {stats.get('pending', 0)}\nReady: {stats.get('ready', 0)}"
+        expired = stats.get('by_status', {}).get('expired', 0)
+        if expired:
+            msg += f"\nHết hạn (cần scrape lại): {expired}"
+        failed = stats.get('by_status', {}).get('failed', 0)
+        if failed:
+            msg += f"\nLỗi quá {MAX_DOWNLOAD_ATTEMPTS} lần (failed): {failed}"
         messagebox.showinfo("Hoàn thành", msg)
 
-    # -------------------------------------------------
-    # Config helpers
     # -------------------------------------------------
     def _load_config(self):
         if not os.path.isfile(self.config_path):
@@ -814,6 +3909,14 @@ class TASK2ManualInstaGuiApp:
             folder = data.get("folder")
             usernames_text = data.get("usernames", "")
             times = data.get("times", "5")
+            browsers = data.get("browsers", "2")
+            adaptive = data.get("adaptive", True)
+            incremental = data.get("incremental", False)
+            block_resources = data.get("block_resources", True)
+            json_backend = data.get("json_backend", False)
+            target_count = data.get("target_count", "0")
+            workers = data.get("workers", "8")
+            per_host = data.get("per_host", "4")
 
             if folder:
                 self.folder_var.set(folder)
@@ -822,6 +3925,18 @@ class TASK2ManualInstaGuiApp:
                 self.username_text.insert("1.0", usernames_text)
             if times:
                 self.times_var.set(times)
+            if browsers:
+                self.browsers_var.set(browsers)
+            self.adaptive_var.set(bool(adaptive))
+            self.incremental_var.set(bool(incremental))
+            self.block_resources_var.set(bool(block_resources))
+            self.json_backend_var.set(bool(json_backend))
+            if target_count:
+                self.target_count_var.set(target_count)
+            if workers:
+                self.workers_var.set(workers)
+            if per_host:
+                self.per_host_var.set(per_host)
         except Exception as e:  # noqa: BLE001
             messagebox.showwarning(
                 "Cảnh báo",
@@ -835,6 +3950,14 @@ class TASK2ManualInstaGuiApp:
                 "folder": self.folder_var.get().strip(),
                 "usernames": usernames_text,
                 "times": self.times_var.get().strip(),
+                "browsers": self.browsers_var.get().strip(),
+                "adaptive": bool(self.adaptive_var.get()),
+                "incremental": bool(self.incremental_var.get()),
+                "block_resources": bool(self.block_resources_var.get()),
+                "json_backend": bool(self.json_backend_var.get()),
+                "target_count": self.target_count_var.get().strip(),
+                "workers": self.workers_var.get().strip(),
+                "per_host": self.per_host_var.get().strip(),
             }
             with open(self.config_path, "w", encoding="utf-8") as f:
                 json.dump(data, f, ensure_ascii=False, indent=2)
@@ -846,16 +3969,361 @@ class TASK2ManualInstaGuiApp:
 
     def on_close(self):
         self._save_config()
+        self.close()
         self.root.destroy()
 
 
-def main():
+# ==================== CLI ====================
+
+class _JsonLinesEmitter:
+    """Ghi mỗi event thành một dòng JSON ra stdout (an toàn khi gọi từ nhiều thread)."""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        line = json.dumps({"event": event, **fields}, ensure_ascii=False)
+        with self._lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+    def progress_callback(self, idx, total, url, msg):
+        self.emit("progress", idx=idx, total=total, url=url or None, message=msg)
+
+
+def _read_usernames(path):
+    """Đọc usernames (mỗi dòng một username) từ file, hoặc từ stdin nếu path là '-'."""
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    return [u.strip() for u in lines if u.strip()]
+
+
+def _add_scrape_arguments(parser):
+    parser.add_argument("--folder", required=True, help="Folder lưu (chứa downloads.db và thư mục từng user)")
+    parser.add_argument("--usernames-file", default="-", help="File usernames, mỗi dòng một username ('-' = stdin)")
+    parser.add_argument("--times", type=int, default=5, help="Số lượt scroll khi dùng --fixed-scroll")
+    parser.add_argument("--browsers", type=int, default=2, help="Số trình duyệt song song")
+    parser.add_argument("--browser-max-uses", type=int, default=20, help="Khởi động lại browser sau N username")
+    parser.add_argument("--fixed-scroll", action="store_true", help="Scroll cố định --times lượt thay vì thích ứng")
+    parser.add_argument("--target-count", type=int, default=0, help="Số bài tối đa mỗi user (0 = tất cả)")
+    parser.add_argument("--incremental", action="store_true", help="Dừng scroll khi gặp bài đã có trong DB")
+    parser.add_argument("--no-block-resources", action="store_true", help="Không chặn ảnh/video/font (debug)")
+    parser.add_argument("--json-backend", action="store_true", help="Đọc JSON response của trang (fallback HTML)")
+
+
+def _add_download_arguments(parser):
+    parser.add_argument("--workers", type=int, default=8, help="Số luồng tải")
+    parser.add_argument("--per-host", type=int, default=4, help="Số kết nối tối đa mỗi host")
+    parser.add_argument("--dedupe", choices=("hardlink", "off"), default="hardlink",
+                        help="Hardlink file trùng nội dung (SHA-256) với file đã tải để tiết kiệm dung lượng")
+    parser.add_argument("--max-rps", type=float, default=0, help="Số request/giây tối đa (toàn cục, 0 = không giới hạn)")
+    parser.add_argument("--max-mbps", type=float, default=0, help="Băng thông tối đa MB/giây (toàn cục, 0 = không giới hạn)")
+    parser.add_argument("--host-rps", type=float, default=0, help="Số request/giây tối đa mỗi host")
+    parser.add_argument("--host-mbps", type=float, default=0, help="Băng thông tối đa MB/giây mỗi host")
+    parser.add_argument("--max-attempts", type=int, default=MAX_DOWNLOAD_ATTEMPTS,
+                        help="Số lần tải lỗi tối đa trước khi file bị đánh dấu failed")
+    parser.add_argument("--no-wal", action="store_true",
+                        help="Không dùng WAL (bắt buộc khi downloads.db nằm trên ổ mạng dùng chung giữa nhiều máy)")
+
+
+def _add_log_arguments(parser):
+    parser.add_argument("--log-format", choices=LOG_FORMATS, default="text",
+                        help="Định dạng log.txt: text hoặc jsonl (mỗi dòng một JSON kèm id/username/bytes/duration)")
+    parser.add_argument("--log-max-mb", type=float, default=LOG_MAX_BYTES / 1024 / 1024,
+                        help="Xoay vòng log.txt khi vượt quá N MB (0 = không xoay vòng)")
+    parser.add_argument("--log-backups", type=int, default=LOG_BACKUP_COUNT, help="Số file log cũ giữ lại khi xoay vòng")
+
+
+def _log_options_from_args(args):
+    """Chuyển tham số CLI thành kwargs cho `LogWriter`."""
+    return {
+        'max_bytes': int(max(0.0, args.log_max_mb) * 1024 * 1024),
+        'backup_count': max(0, args.log_backups),
+        'fmt': args.log_format,
+    }
+
+
+def _rate_limits_from_args(args):
+    """Chuyển tham số CLI thành kwargs cho `RateLimiter`."""
+    return {
+        'requests_per_second': max(0.0, args.max_rps),
+        'bytes_per_second': max(0.0, args.max_mbps) * 1024 * 1024,
+        'host_requests_per_second': max(0.0, args.host_rps),
+        'host_bytes_per_second': max(0.0, args.host_mbps) * 1024 * 1024,
+    }
+
+
+def _scrape_options_from_args(args):
+    """Chuyển tham số CLI thành kwargs cho `run_scrape`."""
+    return {
+        'times': max(1, args.times),
+        'browsers': max(1, args.browsers),
+        'browser_max_uses': max(1, args.browser_max_uses),
+        'adaptive': not args.fixed_scroll,
+        'target_count': args.target_count or None,
+        'incremental': args.incremental,
+        'block_resources': not args.no_block_resources,
+        'json_backend': args.json_backend,
+    }
+
+
+def _build_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog="Auto_Insta_Downloader.py",
+        description="Chạy không cần GUI: scrape usernames vào DB, tải file pending, xem thống kê. "
+                    "Tiến trình được in ra stdout dạng JSON lines.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scrape = subparsers.add_parser("scrape", help="Scrape usernames và insert vào downloads.db")
+    _add_scrape_arguments(scrape)
+    _add_log_arguments(scrape)
+
+    sync = subparsers.add_parser("sync", help="Scrape và tải cùng lúc (pipeline với hàng đợi giới hạn)")
+    _add_scrape_arguments(sync)
+    _add_download_arguments(sync)
+    _add_log_arguments(sync)
+    sync.add_argument("--queue-size", type=int, default=0, help="Số link tối đa chờ tải (0 = workers x 4)")
+
+    download = subparsers.add_parser("download", help="Tải tất cả file pending trong downloads.db")
+    download.add_argument("--folder", required=True, help="Folder lưu (chứa downloads.db)")
+    _add_download_arguments(download)
+    _add_log_arguments(download)
+    download.add_argument("--retry-failed", action="store_true",
+                          help="Đưa các file failed (lỗi quá số lần cho phép) về hàng đợi trước khi tải")
+    download.add_argument("--processes", type=int, default=1,
+                          help="Số process worker chạy song song trên cùng downloads.db")
+
+    reconcile = subparsers.add_parser(
+        "reconcile", help="Đối chiếu file 'ready' trong DB với ổ đĩa, đưa file mất / thiếu lại hàng đợi"
+    )
+    reconcile.add_argument("--folder", required=True, help="Folder lưu (chứa downloads.db)")
+    reconcile.add_argument("--workers", type=int, default=8, help="Số luồng quét thư mục / gửi HEAD")
+    reconcile.add_argument("--verify-remote", action="store_true",
+                           help="Gửi HEAD (If-None-Match) để xác nhận kích thước file nghi thiếu / chưa rõ kích thước")
+    reconcile.add_argument("--per-host", type=int, default=4, help="Số HEAD đồng thời tối đa mỗi host")
+    reconcile.add_argument("--dry-run", action="store_true", help="Chỉ báo cáo, không sửa DB / xóa file")
+    _add_log_arguments(reconcile)
+
+    stats = subparsers.add_parser("stats", help="In thống kê downloads.db dạng JSON")
+    stats.add_argument("--folder", required=True, help="Folder lưu (chứa downloads.db)")
+    stats.add_argument("--by-username", action="store_true", help="Thêm thống kê theo từng username")
+
+    return parser
+
+
+def _download_worker_process(index, folder, download_options, wal=True, log_options=None, results=None):
+    """
+    Chạy `run_download` trong một process worker riêng (mỗi process một worker_id / lease);
+    gửi (index, summary, lỗi) về process cha qua hàng đợi `results`.
+    """
+    core = InstaDownloaderCore()
+    core.wal = wal
+    if log_options:
+        core.log = LogWriter(**log_options)
+    try:
+        results.put((index, core.run_download(folder, **download_options), None))
+    except Exception as e:  # noqa: BLE001
+        results.put((index, None, str(e)))
+        sys.exit(1)
+    finally:
+        core.close()
+
+
+def _run_download_processes(folder, processes, download_options, wal=True, log_options=None,
+                            progress_callback=None, poll_interval=2.0):
+    """
+    Chạy `processes` worker process cùng lúc trên một downloads.db (row được chia qua claim + lease)
+    và gộp kết quả.
+
+    Trong lúc chờ, process cha đọc `get_stats()` mỗi `poll_interval` giây và báo tiến độ qua
+    `progress_callback(done, total, url, msg)` (done = số row đã sang ready / failed từ lúc bắt đầu).
+
+    :return: dict như `run_download` cộng 'processes' và 'process_errors': list
+        {'process', 'exitcode', 'error'} của các process lỗi / bị kill
+    """
+    context = multiprocessing.get_context()
+    results = context.Queue()
+    workers = [
+        context.Process(
+            target=_download_worker_process, args=(index, folder, download_options, wal, log_options, results),
+            name=f"download-worker-{index}",
+        )
+        for index in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    db = DownloadDatabase(os.path.join(folder, "downloads.db"), wal=wal)
+    start_stats = db.get_stats()['by_status']
+    summaries = []
+    errors = {}
+    waiting = set(range(processes))
+    try:
+        while waiting:
+            # Process đã thoát trước lần get này thì kết quả (nếu có) đã nằm sẵn trong hàng đợi
+            exited = [index for index in waiting if not workers[index].is_alive()]
+            try:
+                index, summary, error = results.get(timeout=poll_interval)
+            except queue.Empty:
+                for index in exited:
+                    waiting.discard(index)
+                    errors[index] = "Process thoát mà không trả về kết quả"
+            else:
+                waiting.discard(index)
+                if summary is not None:
+                    summaries.append(summary)
+                else:
+                    errors[index] = error
+            if progress_callback:
+                by_status = db.get_stats()['by_status']
+                done = sum(
+                    by_status.get(status, 0) - start_stats.get(status, 0) for status in ('ready', 'failed')
+                )
+                left = by_status.get('pending', 0) + by_status.get('downloading', 0)
+                progress_callback(
+                    done, done + left, "",
+                    f"Tải ({done}/{done + left}): {len(waiting)}/{processes} process đang chạy"
+                )
+    finally:
+        db.close()
+        for worker in workers:
+            worker.join()
+
+    process_errors = []
+    for index, worker in enumerate(workers):
+        if index in errors or worker.exitcode:
+            process_errors.append({
+                'process': index, 'exitcode': worker.exitcode, 'error': errors.get(index),
+            })
+            print(
+                f"Lỗi process tải #{index} (exit code {worker.exitcode}): {errors.get(index) or 'không rõ'}",
+                file=sys.stderr
+            )
+    return {
+        'total': max((summary['total'] for summary in summaries), default=0),
+        'success': sum(summary['success'] for summary in summaries),
+        'failed': sum(summary['failed'] for summary in summaries),
+        'expired': sum(summary['expired'] for summary in summaries),
+        'skipped': sum(summary['skipped'] for summary in summaries),
+        'rescrape': sorted({username for summary in summaries for username in summary['rescrape']}),
+        'waiting': max((summary['waiting'] for summary in summaries), default=0),
+        'processes': processes,
+        'process_errors': process_errors,
+    }
+
+
+def run_cli(argv):
+    """
+    Entry point dòng lệnh.
+
+    :return: exit code (0 = thành công, 1 = có lỗi/thất bại, 2 = tham số sai)
+    """
+    args = _build_arg_parser().parse_args(argv)
+    out = _JsonLinesEmitter()
+    core = InstaDownloaderCore()
+    core.wal = not getattr(args, "no_wal", False)
+    log_options = _log_options_from_args(args) if hasattr(args, "log_format") else None
+    if log_options:
+        core.log = LogWriter(**log_options)
+    folder = os.path.abspath(args.folder)
+
+    try:
+        if args.command in ("scrape", "sync"):
+            try:
+                usernames = _read_usernames(args.usernames_file)
+            except OSError as e:
+                out.emit("error", message=f"Không đọc được usernames: {e}")
+                return 1
+            if not usernames:
+                out.emit("error", message="Không có username nào.")
+                return 2
+            os.makedirs(folder, exist_ok=True)
+
+            if args.command == "sync":
+                result = core.run_pipeline(
+                    folder, usernames, max_workers=max(1, args.workers), per_host=max(1, args.per_host),
+                    queue_size=args.queue_size or None, progress_callback=out.progress_callback, dedupe=args.dedupe,
+                    rate_limits=_rate_limits_from_args(args), max_attempts=max(1, args.max_attempts),
+                    **_scrape_options_from_args(args)
+                )
+                out.emit("done", command="sync", **result)
+                if result['scrape'] is None:
+                    return 1
+                return 1 if result['scrape']['failed'] or result['download']['failed'] else 0
+
+            summary = core.run_scrape(
+                folder, usernames, progress_callback=out.progress_callback, **_scrape_options_from_args(args)
+            )
+            out.emit("done", command="scrape", **summary)
+            return 1 if summary['failed'] else 0
+
+        if not os.path.isfile(os.path.join(folder, "downloads.db")):
+            out.emit("error", message=f"Không tìm thấy database trong {folder}. Vui lòng scrape trước.")
+            return 1
+
+        if args.command == "download":
+            download_options = {
+                'max_workers': max(1, args.workers),
+                'per_host': max(1, args.per_host),
+                'dedupe': args.dedupe,
+                'rate_limits': _rate_limits_from_args(args),
+                'max_attempts': max(1, args.max_attempts),
+                'retry_failed': args.retry_failed,
+            }
+            if args.processes > 1:
+                summary = _run_download_processes(
+                    folder, args.processes, download_options, wal=core.wal, log_options=log_options,
+                    progress_callback=out.progress_callback
+                )
+            else:
+                summary = core.run_download(folder, progress_callback=out.progress_callback, **download_options)
+            out.emit("done", command="download", **summary)
+            return 1 if summary['failed'] or summary.get('process_errors') else 0
+
+        if args.command == "reconcile":
+            summary = core.run_reconcile(
+                folder, workers=max(1, args.workers), verify_remote=args.verify_remote,
+                per_host=max(1, args.per_host), dry_run=args.dry_run, progress_callback=out.progress_callback,
+            )
+            out.emit("done", command="reconcile", **summary)
+            return 0
+
+        if args.command == "stats":
+            db = core._open_database(folder)
+            fields = db.get_stats()
+            if args.by_username:
+                fields['by_username'] = db.get_stats_by_username()
+            out.emit("stats", **fields)
+            return 0
+    except Exception as e:  # noqa: BLE001
+        out.emit("error", message=str(e))
+        return 1
+    finally:
+        core.close()
+
+    return 2
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return run_cli(argv)
+
+    if tk is None:
+        print("Không có Tkinter: dùng CLI, ví dụ: python Auto_Insta_Downloader.py --help", file=sys.stderr)
+        return 2
     root = tk.Tk()
     app = TASK2ManualInstaGuiApp(root)
     root.mainloop()
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
 
 
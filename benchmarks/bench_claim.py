@@ -0,0 +1,130 @@
+"""
+Benchmark hồi quy cho hàng đợi download: `claim_batch` với kích thước claim thật của worker
+(max_workers * 2 = 16 row với 8 luồng mặc định) trên hàng đợi 100k+ row pending.
+
+Đo claims/s và p50/p99 mỗi claim theo độ dài hàng đợi, đồng thời kiểm tra query plan của mọi câu
+lệnh trong claim: không được có "USE TEMP B-TREE" (sort cả hàng đợi ở mỗi lần claim).
+
+Chạy: python benchmarks/bench_claim.py [--queue 100000 300000] [--claim 16] [--claims 300] [--json kết_quả.json]
+Exit code 1 nếu query plan có sort tạm.
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+
+from common import latency_summary, print_table, write_json
+
+from Auto_Insta_Downloader import DownloadDatabase  # noqa: E402
+
+# run_download claim max_workers * 2 row mỗi lần; CLI mặc định 8 luồng
+CLAIM_SIZE = 16
+ROWS_PER_USER = 5000
+_LITERAL = re.compile(r"'[^']*'|\b\d+(?:\.\d+)?\b")
+
+
+def _fill_queue(db, size):
+    """Thêm `size` row pending: 2/3 link đã ký (có oe=, hạn ngẫu nhiên), 1/3 link không có hạn."""
+    oe_base = int(time.time()) + 86400
+    for start in range(0, size, ROWS_PER_USER):
+        username = f"user{start // ROWS_PER_USER}"
+        rows = []
+        for n in range(start, min(size, start + ROWS_PER_USER)):
+            if n % 3:
+                url = (f"https://scontent.cdninstagram.com/v/t51/{n}_n.jpg"
+                       f"?oh=00_{n}&oe={format(oe_base + n * 7919 % size, 'X')}")
+            else:
+                url = f"https://cdn.example.com/media/{n}.jpg"
+            rows.append((url, None, os.path.join(username, "images", f"{n}.jpg")))
+        db.insert_many(username, rows)
+
+
+def _plan_problems(db, statements):
+    """EXPLAIN QUERY PLAN từng câu lệnh đã chạy (mỗi dạng câu lệnh một lần); trả về list (sql, dòng plan) có sort tạm."""
+    # Cùng câu lệnh, khác tham số (id, thời gian, owner) => cùng một dạng
+    shapes = {_LITERAL.sub("?", sql): sql for sql in statements}
+    problems = []
+    for sql in shapes.values():
+        head = sql.lstrip().split(None, 1)[0].upper()
+        if head not in ("SELECT", "UPDATE"):
+            continue
+        for row in db.conn.execute("EXPLAIN QUERY PLAN " + sql):
+            if "TEMP B-TREE" in row[-1]:
+                problems.append((" ".join(sql.split())[:120], row[-1]))
+    return problems
+
+
+def _tail_claim(db, claim):
+    """
+    Một claim chạy đủ cả ba bước (lease hết hạn, link có hạn, link không có hạn): vài row có lease
+    đã hết hạn, các link có hạn đang chờ retry, phần còn lại là link không có hạn.
+    """
+    with db.conn:
+        db.conn.execute('''
+            UPDATE downloads SET lease_expires_at = 0
+            WHERE id IN (SELECT id FROM downloads WHERE status = 'downloading' LIMIT ?)
+        ''', (max(1, claim // 4),))
+        db.conn.execute('''
+            UPDATE downloads SET next_retry_at = ? WHERE status = 'pending' AND expires_at IS NOT NULL
+        ''', (int(time.time()) + 3600,))
+    return db.claim_batch("bench-tail", claim)
+
+
+def run_once(queue_size, claim=CLAIM_SIZE, claims=300):
+    with tempfile.TemporaryDirectory() as folder:
+        db = DownloadDatabase(os.path.join(folder, "downloads.db"))
+        _fill_queue(db, queue_size)
+        statements = []
+        db.conn.set_trace_callback(statements.append)
+        timings = []
+        for _ in range(claims):
+            started = time.perf_counter()
+            rows = db.claim_batch("bench", claim)
+            timings.append(time.perf_counter() - started)
+            if not rows:
+                break
+        tail = _tail_claim(db, claim)
+        db.conn.set_trace_callback(None)
+        problems = _plan_problems(db, statements)
+        db.close()
+    latency_ms = {key: value * 1000 for key, value in latency_summary(timings).items()}
+    return dict({
+        'queue': queue_size,
+        'claim': claim,
+        'claims': len(timings),
+        'claims_per_second': len(timings) / sum(timings) if timings else None,
+        'tail_claimed': len(tail),
+        'temp_btree': len(problems),
+        'problems': problems,
+    }, **latency_ms)
+
+
+def run(queue_sizes=(100000, 300000), claim=CLAIM_SIZE, claims=300):
+    return [run_once(size, claim, claims) for size in queue_sizes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--queue", type=int, nargs="+", default=[100000, 300000], help="Số row pending")
+    parser.add_argument("--claim", type=int, default=CLAIM_SIZE, help="Số row mỗi lần claim")
+    parser.add_argument("--claims", type=int, default=300, help="Số lần claim được đo")
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    results = run(args.queue, args.claim, args.claims)
+    print_table(results, [
+        ('queue', 'queue', 'd'), ('claim', 'claim', 'd'), ('claims_per_second', 'claims/s', ',.0f'),
+        ('p50', 'p50 (ms)', '.3f'), ('p99', 'p99 (ms)', '.3f'), ('temp_btree', 'temp b-tree', 'd'),
+    ])
+    if args.json:
+        write_json(args.json, {'claim': results})
+    problems = [problem for row in results for problem in row['problems']]
+    for sql, detail in problems:
+        print(f"Sort tạm trong claim: {detail}\n  {sql}", file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""
+Benchmark các thao tác hàng loạt của `DownloadDatabase` trên DB tạm: insert_many, refresh link đã ký,
+claim_batch (hàng đợi worker, cùng kích thước claim với run_download; claims/s và p50/p99 theo độ dài
+hàng đợi lúc claim), cập nhật trạng thái và get_stats.
+
+Chạy: python benchmarks/bench_db.py [--rows 20000] [--users 20] [--claim 16] [--json kết_quả.json]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from bench_claim import CLAIM_SIZE
+from common import latency_summary, print_table, write_json
+
+from Auto_Insta_Downloader import DownloadDatabase  # noqa: E402
+
+
+def _media_rows(username, count, oe_base):
+    return [
+        (
+            f"https://scontent-hkg4-1.cdninstagram.com/v/t51/{username}_{n}_n.jpg"
+            f"?_nc_ht=scontent&oh=00_{n}&oe={format(oe_base + n, 'X')}",
+            f"7/6/2025, 8:{n // 60 % 60:02d}:{n % 60:02d} AM",
+            os.path.join(username, "images", f"{n}.jpg"),
+        )
+        for n in range(count)
+    ]
+
+
+def _timed_batches(func, batches):
+    """Chạy func(batch) cho từng batch; trả về (tổng giây, list giây mỗi batch)."""
+    timings = []
+    for batch in batches:
+        started = time.perf_counter()
+        func(batch)
+        timings.append(time.perf_counter() - started)
+    return sum(timings), timings
+
+
+def _result(op, items, total_seconds, timings):
+    latency_ms = {key: value * 1000 for key, value in latency_summary(timings).items()}
+    return dict({'op': op, 'items': items, 'seconds': total_seconds,
+                 'items_per_second': items / total_seconds if total_seconds else None},
+                **latency_ms)
+
+
+def _claim_results(claim, timings, depths, sizes, buckets=4):
+    """Chia các lần claim theo độ dài hàng đợi lúc claim (`buckets` khoảng bằng nhau, hàng đợi dài trước)."""
+    total = max(depths) if depths else 0
+    step = max(1, -(-total // buckets))
+    results = []
+    for high in range(total, 0, -step):
+        low = max(0, high - step)
+        picked = [(t, size) for t, depth, size in zip(timings, depths, sizes) if low < depth <= high]
+        if not picked:
+            continue
+        selected = [t for t, _ in picked]
+        result = _result(f"claim_batch({claim})", sum(size for _, size in picked), sum(selected), selected)
+        result.update({'queue': f"{low + 1}-{high}", 'claims': len(selected),
+                       'claims_per_second': len(selected) / sum(selected)})
+        results.append(result)
+    return results
+
+
+def run(rows=20000, users=20, claim=CLAIM_SIZE):
+    per_user = max(1, rows // users)
+    oe_base = int(time.time()) + 86400
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        db = DownloadDatabase(os.path.join(folder, "downloads.db"))
+        user_rows = {f"user{u}": _media_rows(f"user{u}", per_user, oe_base) for u in range(users)}
+        total = per_user * users
+
+        seconds, timings = _timed_batches(lambda item: db.insert_many(*item), user_rows.items())
+        results.append(_result("insert_many", total, seconds, timings))
+
+        # Lần scrape sau: cùng media, chữ ký mới => refresh thay vì insert trùng
+        refreshed = {
+            username: [(url.replace("oh=00_", "oh=01_"), ts, path) for url, ts, path in batch_rows]
+            for username, batch_rows in user_rows.items()
+        }
+        seconds, timings = _timed_batches(
+            lambda item: (db.refresh_signed_urls(r[0] for r in item[1]), db.insert_many(*item)), refreshed.items()
+        )
+        results.append(_result("rescrape (refresh + insert)", total, seconds, timings))
+
+        # Claim cho đến khi hết hàng đợi, ghi lại số row pending lúc mỗi lần claim
+        timings = []
+        depths = []
+        claimed = []
+        batches = []
+        while True:
+            started = time.perf_counter()
+            rows_batch = db.claim_batch("bench", claim)
+            elapsed = time.perf_counter() - started
+            if not rows_batch:
+                break
+            timings.append(elapsed)
+            depths.append(total - len(claimed))
+            batches.append(rows_batch)
+            claimed.extend(row['id'] for row in rows_batch)
+        results.extend(_claim_results(claim, timings, depths, [len(b) for b in batches]))
+
+        seconds, timings = _timed_batches(
+            lambda download_id: db.update_download_status(download_id, 'ready'), claimed
+        )
+        results.append(_result("update_download_status", len(claimed), seconds, timings))
+
+        seconds, timings = _timed_batches(lambda _: db.get_stats(), range(50))
+        results.append(_result("get_stats", 50, seconds, timings))
+        db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--claim", type=int, default=CLAIM_SIZE,
+                        help="Số row mỗi lần claim (run_download: số luồng * 2)")
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    results = run(args.rows, args.users, args.claim)
+    print_table(results, [
+        ('op', 'op', 's'), ('queue', 'queue', 's'), ('items', 'items', 'd'), ('seconds', 'total (s)', '.3f'),
+        ('items_per_second', 'items/s', ',.0f'), ('claims_per_second', 'claims/s', ',.0f'),
+        ('p50', 'p50 (ms)', '.3f'), ('p99', 'p99 (ms)', '.3f'),
+    ])
+    if args.json:
+        write_json(args.json, {'db': results})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Benchmark end-to-end worker download (`run_download`) với CDN giả lập chạy cục bộ: đo files/s, MB/s,
+time-to-first-byte và thời gian nhận body mỗi file (p50/p99), đọc từ metric của lượt chạy.
+
+Chạy: python benchmarks/bench_download.py [--files 200] [--size 250000] [--video-ratio 0.2]
+      [--latency 0.02] [--error-rate 0] [--workers 8 16] [--json kết_quả.json]
+"""
+import argparse
+import os
+import tempfile
+
+from cdn_server import LocalCdnServer
+from common import print_table, write_json
+
+from Auto_Insta_Downloader import InstaDownloaderCore  # noqa: E402
+
+USERNAME = "benchuser"
+
+
+def _histogram(metrics, name):
+    """Gộp p50/p99 của histogram `name` (lấy series có count lớn nhất nếu có nhiều label)."""
+    series = [h for h in metrics['histograms'] if h['name'] == name]
+    if not series:
+        return {}
+    return max(series, key=lambda h: h['count'])
+
+
+def _queue_media(core, folder, server, files, size, video_ratio):
+    videos = int(files * video_ratio)
+    rows = []
+    for n in range(files):
+        is_video = n < videos
+        media_size = size * 8 if is_video else size
+        ext = ".mp4" if is_video else ".jpg"
+        kind = "videos" if is_video else "images"
+        rows.append((server.url(f"{USERNAME}{n}", media_size, ext), None,
+                     os.path.join(USERNAME, kind, f"{n}{ext}")))
+    core._open_database(folder).insert_many(USERNAME, rows)
+    return sum(size * 8 if n < videos else size for n in range(files))
+
+
+def run_once(files, size, video_ratio, workers, per_host, latency, error_rate, error_status,
+             range_support, backoff_base):
+    """Một lượt tải trên DB/thư mục tạm mới; trả về dict kết quả."""
+    with LocalCdnServer(latency=latency, error_rate=error_rate, error_status=error_status,
+                        range_support=range_support) as server, tempfile.TemporaryDirectory() as folder:
+        core = InstaDownloaderCore()
+        try:
+            total_bytes = _queue_media(core, folder, server, files, size, video_ratio)
+            summary = core.run_download(
+                folder, max_workers=workers, per_host=per_host, dedupe="off",
+                rate_limits={'backoff_base': backoff_base},
+            )
+            metrics = core.metrics.to_dict()
+        finally:
+            core.close()
+        ttfb = _histogram(metrics, "http_ttfb_seconds")
+        body = _histogram(metrics, "download_body_seconds")
+        return {
+            'workers': workers,
+            'files': files,
+            'success': summary['success'],
+            'failed': summary['failed'],
+            'seconds': metrics['seconds'],
+            'files_per_second': metrics['throughput']['files_per_second'],
+            'mb_per_second': metrics['throughput']['mb_per_second'],
+            'mb_total': total_bytes / 1024 / 1024,
+            'ttfb_p50_ms': ttfb['p50'] * 1000 if ttfb else None,
+            'ttfb_p99_ms': ttfb['p99'] * 1000 if ttfb else None,
+            'body_p50_ms': body['p50'] * 1000 if body else None,
+            'body_p99_ms': body['p99'] * 1000 if body else None,
+            'server_requests': server.stats['requests'],
+            'server_errors': server.stats['errors'],
+        }
+
+
+def run(files=200, size=250000, video_ratio=0.2, workers=(8,), per_host=None, latency=0.02, error_rate=0.0,
+        error_status=503, range_support=True, backoff_base=0.05):
+    return [
+        run_once(files, size, video_ratio, count, per_host or count, latency, error_rate, error_status,
+                 range_support, backoff_base)
+        for count in workers
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=200, help="Số file cần tải")
+    parser.add_argument("--size", type=int, default=250000, help="Kích thước ảnh (bytes); video gấp 8 lần")
+    parser.add_argument("--video-ratio", type=float, default=0.2, help="Tỉ lệ video (0..1)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[8], help="Một hoặc nhiều số luồng để so sánh")
+    parser.add_argument("--per-host", type=int, default=0, help="Kết nối tối đa mỗi host (0 = bằng số luồng)")
+    parser.add_argument("--latency", type=float, default=0.02, help="Giây chờ trước khi server trả header")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Tỉ lệ request lỗi (0..1)")
+    parser.add_argument("--error-status", type=int, default=503, choices=(429, 503))
+    parser.add_argument("--no-range", action="store_true", help="Server không hỗ trợ Range")
+    parser.add_argument("--backoff-base", type=float, default=0.05,
+                        help="Giây backoff cơ sở khi gặp 429/5xx (nhỏ để benchmark không bị chậm giả tạo)")
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    results = run(
+        files=args.files, size=args.size, video_ratio=args.video_ratio, workers=args.workers,
+        per_host=args.per_host or None, latency=args.latency, error_rate=args.error_rate,
+        error_status=args.error_status, range_support=not args.no_range, backoff_base=args.backoff_base,
+    )
+    print_table(results, [
+        ('workers', 'workers', 'd'), ('success', 'success', 'd'), ('failed', 'failed', 'd'),
+        ('seconds', 'total (s)', '.2f'), ('files_per_second', 'files/s', '.1f'), ('mb_per_second', 'MB/s', '.1f'),
+        ('ttfb_p50_ms', 'ttfb p50', '.1f'), ('ttfb_p99_ms', 'ttfb p99', '.1f'),
+        ('body_p50_ms', 'body p50', '.1f'), ('body_p99_ms', 'body p99', '.1f'),
+    ])
+    if args.json:
+        write_json(args.json, {'download': results})
+
+
+if __name__ == "__main__":
+    main()
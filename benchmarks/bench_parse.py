@@ -0,0 +1,52 @@
+"""
+Benchmark `_parse_links_from_text`: engine "lxml" so với "bs4" (html.parser) trên các HTML fixture.
+
+Chạy: python benchmarks/bench_parse.py [số item ...] [--json kết_quả.json]
+"""
+import argparse
+
+from common import latency_summary, print_table, write_json, best_of
+
+from Auto_Insta_Downloader import InstaDownloaderCore  # noqa: E402
+from fixtures import load_fixture  # noqa: E402
+
+
+def run(sizes, repeat=None):
+    """Đo parse cho từng kích thước; trả về list dict kết quả (mỗi engine một dòng)."""
+    # Chỉ dùng các hàm parse, không cần cửa sổ Tk
+    core = InstaDownloaderCore()
+    results = []
+    for size in sizes:
+        text = load_fixture(size)
+        expected = core._parse_links_from_text(text, engine="bs4")
+        rounds = repeat or (5 if size <= 1000 else 2)
+        for engine in ("bs4", "lxml"):
+            actual = core._parse_links_from_text(text, engine=engine)
+            best, timings = best_of(lambda: core._parse_links_from_text(text, engine=engine), rounds)
+            results.append(dict(
+                {'items': size, 'engine': engine, 'seconds': best, 'items_per_second': len(actual) / best,
+                 'identical': actual == expected},
+                **latency_summary(timings),
+            ))
+    core.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("sizes", nargs="*", type=int, default=[100, 1000, 5000])
+    parser.add_argument("--json", help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    results = run(args.sizes)
+    print_table(results, [
+        ('items', 'items', 'd'), ('engine', 'engine', 's'), ('seconds', 'best (s)', '.4f'),
+        ('items_per_second', 'items/s', ',.0f'), ('p50', 'p50 (s)', '.4f'), ('p99', 'p99 (s)', '.4f'),
+        ('identical', 'identical', ''),
+    ])
+    if args.json:
+        write_json(args.json, {'parse': results})
+
+
+if __name__ == "__main__":
+    main()
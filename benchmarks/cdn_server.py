@@ -0,0 +1,209 @@
+"""
+HTTP server cục bộ đóng vai CDN để benchmark việc tải file mà không cần mạng.
+
+URL dạng `/media/<tên>-<kích thước bytes>.<ext>`, ví dụ `/media/p12-250000.jpg`. Nội dung file
+được sinh từ tên nên cố định giữa các lần chạy. Có thể cấu hình độ trễ trước khi trả header,
+hỗ trợ Range và If-None-Match (304), tỉ lệ lỗi (503/429) và băng thông tối đa mỗi kết nối.
+
+Chạy riêng: python benchmarks/cdn_server.py --port 8765 --latency 0.05 --error-rate 0.02
+"""
+import argparse
+import hashlib
+import http.server
+import random
+import re
+import threading
+import time
+
+CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".mp4": "video/mp4",
+}
+_MEDIA_PATH = re.compile(r"^/media/(?P<name>[\w.-]+?)-(?P<size>\d+)(?P<ext>\.\w+)$")
+_RANGE_HEADER = re.compile(r"bytes=(\d+)-(\d*)$")
+_WRITE_CHUNK = 64 * 1024
+
+
+def media_bytes(name, size):
+    """Nội dung giả lập (cố định theo `name`) dài `size` bytes."""
+    block = hashlib.sha256(name.encode("utf-8")).digest() * 2048
+    repeat = size // len(block) + 1
+    return (block * repeat)[:size]
+
+
+class _MediaHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def _serve(self, send_body):
+        config = self.server.config
+        match = _MEDIA_PATH.match(self.path.split("?", 1)[0])
+        if not match:
+            self._send_empty(404)
+            return
+        if config["latency"]:
+            time.sleep(config["latency"])
+        if config["error_rate"] and config["rng"].random() < config["error_rate"]:
+            self.server.count("errors")
+            self._send_empty(config["error_status"], {"Retry-After": "1"} if config["error_status"] == 429 else None)
+            return
+
+        name = match.group("name")
+        size = int(match.group("size"))
+        body = self.server.get_body(name, size)
+        status = 200
+        headers = {
+            "Content-Type": CONTENT_TYPES.get(match.group("ext").lower(), "application/octet-stream"),
+            "ETag": f'"{hashlib.md5(name.encode("utf-8")).hexdigest()}-{size}"',
+        }
+        if self.headers.get("If-None-Match") == headers["ETag"]:
+            self._send_empty(304, {"ETag": headers["ETag"]})
+            return
+        start, end = 0, size - 1
+        range_match = _RANGE_HEADER.match(self.headers.get("Range", "")) if config["range_support"] else None
+        if config["range_support"]:
+            headers["Accept-Ranges"] = "bytes"
+        if range_match:
+            start = int(range_match.group(1))
+            end = int(range_match.group(2)) if range_match.group(2) else size - 1
+            if start >= size:
+                self._send_empty(416, {"Content-Range": f"bytes */{size}"})
+                return
+            end = min(end, size - 1)
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.server.count("requests")
+        if send_body:
+            self._write_body(memoryview(body)[start:end + 1], config["bandwidth"])
+
+    def _write_body(self, view, bandwidth):
+        started = time.monotonic()
+        sent = 0
+        for offset in range(0, len(view), _WRITE_CHUNK):
+            chunk = view[offset:offset + _WRITE_CHUNK]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if bandwidth:
+                ahead = sent / bandwidth - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.server.count("bytes", sent)
+
+    def _send_empty(self, status, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class LocalCdnServer:
+    """
+    CDN giả lập chạy trong thread nền.
+
+    :param latency: số giây chờ trước khi trả header (mô phỏng time-to-first-byte)
+    :param error_rate: tỉ lệ request bị trả lỗi `error_status` (0..1)
+    :param error_status: mã lỗi trả về (503 hoặc 429 kèm Retry-After)
+    :param range_support: hỗ trợ header Range (206) hay luôn trả 200 cả file
+    :param bandwidth: byte/giây tối đa mỗi response (None = không giới hạn)
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, error_status=503,
+                 range_support=True, bandwidth=None, seed=0):
+        self._httpd = http.server.ThreadingHTTPServer((host, port), _MediaHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.config = {
+            "latency": latency,
+            "error_rate": error_rate,
+            "error_status": error_status,
+            "range_support": range_support,
+            "bandwidth": bandwidth,
+            "rng": random.Random(seed),
+        }
+        self._bodies = {}
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "bytes": 0}
+        self._httpd.get_body = self._get_body
+        self._httpd.count = self._count
+        self._thread = None
+
+    def _get_body(self, name, size):
+        key = (name, size)
+        with self._lock:
+            body = self._bodies.get(key)
+        if body is None:
+            body = media_bytes(name, size)
+            with self._lock:
+                self._bodies[key] = body
+        return body
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def url(self, name, size, ext=".jpg"):
+        """URL tới một file giả lập `size` bytes."""
+        return f"{self.base_url}/media/{name}-{size}{ext}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CDN giả lập cho benchmark tải file")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Giây chờ trước khi trả header")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Tỉ lệ request lỗi (0..1)")
+    parser.add_argument("--error-status", type=int, default=503, choices=(429, 503))
+    parser.add_argument("--no-range", action="store_true", help="Tắt hỗ trợ Range")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Byte/giây tối đa mỗi response")
+    args = parser.parse_args()
+    server = LocalCdnServer(
+        port=args.port, latency=args.latency, error_rate=args.error_rate, error_status=args.error_status,
+        range_support=not args.no_range, bandwidth=args.bandwidth or None,
+    )
+    print(f"CDN giả lập: {server.url('example', 250000)}")
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
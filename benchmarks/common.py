@@ -0,0 +1,59 @@
+"""Hàm dùng chung cho các benchmark: đo thời gian, percentile, in bảng / JSON."""
+import json
+import os
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+
+def best_of(func, repeat):
+    """Chạy `func` `repeat` lần, trả về (thời gian nhanh nhất, list thời gian từng lần) tính bằng giây."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings), timings
+
+
+def percentile(values, fraction):
+    """Percentile theo nearest-rank trên list đã sort hoặc chưa sort; None nếu rỗng."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def latency_summary(values):
+    """dict {'p50', 'p99', 'max'} (giây) của một list thời gian."""
+    return {
+        'p50': percentile(values, 0.50),
+        'p99': percentile(values, 0.99),
+        'max': max(values) if values else None,
+    }
+
+
+def print_table(rows, columns):
+    """In list dict dạng bảng căn phải theo `columns` [(key, tiêu đề, format)]."""
+    table = [
+        ['-' if row.get(key) is None else format(row.get(key), fmt) for key, _, fmt in columns]
+        for row in rows
+    ]
+    widths = [
+        max([len(title), 10] + [len(cells[i]) for cells in table])
+        for i, (_, title, _) in enumerate(columns)
+    ]
+    print(" ".join(f"{title:>{width}}" for (_, title, _), width in zip(columns, widths)))
+    for cells in table:
+        print(" ".join(f"{cell:>{width}}" for cell, width in zip(cells, widths)))
+
+
+def write_json(path, data):
+    """Ghi kết quả benchmark ra JSON (để so sánh giữa các phiên bản)."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.write("\n")
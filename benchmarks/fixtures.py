@@ -0,0 +1,76 @@
+"""Sinh HTML giả lập `ul.profile-media-list` của gramsnap để benchmark offline."""
+import os
+import random
+from datetime import datetime, timedelta
+
+ITEM_TEMPLATE = (
+    '<li class="profile-media-list__item">'
+    '<div class="media-content">'
+    '<img class="media-content__image" src="https://scontent.cdninstagram.com/v/t51/{n}_thumb.jpg?stp=dst&amp;oe={oe}" alt="">'
+    '</div>'
+    '<div class="media-content__info">'
+    '<p class="media-content__caption">Caption {n} &amp; some #tags @mention</p>'
+    '<p class="media-content__meta-time" title="{title}">{ago} ago</p>'
+    '<a class="button button--filled button__download" '
+    'href="https://scontent.cdninstagram.com/v/t51/{n}_n.{ext}?_nc_ht=scontent&amp;oh=00_{n}&amp;oe={oe}">Download</a>'
+    '</div>'
+    '</li>'
+)
+
+
+def make_profile_media_list(count, seed=0):
+    """
+    Tạo inner HTML của ul.profile-media-list với `count` item (mới nhất trước).
+
+    Khoảng 1/8 item trùng giây với item trước để kiểm tra việc đánh số tên file trùng.
+    """
+    rng = random.Random(seed)
+    now = datetime(2025, 7, 6, 8, 46, 19)
+    parts = []
+    for n in range(count):
+        if n and rng.random() >= 0.125:
+            now -= timedelta(minutes=rng.randint(1, 600), seconds=rng.randint(0, 59))
+        hour = now.hour % 12 or 12
+        suffix = "AM" if now.hour < 12 else "PM"
+        title = f"{now.month}/{now.day}/{now.year}, {hour}:{now.minute:02d}:{now.second:02d} {suffix}"
+        parts.append(ITEM_TEMPLATE.format(
+            n=1000000 + n,
+            oe=format(1760000000 + n, "X"),
+            title=title,
+            ago=f"{n + 1}h",
+            ext="mp4" if rng.random() < 0.3 else "jpg",
+        ))
+    return "".join(parts)
+
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+# Kích thước có file HTML lưu sẵn trong benchmarks/fixtures/ (cố định giữa các phiên bản)
+SAVED_FIXTURE_SIZES = (100, 1000)
+
+
+def fixture_path(count):
+    return os.path.join(FIXTURE_DIR, f"profile_media_list_{count}.html")
+
+
+def load_fixture(count):
+    """
+    Đọc HTML fixture `count` item đã lưu trong benchmarks/fixtures/; nếu không có file,
+    sinh bằng `make_profile_media_list(count)` (seed cố định nên kết quả vẫn lặp lại được).
+    """
+    path = fixture_path(count)
+    if os.path.isfile(path):
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    return make_profile_media_list(count)
+
+
+def save_fixtures(sizes=SAVED_FIXTURE_SIZES):
+    """Ghi lại các fixture vào benchmarks/fixtures/ (chỉ chạy khi cố ý đổi fixture)."""
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    for count in sizes:
+        with open(fixture_path(count), "w", encoding="utf-8") as f:
+            f.write(make_profile_media_list(count))
+
+
+if __name__ == "__main__":
+    save_fixtures()
@@ -0,0 +1,70 @@
+"""
+Chạy toàn bộ benchmark offline (parse, database, claim, download) với tham số mặc định và ghi một file
+JSON tổng hợp để so sánh giữa các phiên bản. Exit code 1 nếu claim_batch có sort tạm trong query plan.
+
+Chạy: python benchmarks/run_all.py [--quick] [--json benchmark-results.json]
+"""
+import argparse
+import platform
+import sys
+from datetime import datetime
+
+import bench_claim
+import bench_db
+import bench_download
+import bench_parse
+from common import write_json
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="Bộ dữ liệu nhỏ (kiểm tra nhanh, số liệu kém ổn định hơn)")
+    parser.add_argument("--json", default="benchmark-results.json", help="File JSON kết quả")
+    args = parser.parse_args()
+
+    parse_sizes = [100, 1000] if args.quick else [100, 1000, 5000]
+    db_rows = 5000 if args.quick else 20000
+    download_files = 60 if args.quick else 200
+    claim_queues = [100000] if args.quick else [100000, 300000]
+
+    print("== parse ==")
+    parse_results = bench_parse.run(parse_sizes)
+    for row in parse_results:
+        print(f"{row['items']:>6} {row['engine']:>5}: {row['items_per_second']:,.0f} items/s")
+
+    print("== database ==")
+    db_results = bench_db.run(rows=db_rows)
+    for row in db_results:
+        label = f"{row['op']} @ {row['queue']}" if row.get('queue') else row['op']
+        rate = (f"{row['claims_per_second']:,.0f} claims/s" if row.get('claims_per_second')
+                else f"{row['items_per_second']:,.0f} items/s")
+        print(f"{label:>38}: {rate}, p50 {row['p50']:.3f} ms, p99 {row['p99']:.3f} ms")
+
+    print("== claim ==")
+    claim_results = bench_claim.run(claim_queues)
+    for row in claim_results:
+        print(f"{row['queue']:>7} pending: {row['claims_per_second']:,.0f} claims/s, p99 {row['p99']:.3f} ms, "
+              f"{row['temp_btree']} sort tạm")
+
+    print("== download ==")
+    download_results = bench_download.run(files=download_files, workers=(4, 8))
+    for row in download_results:
+        print(f"{row['workers']:>3} luồng: {row['files_per_second']:.1f} files/s, {row['mb_per_second']:.1f} MB/s, "
+              f"ttfb p99 {row['ttfb_p99_ms']:.1f} ms")
+
+    write_json(args.json, {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'quick': args.quick,
+        'parse': parse_results,
+        'db': db_results,
+        'claim': claim_results,
+        'download': download_results,
+    })
+    print(f"Đã ghi {args.json}")
+    return 1 if any(row['temp_btree'] for row in claim_results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())